@@ -0,0 +1,422 @@
+"""
+Chooses the fastest available reflectivity backend for each problem size.
+
+Which backend is fastest depends on the host and on the size of the problem.
+The C kernel is only just ahead of the Python kernel for a few hundred points,
+OpenCL has a fixed launch overhead but wins for large problems, and threads
+only pay off when there's enough work. `Autotuner` times each available
+backend on a grid of (npoints, nlayers, threads) cells, stores the results on
+disk and sends each calculation to the fastest backend for its cell.
+
+The refnx code is distributed under the following license:
+
+Copyright (c) 2015 A. R. J. Nelson, ANSTO
+
+Permission to use and redistribute the source code or binary forms of this
+software and its documentation, with or without modification is hereby
+granted provided that the above notice of copyright, these terms of use,
+and the disclaimer of warranty below appear in the source code and
+documentation, and that none of the names of above institutions or
+authors appear in advertising or endorsement of works derived from this
+software without specific prior written permission from all parties.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+DEALINGS IN THIS SOFTWARE.
+
+"""
+
+import atexit
+import json
+import os
+import platform
+import threading
+import time
+
+import numpy as np
+
+try:
+    from . import _reflect
+except ImportError:
+    import _reflect
+
+
+# cells of the tuning grid. A problem is timed in the smallest cell that is at
+# least as large.
+NPOINTS_GRID = (64, 256, 1024, 4096, 16384, 65536)
+NLAYERS_GRID = (0, 4, 16, 64, 256)
+
+# backends whose results differ from the Python kernel by more than this are
+# not used.
+_RTOL = 1e-6
+
+# the cache file format, results with a different version are discarded.
+_VERSION = 2
+
+
+def _load_c():
+    try:
+        from . import _creflect
+    except ImportError:
+        import _creflect
+    return _creflect.abeles
+
+
+def _load_python():
+    return _reflect.abeles
+
+
+def _load_pyopencl():
+    import pyopencl  # noqa: F401
+
+    return _reflect.abeles_pyopencl
+
+
+# name -> function returning the backend's abeles, raising ImportError (or
+# another exception) if the backend isn't available.
+_BACKENDS = {
+    "c": _load_c,
+    "python": _load_python,
+    "pyopencl": _load_pyopencl,
+}
+
+
+def available_backends():
+    """
+    The reflectivity backends that can be used on this host.
+
+    Returns
+    -------
+    backends: dict
+        name -> abeles function, with the same signature as
+        `_reflect.abeles`.
+    """
+    backends = {}
+    for name, load in _BACKENDS.items():
+        try:
+            backends[name] = load()
+        except Exception:
+            continue
+    return backends
+
+
+def _normalise_threads(threads):
+    if threads == -1:
+        return os.cpu_count() or 1
+    return max(int(threads), 1)
+
+
+def _cell(npoints, nlayers, threads):
+    # the grid cell that a problem belongs to. Problems larger than the grid
+    # use the largest cell.
+    i = np.searchsorted(NPOINTS_GRID, npoints)
+    j = np.searchsorted(NLAYERS_GRID, nlayers)
+    return (
+        NPOINTS_GRID[min(i, len(NPOINTS_GRID) - 1)],
+        NLAYERS_GRID[min(j, len(NLAYERS_GRID) - 1)],
+        _normalise_threads(threads),
+    )
+
+
+def _key(cell):
+    return "%d,%d,%d" % cell
+
+
+def _problem(npoints, nlayers):
+    # a representative problem for a cell. The SLD profile and roughnesses
+    # are random, but fixed, so timings don't depend on the call order.
+    rng = np.random.default_rng(npoints + 1000 * nlayers)
+    q = np.linspace(0.005, 0.5, npoints)
+    layers = np.zeros((nlayers + 2, 4))
+    layers[1:-1, 0] = rng.uniform(10, 100, nlayers)
+    layers[1:-1, 1] = rng.uniform(-1, 7, nlayers)
+    layers[1:-1, 2] = rng.uniform(0, 0.1, nlayers)
+    layers[1:, 3] = rng.uniform(1, 5, nlayers + 1)
+    layers[-1, 1] = 2.07
+    return q, layers
+
+
+def _time(func, min_time=0.02, repeat=3):
+    # best time of `repeat` runs, each long enough to be measured reliably
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or number >= 1000:
+            break
+        number *= 2
+
+    best = elapsed / number
+    if elapsed > 25 * min_time:
+        # slow enough that timing noise doesn't matter
+        return best
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+
+def _uncached(abeles, q, layers, threads):
+    # The backends are timed on the same problem over and over. The Python
+    # kernel would only measure its interface term cache after the first
+    # call, while the other backends do the whole calculation.
+    _reflect._clear_interface_cache()
+    return abeles(q, layers, threads=threads)
+
+
+def _host():
+    # describes the host and the backends, timings measured with a different
+    # description are not reused.
+    return {
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "node": platform.node(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+    }
+
+
+class Autotuner:
+    """
+    Calculates reflectivity with the fastest backend for the problem size.
+
+    The first time a problem from a given (npoints, nlayers, threads) cell is
+    calculated, every available backend is timed on a representative problem
+    from that cell. Backends that don't agree with the Python kernel are
+    excluded. The timings are saved to `cache_file`, so later processes on
+    the same host don't repeat them. Cells measured on first use are saved
+    together when the interpreter exits, rather than rewriting the file
+    after each one. `tune` measures the whole grid up front and saves it
+    straight away.
+
+    Parameters
+    ----------
+    backends: dict, optional
+        name -> abeles function, by default `available_backends()`.
+    cache_file: str or None, optional
+        JSON file in which the timings are kept. By default
+        ``autotune.json`` in the refnx cache directory (``$REFNX_CACHE_DIR``
+        or ``~/.cache/refnx``). If None, the timings are only kept in memory.
+
+    Examples
+    --------
+    >>> autotuner = Autotuner()
+    >>> autotuner.best(1000, 10)
+    'c'
+    >>> R = autotuner(q, layers, threads=-1)
+    """
+
+    def __init__(self, backends=None, cache_file=""):
+        if backends is None:
+            backends = available_backends()
+        self.backends = dict(backends)
+
+        if cache_file == "":
+            cache_file = _reflect._cache_dir("autotune.json")
+        self.cache_file = cache_file
+
+        # cell key -> {backend name: seconds, or None if inaccurate}
+        self.timings = {}
+        self._best = {}
+        # guards timings and _best. Held while a cell is measured, so that
+        # concurrent calls don't time the backends against each other.
+        self._lock = threading.RLock()
+        # True once a save at exit has been registered for new timings
+        self._save_pending = False
+        self._load()
+
+    def _load(self):
+        if self.cache_file is None or not os.path.isfile(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, "r") as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return
+        if stored.get("version") != _VERSION or stored.get("host") != _host():
+            return
+        self.timings.update(stored.get("timings", {}))
+
+    def save(self):
+        """
+        Write the timings to `cache_file`, merged with any timings that
+        other processes have written in the meantime.
+        """
+        if self.cache_file is None:
+            return
+        with self._lock:
+            timings = {key: dict(cell) for key, cell in self.timings.items()}
+        previous = Autotuner(backends={}, cache_file=self.cache_file)
+        for key, cell in previous.timings.items():
+            timings.setdefault(key, {})
+            for name, seconds in cell.items():
+                timings[key].setdefault(name, seconds)
+
+        stored = {"version": _VERSION, "host": _host(), "timings": timings}
+        _reflect._write_atomic(
+            self.cache_file, json.dumps(stored, indent=1).encode()
+        )
+
+    def measure(self, npoints, nlayers, threads=0):
+        """
+        Time the backends for the cell containing a problem, unless they've
+        already been timed.
+
+        Parameters
+        ----------
+        npoints: int
+            Number of Q points.
+        nlayers: int
+            Number of layers, not counting the fronting and backing media.
+        threads: int, optional
+            Number of threads, -1 means `os.cpu_count()`.
+
+        Returns
+        -------
+        timings: dict
+            backend name -> seconds per calculation. Backends that don't
+            agree with the Python kernel have a time of None.
+        """
+        cell = _cell(npoints, nlayers, threads)
+        key = _key(cell)
+        with self._lock:
+            timings = self.timings.setdefault(key, {})
+            missing = [name for name in self.backends if name not in timings]
+            if not missing:
+                return dict(timings)
+
+            q, layers = _problem(*cell[:2])
+            reference = _reflect.abeles(q, layers)
+            for name in missing:
+                abeles = self.backends[name]
+                try:
+                    # the first call may include setup, e.g. OpenCL
+                    # compilation
+                    R = abeles(q, layers, threads=cell[2])
+                except Exception:
+                    timings[name] = None
+                    continue
+                if not np.allclose(R, reference, rtol=_RTOL, atol=0):
+                    timings[name] = None
+                    continue
+                timings[name] = _time(
+                    lambda: _uncached(abeles, q, layers, cell[2])
+                )
+
+            self._best.pop(key, None)
+            return dict(timings)
+
+    def _save_at_exit(self):
+        # batches the saves of cells measured on first use
+        with self._lock:
+            if self._save_pending or self.cache_file is None:
+                return
+            self._save_pending = True
+        atexit.register(self.save)
+
+    def tune(
+        self,
+        npoints_grid=NPOINTS_GRID,
+        nlayers_grid=NLAYERS_GRID,
+        threads_grid=(1, -1),
+    ):
+        """
+        Time the backends over a grid of problem sizes and save the results.
+
+        Parameters
+        ----------
+        npoints_grid, nlayers_grid, threads_grid: sequence of int
+            Problem sizes to time.
+        """
+        for npoints in npoints_grid:
+            for nlayers in nlayers_grid:
+                for threads in threads_grid:
+                    self.measure(npoints, nlayers, threads)
+        self.save()
+
+    def best(self, npoints, nlayers, threads=0):
+        """
+        The fastest backend for a problem, timing the backends first if
+        necessary.
+
+        Parameters
+        ----------
+        npoints: int
+            Number of Q points.
+        nlayers: int
+            Number of layers, not counting the fronting and backing media.
+        threads: int, optional
+            Number of threads, -1 means `os.cpu_count()`.
+
+        Returns
+        -------
+        name: str
+            Name of the fastest backend.
+        """
+        key = _key(_cell(npoints, nlayers, threads))
+        name = self._best.get(key)
+        if name is not None:
+            return name
+
+        with self._lock:
+            cell = dict(self.timings.get(key, {}))
+        if any(name not in cell for name in self.backends):
+            cell = self.measure(npoints, nlayers, threads)
+            self._save_at_exit()
+
+        usable = {
+            name: seconds
+            for name, seconds in cell.items()
+            if name in self.backends and seconds is not None
+        }
+        name = min(usable, key=usable.get) if usable else "python"
+        with self._lock:
+            self._best[key] = name
+        return name
+
+    def __call__(self, q, layers, scale=1.0, bkg=0.0, threads=0):
+        """
+        Abeles matrix formalism for calculating reflectivity from a
+        stratified medium, using the fastest backend. The arguments are the
+        same as for `_reflect.abeles`.
+
+        Returns
+        -------
+        Reflectivity: np.ndarray
+            Calculated reflectivity values for each q value.
+        """
+        q = np.asarray(q, dtype=np.float64)
+        name = self.best(q.size, len(layers) - 2, threads)
+        abeles = self.backends.get(name, _reflect.abeles)
+        return abeles(q, layers, scale=scale, bkg=bkg, threads=threads)
+
+
+_autotuner = None
+
+
+def get_autotuner():
+    """
+    The process wide `Autotuner`, created on first use.
+    """
+    global _autotuner
+    if _autotuner is None:
+        _autotuner = Autotuner()
+    return _autotuner
+
+
+def abeles(q, layers, scale=1.0, bkg=0.0, threads=0):
+    """
+    Abeles matrix formalism for calculating reflectivity from a stratified
+    medium, with the fastest backend for the problem size on this host. See
+    `_reflect.abeles` for the parameters.
+    """
+    return get_autotuner()(q, layers, scale=scale, bkg=bkg, threads=threads)
@@ -0,0 +1,344 @@
+"""
+Micro-benchmarks for the reflectivity kernels.
+
+Each kernel is timed over a sweep of Q point, layer and thread counts, and the
+throughput is reported in points * layers per second (layers are counted as
+interfaces, N + 1 for N layers). Results can be saved as a baseline and later
+runs compared against it, so that kernel regressions are caught::
+
+    python _benchmark.py --save baseline.json
+    python _benchmark.py --compare baseline.json
+
+``--compare`` exits with status 1 if any benchmark is more than
+``--tolerance`` slower than its baseline.
+
+The reference baseline is tracked in ``benchmark_baseline.json``, next to
+this file, and records the host it was measured on. Timings are only
+comparable on the same host, so on another host (e.g. a CI runner) record a
+baseline from the base commit first and compare the change against that::
+
+    git stash; python _benchmark.py --save /tmp/base.json; git stash pop
+    python _benchmark.py --compare /tmp/base.json
+
+When a change is meant to alter kernel performance, regenerate the tracked
+baseline with the default sweep (``python _benchmark.py --save
+benchmark_baseline.json``) and commit it with the change.
+
+The refnx code is distributed under the following license:
+
+Copyright (c) 2015 A. R. J. Nelson, ANSTO
+
+Permission to use and redistribute the source code or binary forms of this
+software and its documentation, with or without modification is hereby
+granted provided that the above notice of copyright, these terms of use,
+and the disclaimer of warranty below appear in the source code and
+documentation, and that none of the names of above institutions or
+authors appear in advertising or endorsement of works derived from this
+software without specific prior written permission from all parties.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+DEALINGS IN THIS SOFTWARE.
+
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+try:
+    from . import _autotune, _reflect
+except ImportError:
+    import _autotune
+    import _reflect
+
+
+NPOINTS = (100, 1000, 10000)
+NLAYERS = (2, 20, 200)
+
+# the baseline file format, baselines with a different version can't be
+# compared.
+_VERSION = 1
+
+
+def _abeles_problem(npoints, nlayers):
+    return _autotune._problem(npoints, nlayers)
+
+
+def _pnr_problem(npoints, nlayers, rough=True):
+    q, layers = _autotune._problem(npoints, nlayers)
+    rng = np.random.default_rng(nlayers)
+    magnetic = np.zeros((nlayers + 2, 6))
+    magnetic[:, :3] = layers[:, :3]
+    magnetic[1:-1, 3] = rng.uniform(0, 2, nlayers)
+    magnetic[1:-1, 4] = rng.uniform(0, 180, nlayers)
+    if rough:
+        magnetic[:, 5] = layers[:, 3]
+    return q, magnetic
+
+
+def _pnr_smooth_problem(npoints, nlayers):
+    # without roughness pnr multiplies the layer matrices in place
+    return _pnr_problem(npoints, nlayers, rough=False)
+
+
+def _contract_problem(npoints, nlayers):
+    # a finely microsliced profile, of the kind _contract_by_area is for
+    z = np.linspace(-1, 1, nlayers)
+    slabs = np.zeros((nlayers + 2, 5))
+    slabs[1:-1, 0] = 1.0
+    slabs[1:-1, 1] = 3 + np.tanh(5 * z)
+    slabs[-1, 1] = 2.07
+    return None, slabs
+
+
+def _kernels():
+    """
+    The kernels that can be benchmarked on this host.
+
+    Returns
+    -------
+    kernels: dict
+        name -> (problem, calc, threaded). ``problem(npoints, nlayers)``
+        returns ``(q, layers)`` and ``calc(q, layers, threads)`` does the
+        calculation. If `threaded` is False the kernel is only timed with
+        one thread.
+    """
+    kernels = {
+        "abeles": (
+            _abeles_problem,
+            lambda q, w, threads: _reflect.abeles(q, w, threads=threads),
+            True,
+        ),
+        "pnr": (
+            _pnr_problem,
+            lambda q, w, threads: _reflect.pnr(q, w, threads=threads),
+            True,
+        ),
+        "pnr_smooth": (
+            _pnr_smooth_problem,
+            lambda q, w, threads: _reflect.pnr(q, w, threads=threads),
+            True,
+        ),
+        # the uncached contraction, _contract_by_area would only measure
+        # the cache after the first call.
+        "contract_by_area": (
+            _contract_problem,
+            lambda q, w, threads: _reflect._contract(w, 0.5),
+            False,
+        ),
+    }
+
+    backends = _autotune.available_backends()
+    if "c" in backends:
+        creflect = backends["c"]
+        kernels["creflect"] = (
+            _abeles_problem,
+            lambda q, w, threads: creflect(q, w, threads=threads),
+            True,
+        )
+    if "pyopencl" in backends:
+        opencl = backends["pyopencl"]
+        kernels["pyopencl"] = (
+            _abeles_problem,
+            lambda q, w, threads: opencl(q, w),
+            False,
+        )
+    return kernels
+
+
+def _uncached(calc, q, layers, threads):
+    # The same problem is calculated over and over, so abeles would only
+    # measure its interface term cache after the first call.
+    _reflect._clear_interface_cache()
+    return calc(q, layers, threads)
+
+
+def _key(kernel, npoints, nlayers, threads):
+    return f"{kernel}/{npoints}/{nlayers}/{threads}"
+
+
+def run(kernels=None, npoints=NPOINTS, nlayers=NLAYERS, threads=None):
+    """
+    Time the kernels over a sweep of problem sizes.
+
+    Parameters
+    ----------
+    kernels: sequence of str, optional
+        Names of the kernels to time, by default all the available ones
+        ('abeles', 'pnr', 'pnr_smooth', 'contract_by_area', 'creflect',
+        'pyopencl').
+    npoints, nlayers: sequence of int, optional
+        Numbers of Q points and layers to time.
+    threads: sequence of int, optional
+        Numbers of threads to time, by default 1 and `os.cpu_count()`.
+
+    Returns
+    -------
+    results: dict
+        ``'kernel/npoints/nlayers/threads'`` -> ``{'seconds': ...,
+        'throughput': ...}``, with throughput in points * layers per second.
+        'contract_by_area' has no Q points, its throughput is in layers per
+        second.
+    """
+    available = _kernels()
+    if kernels is None:
+        kernels = list(available)
+    if threads is None:
+        threads = sorted({1, os.cpu_count() or 1})
+
+    results = {}
+    for name in kernels:
+        problem, calc, threaded = available[name]
+        for nlayer in nlayers:
+            for npoint in npoints if name != "contract_by_area" else (1,):
+                q, layers = problem(npoint, nlayer)
+                for thread in threads if threaded else (1,):
+                    # the first call may include setup, e.g. compilation
+                    calc(q, layers, thread)
+                    seconds = _autotune._time(
+                        lambda: _uncached(calc, q, layers, thread)
+                    )
+                    results[_key(name, npoint, nlayer, thread)] = {
+                        "seconds": seconds,
+                        "throughput": npoint * (nlayer + 1) / seconds,
+                    }
+    return results
+
+
+def save(results, fname):
+    """
+    Save benchmark results as a baseline.
+
+    Parameters
+    ----------
+    results: dict
+        From `run`.
+    fname: str
+        JSON file to write.
+    """
+    stored = {
+        "version": _VERSION,
+        "host": _autotune._host(),
+        "results": results,
+    }
+    with open(fname, "w") as f:
+        json.dump(stored, f, indent=1)
+
+
+def compare(results, fname, tolerance=0.2):
+    """
+    Compare benchmark results against a saved baseline.
+
+    Parameters
+    ----------
+    results: dict
+        From `run`.
+    fname: str
+        Baseline written by `save`.
+    tolerance: float, optional
+        A benchmark is a regression if its throughput is more than this
+        fraction below the baseline.
+
+    Returns
+    -------
+    ratios: dict
+        benchmark key -> throughput / baseline throughput, for the
+        benchmarks present in both.
+    regressions: list of str
+        The keys of the benchmarks that regressed.
+    """
+    with open(fname, "r") as f:
+        stored = json.load(f)
+    if stored.get("version") != _VERSION:
+        raise ValueError(f"{fname} is not a compatible benchmark baseline")
+    if stored.get("host") != _autotune._host():
+        print(
+            f"Warning: {fname} was recorded on a different host, the"
+            " comparison may not be meaningful.",
+            file=sys.stderr,
+        )
+
+    baseline = stored["results"]
+    ratios = {
+        key: result["throughput"] / baseline[key]["throughput"]
+        for key, result in results.items()
+        if key in baseline
+    }
+    regressions = [
+        key for key, ratio in ratios.items() if ratio < 1 - tolerance
+    ]
+    return ratios, regressions
+
+
+def _format(results, ratios=None, regressions=()):
+    lines = [
+        f"{'benchmark':<36}{'time (s)':>12}{'points*layers/s':>18}"
+        + (f"{'vs baseline':>14}" if ratios is not None else "")
+    ]
+    for key, result in results.items():
+        line = (
+            f"{key:<36}{result['seconds']:>12.3e}"
+            f"{result['throughput']:>18.3e}"
+        )
+        if ratios is not None:
+            if key in ratios:
+                flag = " !" if key in regressions else ""
+                line += f"{ratios[key]:>12.2f}x{flag}"
+            else:
+                line += f"{'-':>13}"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the reflectivity kernels."
+    )
+    parser.add_argument(
+        "--kernels",
+        nargs="+",
+        help="kernels to benchmark, by default all the available ones",
+    )
+    parser.add_argument("--npoints", nargs="+", type=int, default=NPOINTS)
+    parser.add_argument("--nlayers", nargs="+", type=int, default=NLAYERS)
+    parser.add_argument("--threads", nargs="+", type=int)
+    parser.add_argument("--save", help="save the results as a baseline")
+    parser.add_argument("--compare", help="compare against a baseline")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed fractional loss of throughput (default 0.2)",
+    )
+    args = parser.parse_args(argv)
+
+    results = run(
+        kernels=args.kernels,
+        npoints=args.npoints,
+        nlayers=args.nlayers,
+        threads=args.threads,
+    )
+
+    ratios, regressions = None, []
+    if args.compare:
+        ratios, regressions = compare(results, args.compare, args.tolerance)
+    print(_format(results, ratios, regressions))
+
+    if args.save:
+        save(results, args.save)
+    if regressions:
+        print(f"\n{len(regressions)} benchmark(s) regressed", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
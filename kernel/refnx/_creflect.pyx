@@ -35,6 +35,13 @@ cdef extern from "refcaller.h" nogil:
                  const double *xP)
     void reflectMT(int numcoefs, const double *coefP, int npoints, double *yP,
                    const double *xP, int threads)
+    void reflect_batch(int nstructures, int numcoefs, const double *coefP,
+                       int npoints, double *yP, const double *xP,
+                       int threads)
+    void reflect_jacobian(int numcoefs, const double *coefP, int npoints,
+                          double *yP, double *jacP, const double *xP)
+    void reflect_single(int numcoefs, const double *coefP, int npoints,
+                        double *yP, double *errP, const double *xP)
 
 DTYPE = np.float64
 ctypedef cnp.float64_t DTYPE_t
@@ -131,6 +138,245 @@ cpdef cnp.ndarray abeles(cnp.ndarray x,
     return y
 
 
+@cython.boundscheck(False)
+@cython.cdivision(True)
+cpdef cnp.ndarray abeles_batch(cnp.ndarray x,
+                               double[:, :, :] w,
+                               scale=1.0,
+                               bkg=0.,
+                               int threads=-1):
+    """Abeles matrix formalism for calculating reflectivity from a whole
+    population of stratified media in a single call.
+
+    Parameters
+    ----------
+    q: array_like
+        the q values required for the calculation.
+        Q = 4 * Pi / lambda * sin(omega).
+        Units = Angstrom**-1
+    layers: np.ndarray
+        coefficients required for the calculation, has shape (P, 2 + N, 4),
+        where P is the number of structures and N is the number of layers.
+        Each ``layers[i]`` has the same layout as the `layers` argument of
+        `abeles`.
+    scale: float or array_like
+        Multiply all reflectivities by this value. Can also be an array of
+        shape (P,), one value per structure.
+    bkg: float or array_like
+        Linear background to be added to all reflectivities. Can also be an
+        array of shape (P,), one value per structure.
+    threads: int, optional
+        How many threads you would like to use in the reflectivity calculation.
+        If `threads == -1` then the calculation is automatically spread over
+        `multiprocessing.cpu_count()` threads.
+
+    Returns
+    -------
+    Reflectivity: np.ndarray
+        Calculated reflectivity values for each structure and each q value,
+        has shape ``(P,) + q.shape``.
+    """
+    if w.shape[2] != 4 or w.shape[1] < 2:
+        raise ValueError("Layer parameters for _creflect must be an array of"
+                         " shape (P, >2, 4)")
+    if x.dtype != np.float64:
+        raise ValueError("Q values for _creflect must be np.float64")
+
+    cdef:
+        int npop = w.shape[0]
+        int nlayers = w.shape[1] - 2
+        int npoints = x.size
+        int ncoefs = 4*nlayers + 8
+        Py_ssize_t i
+        cnp.ndarray[DTYPE_t, ndim=2] coefs = np.empty((npop, ncoefs), DTYPE)
+        double[:, ::1] coefs_view = coefs
+        cnp.ndarray y = np.empty((npop,) + (<object>x).shape, DTYPE)
+        # one scale factor and background per structure
+        double[::1] scales = np.array(
+            np.broadcast_to(np.reshape(scale, -1), (npop,)), DTYPE
+        )
+        double[::1] bkgs = np.array(
+            np.broadcast_to(np.reshape(bkg, -1), (npop,)), DTYPE
+        )
+
+    if not x.flags['C_CONTIGUOUS']:
+        x = np.ascontiguousarray(x, dtype=DTYPE)
+
+    with nogil:
+        if threads == -1:
+            threads = NCPU
+        elif threads == 0:
+            threads = 1
+
+        for i in range(npop):
+            coefs_view[i, 0] = nlayers
+            coefs_view[i, 1] = scales[i]
+            coefs_view[i, 2:4] = w[i, 0, 1: 3]
+            coefs_view[i, 4: 6] = w[i, -1, 1: 3]
+            coefs_view[i, 6] = bkgs[i]
+            coefs_view[i, 7] = w[i, -1, 3]
+            if nlayers:
+                coefs_view[i, 8::4] = w[i, 1:-1, 0]
+                coefs_view[i, 9::4] = w[i, 1:-1, 1]
+                coefs_view[i, 10::4] = w[i, 1:-1, 2]
+                coefs_view[i, 11::4] = w[i, 1:-1, 3]
+
+        reflect_batch(npop, ncoefs, <const double*>coefs.data, npoints,
+                      <double*>y.data, <const double*>x.data, threads)
+
+    return y
+
+
+@cython.boundscheck(False)
+@cython.cdivision(True)
+cpdef abeles_jacobian(cnp.ndarray x,
+                      double[:, :] w,
+                      double scale=1.0,
+                      double bkg=0.):
+    """Reflectivity, and its analytic derivatives with respect to each of the
+    layer parameters, calculated with the Abeles matrix formalism.
+
+    Parameters
+    ----------
+    q: array_like
+        the q values required for the calculation.
+        Q = 4 * Pi / lambda * sin(omega).
+        Units = Angstrom**-1
+    layers: np.ndarray
+        coefficients required for the calculation, has shape (2 + N, 4),
+        where N is the number of layers. The layout is the same as for
+        `abeles`.
+    scale: float
+        Multiply all reflectivities by this value.
+    bkg: float
+        Linear background to be added to all reflectivities
+
+    Returns
+    -------
+    reflectivity, jacobian: np.ndarray
+        `reflectivity` is the same as the output of `abeles`.
+        ``jacobian[i, j]`` is the derivative of the reflectivity with respect
+        to ``layers[i, j]``, it has shape ``layers.shape + q.shape``.
+    """
+    if w.shape[1] != 4 or w.shape[0] < 2:
+        raise ValueError("Layer parameters for _creflect must be an array of"
+                         " shape (>2, 4)")
+    if x.dtype != np.float64:
+        raise ValueError("Q values for _creflect must be np.float64")
+
+    cdef:
+        int nlayers = w.shape[0] - 2
+        int npoints = x.size
+        int ncoefs = 4*nlayers + 8
+        cnp.ndarray[DTYPE_t, ndim=1] coefs = np.empty(ncoefs, DTYPE)
+        double[::1] coefs_view = coefs
+        # C ordered, like the contiguous copy of x that the kernel reads
+        cnp.ndarray y = np.empty_like(x, DTYPE, order="C")
+        cnp.ndarray jac = np.empty((ncoefs, npoints), DTYPE)
+
+    if not x.flags['C_CONTIGUOUS']:
+        x = np.ascontiguousarray(x, dtype=DTYPE)
+
+    with nogil:
+        coefs_view[0] = nlayers
+        coefs_view[1] = scale
+        coefs_view[2:4] = w[0, 1: 3]
+        coefs_view[4: 6] = w[-1, 1: 3]
+        coefs_view[6] = bkg
+        coefs_view[7] = w[-1, 3]
+        if nlayers:
+            coefs_view[8::4] = w[1:-1, 0]
+            coefs_view[9::4] = w[1:-1, 1]
+            coefs_view[10::4] = w[1:-1, 2]
+            coefs_view[11::4] = w[1:-1, 3]
+
+        reflect_jacobian(ncoefs, <const double*>coefs.data, npoints,
+                         <double*>y.data, <double*>jac.data,
+                         <const double*>x.data)
+
+    # rearrange the derivatives with respect to coefs into the layers layout
+    jacobian = np.zeros((nlayers + 2, 4, npoints), DTYPE)
+    jacobian[0, 1:3] = jac[2:4]
+    jacobian[-1, 1:3] = jac[4:6]
+    jacobian[-1, 3] = jac[7]
+    jacobian[1:-1] = jac[8:].reshape(nlayers, 4, npoints)
+
+    shape = (<object>x).shape
+    return y, jacobian.reshape((nlayers + 2, 4) + shape)
+
+
+@cython.boundscheck(False)
+@cython.cdivision(True)
+cpdef abeles_fast(cnp.ndarray x,
+                  double[:, :] w,
+                  double scale=1.0,
+                  double bkg=0.):
+    """Single precision Abeles matrix formalism for calculating reflectivity
+    from a stratified medium, with an estimate of the error.
+
+    Parameters
+    ----------
+    q: array_like
+        the q values required for the calculation.
+        Q = 4 * Pi / lambda * sin(omega).
+        Units = Angstrom**-1
+    layers: np.ndarray
+        coefficients required for the calculation, has shape (2 + N, 4),
+        where N is the number of layers. The layout is the same as for
+        `abeles`.
+    scale: float
+        Multiply all reflectivities by this value.
+    bkg: float
+        Linear background to be added to all reflectivities
+
+    Returns
+    -------
+    reflectivity, error: np.ndarray
+        `reflectivity` is the calculated reflectivity for each q value, only
+        accurate to single precision. `error` is a first order estimate of
+        the relative error of each value, with the errors of the layers added
+        in quadrature. Points whose error is larger than the accuracy you
+        need can be recalculated with `abeles`.
+    """
+    if w.shape[1] != 4 or w.shape[0] < 2:
+        raise ValueError("Layer parameters for _creflect must be an array of"
+                         " shape (>2, 4)")
+    if x.dtype != np.float64:
+        raise ValueError("Q values for _creflect must be np.float64")
+
+    cdef:
+        int nlayers = w.shape[0] - 2
+        int npoints = x.size
+        cnp.ndarray[DTYPE_t, ndim=1] coefs = np.empty(4*nlayers + 8,
+                                                      DTYPE)
+        double[::1] coefs_view = coefs
+        # C ordered, like the contiguous copy of x that the kernel reads
+        cnp.ndarray y = np.empty_like(x, DTYPE, order="C")
+        cnp.ndarray err = np.empty_like(x, DTYPE, order="C")
+
+    if not x.flags['C_CONTIGUOUS']:
+        x = np.ascontiguousarray(x, dtype=DTYPE)
+
+    with nogil:
+        coefs_view[0] = nlayers
+        coefs_view[1] = scale
+        coefs_view[2:4] = w[0, 1: 3]
+        coefs_view[4: 6] = w[-1, 1: 3]
+        coefs_view[6] = bkg
+        coefs_view[7] = w[-1, 3]
+        if nlayers:
+            coefs_view[8::4] = w[1:-1, 0]
+            coefs_view[9::4] = w[1:-1, 1]
+            coefs_view[10::4] = w[1:-1, 2]
+            coefs_view[11::4] = w[1:-1, 3]
+
+        reflect_single(4*nlayers + 8, <const double*>coefs.data, npoints,
+                       <double*>y.data, <double*>err.data,
+                       <const double*>x.data)
+
+    return y, err
+
+
 cpdef _contract_by_area(cnp.ndarray[cnp.float64_t, ndim=2] slabs, dA=0.5):
     newslabs = np.copy(slabs)[::-1]
 
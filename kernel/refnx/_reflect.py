@@ -23,12 +23,30 @@ FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 DEALINGS IN THIS SOFTWARE.
 
 """
+import contextlib
+import hashlib
+import heapq
+import json
+import os
 import os.path
+import threading
+import time
+import warnings
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
 # TINY = np.finfo(np.float64).tiny
 TINY = 1e-30
 
+# TINY is too small for single precision. The imaginary part it gives the
+# wavevectors is ~1e-35, and products of two of them are subnormal float32
+# numbers, which are very slow to calculate with. TINY32 still picks the
+# correct branch cut, but is far below the resolution of Q**2 / 4 in float32.
+TINY32 = 1e-12
+
 """
 import numpy as np
 q = np.linspace(0.01, 0.5, 1000)
@@ -41,162 +59,2934 @@ w = np.array([[0, 2.07, 0, 0],
 """
 The timings for the reflectivity calculation above are (6/3/2019):
 
-_creflect.abeles = 254 us
-_reflect.abeles = 433 us
-the alternative cython implementation is 572 us.
+_creflect.abeles = 254 us
+_reflect.abeles = 433 us
+the alternative cython implementation is 572 us.
+
+If TINY is made too small, then the C implementations start too suffer because
+the sqrt calculation takes too long. The C implementation is only just ahead of
+the python implementation!
+"""
+
+# Calculations smaller than this (number of Q points) are not split over
+# threads, dispatching to the pool would cost more than it saves.
+_MIN_POINTS_PER_THREAD = 500
+
+# Gauss-Kronrod (G2, K5) rule on [-1, 1]. The Gauss nodes are the second and
+# fourth Kronrod nodes, _GK_GAUSS has zero weight at the other three.
+_GK_NODES = np.array(
+    [-np.sqrt(6 / 7), -1 / np.sqrt(3), 0.0, 1 / np.sqrt(3), np.sqrt(6 / 7)]
+)
+_GK_KRONROD = np.array([98 / 495, 27 / 55, 28 / 45, 27 / 55, 98 / 495])
+_GK_GAUSS = np.array([0.0, 1.0, 0.0, 1.0, 0.0])
+
+# half width, in standard deviations, of the resolution kernel
+_GK_WINDOW = 3.5
+
+
+_thread_pool = None
+
+
+def _get_thread_pool():
+    """
+    Lazily created thread pool used by the Python kernels. NumPy's complex
+    ufuncs release the GIL, so Q points can be calculated concurrently.
+    """
+    global _thread_pool
+    if _thread_pool is None:
+        _thread_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+    return _thread_pool
+
+
+def _reset_thread_pool():
+    # the worker threads don't survive a fork, the child makes its own pool.
+    global _thread_pool
+    _thread_pool = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_thread_pool)
+
+
+class KernelProfile:
+    """
+    Call counts and per-stage timings of the reflectivity kernels, collected
+    while a `profile` context is active.
+
+    Notes
+    -----
+    Stages calculated on several threads at once (``threads > 1``) each add
+    their own time, so the stage times can sum to more than the wall time.
+    Calculations done in other processes aren't recorded.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Discard everything recorded so far.
+        """
+        with self._lock:
+            # kernel -> {"calls": ..., "points": ..., "layers": ...}
+            self.kernels = {}
+            # stage -> {"calls": ..., "seconds": ...}
+            self.stages = {}
+
+    def add_call(self, kernel, npoints, nlayers):
+        # one call of a kernel, for npoints Q points and nlayers layers
+        with self._lock:
+            counts = self.kernels.setdefault(
+                kernel, {"calls": 0, "points": 0, "layers": 0}
+            )
+            counts["calls"] += 1
+            counts["points"] += int(npoints)
+            counts["layers"] += int(nlayers)
+
+    def add_stage(self, stage, seconds):
+        with self._lock:
+            timing = self.stages.setdefault(stage, {"calls": 0, "seconds": 0})
+            timing["calls"] += 1
+            timing["seconds"] += seconds
+
+    def snapshot(self):
+        """
+        A copy of the profile so far.
+
+        Returns
+        -------
+        snapshot: dict
+            ``{"kernels": {kernel: {"calls", "points", "layers"}},
+            "stages": {stage: {"calls", "seconds"}}}``. The stages are
+            'abeles.wavevectors', 'abeles.propagation',
+            'abeles_fast.wavevectors', 'abeles_fast.propagation',
+            'abeles_jacobian.wavevectors', 'abeles_jacobian.propagation',
+            'abeles_smeared.reflectance', 'abeles_smeared.quadrature',
+            'abeles_smeared.fft', 'pnr.wavevectors', 'pnr.propagation',
+            'evaluator.reflectance', 'evaluator.smearing',
+            'resolution.smearing' and 'contraction'. The
+            'abeles_smeared.reflectance' stage includes the 'abeles' stages
+            of the calculations it makes.
+        """
+        with self._lock:
+            return {
+                "kernels": {k: dict(v) for k, v in self.kernels.items()},
+                "stages": {k: dict(v) for k, v in self.stages.items()},
+            }
+
+    def to_json(self, **kwds):
+        """
+        The `snapshot` as a JSON string. Keyword arguments are passed to
+        `json.dumps`.
+        """
+        return json.dumps(self.snapshot(), **kwds)
+
+
+# the active KernelProfile. When it's None the kernels only pay for checking
+# that it's None.
+_profiler = None
+
+
+@contextlib.contextmanager
+def profile(profiler=None):
+    """
+    Context manager that records call counts and per-stage timings of
+    `abeles`, `abeles_fast`, `abeles_jacobian`, `abeles_smeared`, `pnr`,
+    `_contract_by_area` and `AbelesEvaluator`.
+
+    Parameters
+    ----------
+    profiler: KernelProfile, optional
+        Accumulate into an existing profile, e.g. across several fits.
+
+    Yields
+    ------
+    profiler: KernelProfile
+
+    Notes
+    -----
+    Profiling applies to calculations on all threads of the process, not
+    only the thread that entered the context.
+
+    Examples
+    --------
+    >>> with profile() as p:
+    ...     R = abeles(q, layers)
+    >>> p.snapshot()["stages"]["abeles.propagation"]["seconds"]
+    """
+    global _profiler
+    if profiler is None:
+        profiler = KernelProfile()
+    previous = _profiler
+    _profiler = profiler
+    try:
+        yield profiler
+    finally:
+        _profiler = previous
+
+
+def _cache_dir(*subdirs):
+    """
+    Directory for refnx's on-disk caches, ``$REFNX_CACHE_DIR`` if it is set,
+    otherwise ``$XDG_CACHE_HOME/refnx`` (``~/.cache/refnx``).
+    """
+    base = os.environ.get("REFNX_CACHE_DIR")
+    if not base:
+        base = os.path.join(
+            os.environ.get("XDG_CACHE_HOME")
+            or os.path.join(os.path.expanduser("~"), ".cache"),
+            "refnx",
+        )
+    return os.path.join(base, *subdirs)
+
+
+def _write_atomic(path, data):
+    # write to a temporary file then rename, so that concurrent processes
+    # never see a partially written file.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except OSError:
+        # the cache is an optimisation, not being able to write it is fine.
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+class _OpenCLState:
+    """
+    The OpenCL context, program, command queue and device buffers used by
+    `abeles_pyopencl` in one process.
+
+    Building ``abeles_pyopencl.cl`` is slow, so compiled program binaries
+    are cached on disk, keyed on the source and the device/driver. Device
+    buffers are reused between calls, and only reallocated when a larger
+    calculation comes along.
+    """
+
+    def __init__(self):
+        import pyopencl as cl
+
+        self.pid = os.getpid()
+        self.ctx = cl.create_some_context(interactive=False)
+        self.queue = cl.CommandQueue(self.ctx)
+        self.prg = self._build_program()
+        self.kernel = cl.Kernel(self.prg, "abeles")
+        self.lock = threading.Lock()
+
+        # name -> (device buffer, capacity in bytes)
+        self._buffers = {}
+        # the Q values currently held in the "q" buffer
+        self._q = None
+
+    def _build_program(self):
+        import pyopencl as cl
+
+        pth = os.path.dirname(os.path.abspath(__file__))
+        with open(os.path.join(pth, "abeles_pyopencl.cl"), "r") as f:
+            src = f.read()
+
+        devices = self.ctx.devices
+        h = hashlib.sha256(src.encode())
+        h.update(cl.VERSION_TEXT.encode())
+        for dev in devices:
+            for info in (dev.platform.name, dev.name, dev.driver_version):
+                h.update(info.encode())
+        fname = _cache_dir("opencl", f"abeles-{h.hexdigest()[:32]}.bin")
+
+        # there's only a single binary if there's a single device.
+        if len(devices) == 1 and os.path.isfile(fname):
+            try:
+                with open(fname, "rb") as f:
+                    binary = f.read()
+                return cl.Program(self.ctx, devices, [binary]).build()
+            except (OSError, cl.Error):
+                # stale or corrupt, rebuild from source
+                pass
+
+        prg = cl.Program(self.ctx, src).build()
+        if len(devices) == 1:
+            binary = prg.get_info(cl.program_info.BINARIES)[0]
+            _write_atomic(fname, binary)
+        return prg
+
+    def buffer(self, name, nbytes, flags):
+        """
+        A device buffer of at least `nbytes`, reused between calls.
+        """
+        import pyopencl as cl
+
+        buf, capacity = self._buffers.get(name, (None, 0))
+        if nbytes > capacity:
+            if buf is not None:
+                buf.release()
+            # round up, so that gradually increasing sizes don't reallocate
+            # every time.
+            capacity = max(1 << (nbytes - 1).bit_length(), 64)
+            buf = cl.Buffer(self.ctx, flags, capacity)
+            self._buffers[name] = (buf, capacity)
+            if name == "q":
+                self._q = None
+        return buf
+
+    def __call__(self, flatq, coefs):
+        import pyopencl as cl
+
+        mf = cl.mem_flags
+        queue = self.queue
+        with self.lock:
+            q_g = self.buffer("q", flatq.nbytes, mf.READ_ONLY)
+            # during a fit the Q values don't change between calls
+            if self._q is None or not np.array_equal(self._q, flatq):
+                cl.enqueue_copy(queue, q_g, flatq, is_blocking=False)
+                self._q = flatq.copy()
+
+            coefs_g = self.buffer("coefs", coefs.nbytes, mf.READ_ONLY)
+            cl.enqueue_copy(queue, coefs_g, coefs, is_blocking=False)
+
+            ref_g = self.buffer("ref", flatq.nbytes, mf.WRITE_ONLY)
+
+            self.kernel(queue, flatq.shape, None, q_g, coefs_g, ref_g)
+            reflectivity = np.empty_like(flatq)
+            cl.enqueue_copy(queue, reflectivity, ref_g)
+        return reflectivity
+
+
+_opencl_state = None
+_opencl_lock = threading.Lock()
+# set in a child forked from a process that had already used OpenCL
+_opencl_forked = False
+
+
+def _get_opencl_state():
+    """
+    Lazily created OpenCL state for this process. OpenCL contexts can't be
+    shared with (or pickled for) child processes, a forked or spawned worker
+    creates its own on first use. The program binary comes from the on-disk
+    cache, so that doesn't mean recompiling.
+    """
+    global _opencl_state, _opencl_forked
+    state = _opencl_state
+    if state is None or state.pid != os.getpid():
+        with _opencl_lock:
+            state = _opencl_state
+            if state is None or state.pid != os.getpid():
+                if _opencl_forked:
+                    warnings.warn(
+                        "OpenCL was used before this process was forked."
+                        " Many OpenCL drivers (e.g. pocl) can't be used in"
+                        " a forked child after that, and calculations may"
+                        " hang. Use the 'spawn' or 'forkserver'"
+                        " multiprocessing start methods instead.",
+                        RuntimeWarning,
+                    )
+                    _opencl_forked = False
+                state = _opencl_state = _OpenCLState()
+    return state
+
+
+def _reset_opencl_state():
+    # the parent's context, queue and buffers can't be used in a forked child.
+    global _opencl_state, _opencl_lock, _opencl_forked
+    _opencl_forked = _opencl_state is not None
+    _opencl_state = None
+    _opencl_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_opencl_state)
+
+
+class _Abeles_pyopencl:
+    """
+    Callable calculating reflectivity with OpenCL. It holds no OpenCL
+    objects itself (they live in a per-process `_OpenCLState`), so it can be
+    pickled and sent to other processes.
+    """
+
+    def __getstate__(self):
+        return self.__dict__.copy()
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def __call__(self, q, w, scale=1.0, bkg=0.0, threads=0):
+        """
+        Abeles matrix formalism for calculating reflectivity from a
+        stratified
+        medium.
+        Uses pyopencl on a GPU to calculate reflectivity. The accuracy of
+        this function may not as good as the C and Python based versions.
+        The OpenCL context is created once per process and the compiled
+        program is cached on disk (see `_cache_dir`), so it can be used
+        from multiprocessing based parallelism. If the parent process has
+        already used OpenCL, start the workers with 'spawn' or
+        'forkserver', most drivers don't survive a fork.
+
+        Parameters
+        ----------
+        q: array_like
+            the q values required for the calculation.
+            Q = 4 * Pi / lambda * sin(omega).
+            Units = Angstrom**-1
+        layers: np.ndarray
+            coefficients required for the calculation, has shape
+            (2 + N, 4), where N is the number of layers
+            layers[0, 1] - SLD of fronting (/1e-6 Angstrom**-2)
+            layers[0, 2] - iSLD of fronting (/1e-6 Angstrom**-2)
+            layers[N, 0] - thickness of layer N
+            layers[N, 1] - SLD of layer N (/1e-6 Angstrom**-2)
+            layers[N, 2] - iSLD of layer N (/1e-6 Angstrom**-2)
+            layers[N, 3] - roughness between layer N-1/N
+            layers[-1, 1] - SLD of backing (/1e-6 Angstrom**-2)
+            layers[-1, 2] - iSLD of backing (/1e-6 Angstrom**-2)
+            layers[-1, 3] - roughness between backing and last layer
+        scale: float
+            Multiply all reflectivities by this value.
+        bkg: float
+            Linear background to be added to all reflectivities
+        threads: int, optional
+            Ignored, the calculation is parallelised over the OpenCL device.
+
+        Returns
+        -------
+        Reflectivity: np.ndarray
+            Calculated reflectivity values for each q value.
+        """
+        qvals = np.asfarray(q)
+        flatq = np.ascontiguousarray(qvals.ravel())
+
+        nlayers = len(w) - 2
+        coefs = np.empty((nlayers * 4 + 8))
+        coefs[0] = nlayers
+        coefs[1] = scale
+        coefs[2:4] = w[0, 1:3]
+        coefs[4:6] = w[-1, 1:3]
+        coefs[6] = bkg
+        coefs[7] = w[-1, 3]
+        if nlayers:
+            coefs[8::4] = w[1:-1, 0]
+            coefs[9::4] = w[1:-1, 1]
+            coefs[10::4] = w[1:-1, 2]
+            coefs[11::4] = w[1:-1, 3]
+
+        if not flatq.size:
+            return np.empty_like(qvals)
+
+        reflectivity = _get_opencl_state()(flatq, coefs)
+        return np.reshape(reflectivity, qvals.shape)
+
+
+abeles_pyopencl = _Abeles_pyopencl()
+
+
+def abeles(
+    q, layers, scale=1.0, bkg=0, threads=0, chunk_size=None, repeats=None
+):
+    """
+    Abeles matrix formalism for calculating reflectivity from a stratified
+    medium.
+
+    Parameters
+    ----------
+    q: array_like
+        the q values required for the calculation.
+        Q = 4 * Pi / lambda * sin(omega).
+        Units = Angstrom**-1
+    layers: np.ndarray
+        coefficients required for the calculation, has shape (2 + N, 4),
+        where N is the number of layers
+        layers[0, 1] - SLD of fronting (/1e-6 Angstrom**-2)
+        layers[0, 2] - iSLD of fronting (/1e-6 Angstrom**-2)
+        layers[N, 0] - thickness of layer N
+        layers[N, 1] - SLD of layer N (/1e-6 Angstrom**-2)
+        layers[N, 2] - iSLD of layer N (/1e-6 Angstrom**-2)
+        layers[N, 3] - roughness between layer N-1/N
+        layers[-1, 1] - SLD of backing (/1e-6 Angstrom**-2)
+        layers[-1, 2] - iSLD of backing (/1e-6 Angstrom**-2)
+        layers[-1, 3] - roughness between backing and last layer
+    scale: float
+        Multiply all reflectivities by this value.
+    bkg: float
+        Linear background to be added to all reflectivities
+    threads: int, optional
+        How many threads you would like to use in the reflectivity calculation.
+        If `threads == -1` then the calculation is automatically spread over
+        `os.cpu_count()` threads. Q points are split between the threads.
+    chunk_size: int, optional
+        Maximum number of Q points that are calculated at once. The
+        temporary work arrays have size ``chunk_size * (N + 2)``, rather than
+        scaling with the total number of Q points, which bounds memory use
+        for large datasets. By default all Q points are calculated at once.
+    repeats: sequence of (int, int, int), optional
+        Compact description of repeated blocks of layers (e.g. a multilayer
+        or supermirror). Each entry is ``(start, stop, n)``, meaning that
+        the rows ``layers[start:stop]`` are repeated `n` times. The result is
+        the same as for a `layers` array in which each block has been
+        expanded into `n` consecutive copies, but the cost grows with
+        ``log(n)`` rather than with `n`. Blocks may not overlap, or include
+        the fronting or backing media.
+
+    Returns
+    -------
+    Reflectivity: np.ndarray
+        Calculated reflectivity values for each q value.
+    """
+    qvals = np.asfarray(q)
+    flatq = qvals.ravel()
+
+    prof = _profiler
+    if prof is not None:
+        prof.add_call("abeles", flatq.size, len(layers) - 2)
+
+    reflectivity = np.empty_like(flatq)
+
+    def calc(chunk):
+        if repeats:
+            r = _abeles_reflectance_repeats(flatq[chunk], layers, repeats)
+        else:
+            r = _abeles_reflectance(flatq[chunk], layers)
+        reflectivity[chunk] = np.real(r * np.conj(r))
+
+    _map_chunks(calc, flatq.size, chunk_size=chunk_size, threads=threads)
+
+    reflectivity *= scale
+    reflectivity += bkg
+    return np.reshape(reflectivity, qvals.shape)
+
+
+def abeles_batch(q, layers, scale=1.0, bkg=0, threads=0, chunk_size=None):
+    """
+    Abeles matrix formalism for calculating reflectivity from a whole
+    population of stratified media, e.g. all the members of a differential
+    evolution generation, in a single call.
+
+    Parameters
+    ----------
+    q: array_like
+        the q values required for the calculation.
+        Q = 4 * Pi / lambda * sin(omega).
+        Units = Angstrom**-1
+    layers: np.ndarray
+        coefficients required for the calculation, has shape (P, 2 + N, 4),
+        where P is the number of structures and N is the number of layers.
+        Each ``layers[i]`` has the same layout as the `layers` argument of
+        `abeles`.
+    scale: float or array_like
+        Multiply all reflectivities by this value. Can also be an array of
+        shape (P,), one value per structure.
+    bkg: float or array_like
+        Linear background to be added to all reflectivities. Can also be an
+        array of shape (P,), one value per structure.
+    threads: int, optional
+        How many threads you would like to use in the reflectivity calculation.
+        If `threads == -1` then the calculation is automatically spread over
+        `os.cpu_count()` threads. Q points are split between the threads.
+    chunk_size: int, optional
+        Maximum number of Q points that are calculated at once, see `abeles`.
+        The temporary arrays hold every structure of the population for
+        each Q point, so they are `P` times larger than for `abeles`.
+
+    Returns
+    -------
+    Reflectivity: np.ndarray
+        Calculated reflectivity values for each structure and each q value,
+        has shape ``(P,) + q.shape``.
+    """
+    qvals = np.asfarray(q)
+    flatq = qvals.ravel()
+
+    layers = np.asfarray(layers)
+    if layers.ndim != 3 or layers.shape[2] != 4 or layers.shape[1] < 2:
+        raise ValueError("layers must be an array of shape (P, >2, 4)")
+    npop = layers.shape[0]
+
+    reflectivity = np.empty((npop, flatq.size))
+
+    def calc(chunk):
+        r = _abeles_reflectance(flatq[chunk], layers)
+        reflectivity[:, chunk] = np.real(r * np.conj(r))
+
+    _map_chunks(calc, flatq.size, chunk_size=chunk_size, threads=threads)
+
+    reflectivity *= np.reshape(scale, (-1, 1))
+    reflectivity += np.reshape(bkg, (-1, 1))
+    return np.reshape(reflectivity, (npop,) + qvals.shape)
+
+
+def abeles_jacobian(q, layers, scale=1.0, bkg=0.0, threads=0, chunk_size=None):
+    """
+    Reflectivity, and its derivatives with respect to each of the layer
+    parameters, calculated with the Abeles matrix formalism.
+
+    The derivatives are analytic. They are calculated from one forward and
+    one backward sweep over the characteristic matrices, so the cost is a
+    small multiple of a single reflectivity calculation, rather than the
+    ``4 * N + 2`` extra calculations needed for finite differences.
+
+    Parameters
+    ----------
+    q: array_like
+        the q values required for the calculation.
+        Q = 4 * Pi / lambda * sin(omega).
+        Units = Angstrom**-1
+    layers: np.ndarray
+        coefficients required for the calculation, has shape (2 + N, 4),
+        where N is the number of layers. The layout is the same as for
+        `abeles`.
+    scale: float
+        Multiply all reflectivities by this value.
+    bkg: float
+        Linear background to be added to all reflectivities
+    threads: int, optional
+        How many threads you would like to use in the reflectivity calculation.
+        If `threads == -1` then the calculation is automatically spread over
+        `os.cpu_count()` threads. Q points are split between the threads.
+    chunk_size: int, optional
+        Maximum number of Q points that are calculated at once, see `abeles`.
+
+    Returns
+    -------
+    reflectivity, jacobian: np.ndarray
+        `reflectivity` is the same as the output of `abeles`.
+        ``jacobian[i, j]`` is the derivative of the reflectivity with respect
+        to ``layers[i, j]``, it has shape ``layers.shape + q.shape``.
+        Entries that don't affect the reflectivity (the thickness and
+        roughness of the fronting medium, the thickness of the backing
+        medium and the iSLD of the fronting medium) are zero. The derivatives
+        with respect to `scale` and `bkg` are ``(reflectivity - bkg) / scale``
+        and 1.
+    """
+    qvals = np.asfarray(q)
+    flatq = qvals.ravel()
+    layers = np.asfarray(layers)
+
+    prof = _profiler
+    if prof is not None:
+        prof.add_call("abeles_jacobian", flatq.size, len(layers) - 2)
+
+    reflectivity = np.empty_like(flatq)
+    jacobian = np.empty(layers.shape + flatq.shape)
+
+    def calc(chunk):
+        r, jac = _abeles_jacobian(flatq[chunk], layers)
+        reflectivity[chunk] = np.real(r * np.conj(r))
+        # dR/dp = 2 Re(conj(r) dr/dp)
+        jac *= np.conj(r)
+        jacobian[..., chunk] = 2.0 * jac.real
+
+    _map_chunks(calc, flatq.size, chunk_size=chunk_size, threads=threads)
+
+    reflectivity *= scale
+    reflectivity += bkg
+    jacobian *= scale
+    return (
+        np.reshape(reflectivity, qvals.shape),
+        np.reshape(jacobian, layers.shape + qvals.shape),
+    )
+
+
+def abeles_fast(q, layers, scale=1.0, bkg=0, threads=0, chunk_size=None):
+    """
+    Reduced precision (complex64) version of `abeles`, with an estimate of
+    the error of each reflectivity value.
+
+    Single precision halves the memory traffic of the calculation, which is
+    useful when screening a large grid of parameters. The precision that is
+    lost can be significant near the critical edge, where the wavevector is
+    the difference of two nearly equal numbers, and deep in the tail of the
+    reflectivity curve, where the reflected amplitude is the difference of
+    large, nearly equal, matrix elements. The error estimate flags those
+    points, so they can be recalculated in double precision::
+
+        R, err = abeles_fast(q, layers)
+        bad = err > rtol
+        R[bad] = abeles(q[bad], layers)
+
+    where ``rtol`` is the relative accuracy you need. The estimate is
+    typically 10 - 50 times larger than the actual error, so only a few
+    percent of the points of a 20 - 50 layer system are recalculated for
+    ``rtol = 1e-3``.
+
+    Parameters
+    ----------
+    q: array_like
+        the q values required for the calculation.
+        Q = 4 * Pi / lambda * sin(omega).
+        Units = Angstrom**-1
+    layers: np.ndarray
+        coefficients required for the calculation, has shape (2 + N, 4),
+        where N is the number of layers. The layout is the same as for
+        `abeles`.
+    scale: float
+        Multiply all reflectivities by this value.
+    bkg: float
+        Linear background to be added to all reflectivities
+    threads: int, optional
+        How many threads you would like to use in the reflectivity calculation.
+        If `threads == -1` then the calculation is automatically spread over
+        `os.cpu_count()` threads. Q points are split between the threads.
+    chunk_size: int, optional
+        Maximum number of Q points that are calculated at once, see `abeles`.
+
+    Returns
+    -------
+    reflectivity, error: np.ndarray
+        `reflectivity` is the calculated reflectivity for each q value
+        (np.float64, but only accurate to single precision). `error` is an
+        estimate of the relative error of each value. It's propagated to
+        first order alongside the matrix product, with the errors of the
+        individual layers added in quadrature, so it's an estimate rather
+        than a strict bound. It is `np.inf` if the single precision
+        calculation overflowed.
+    """
+    qvals = np.asfarray(q)
+    flatq = qvals.ravel()
+
+    prof = _profiler
+    if prof is not None:
+        prof.add_call("abeles_fast", flatq.size, len(layers) - 2)
+
+    reflectivity = np.empty_like(flatq)
+    error = np.empty_like(flatq)
+
+    def calc(chunk):
+        r, err = _abeles_reflectance_fast(flatq[chunk], layers)
+        reflectivity[chunk] = np.real(r * np.conj(r))
+        error[chunk] = err
+
+    _map_chunks(calc, flatq.size, chunk_size=chunk_size, threads=threads)
+
+    reflectivity *= scale
+    # the background is exact, it dilutes the relative error
+    error *= reflectivity
+    reflectivity += bkg
+    with np.errstate(invalid="ignore", divide="ignore"):
+        error /= np.abs(reflectivity)
+    error[~np.isfinite(reflectivity)] = np.inf
+    error[np.isnan(error)] = np.inf
+    return np.reshape(reflectivity, qvals.shape), np.reshape(
+        error, qvals.shape
+    )
+
+
+def abeles_adaptive(
+    q,
+    layers,
+    scale=1.0,
+    bkg=0,
+    threads=0,
+    rtol=1e-4,
+    points_per_fringe=8,
+    repeats=None,
+):
+    """
+    `abeles` for densely spaced Q points, calculating the reflectivity of
+    only as many of them as are needed to interpolate the rest.
+
+    The kernel is first calculated on a coarse subset of the Q points, with
+    `points_per_fringe` points per Kiessig fringe. The fringe spacing is
+    estimated as ``2 * pi / D``, where D is the total thickness of the film.
+    Each interval between calculated points is then checked by calculating
+    the points a third and two thirds of the way along it and comparing
+    them with a cubic Hermite interpolant of log(R). Intervals where the
+    relative difference is larger than `rtol` are split at those points and
+    checked again, so that the calculated points concentrate at the critical
+    edge and on sharp fringes. Finally the reflectivity of the remaining
+    points is interpolated with the cubic through the ends and the probes of
+    their interval, which is more accurate than the interpolant that was
+    checked.
+
+    Parameters
+    ----------
+    q: array_like
+        the q values required for the calculation.
+        Q = 4 * Pi / lambda * sin(omega).
+        Units = Angstrom**-1
+    layers: np.ndarray
+        coefficients required for the calculation, has shape (2 + N, 4),
+        where N is the number of layers. The layout is the same as for
+        `abeles`.
+    scale: float
+        Multiply all reflectivities by this value.
+    bkg: float
+        Linear background to be added to all reflectivities
+    threads: int, optional
+        How many threads you would like to use in the reflectivity calculation.
+        If `threads == -1` then the calculation is automatically spread over
+        `os.cpu_count()` threads.
+    rtol: float, optional
+        Relative tolerance of the interpolated reflectivity (before `scale`
+        and `bkg` are applied).
+    points_per_fringe: int, optional
+        Number of points per Kiessig fringe in the initial coarse grid.
+    repeats: sequence of (int, int, int), optional
+        Repeated blocks of layers, see `abeles`.
+
+    Returns
+    -------
+    Reflectivity: np.ndarray
+        Calculated reflectivity values for each q value.
+
+    Notes
+    -----
+    The interpolation error is only checked at two points in each interval,
+    so it is an estimate rather than a bound. Structure narrower than the
+    initial grid spacing (e.g. fringes of a layer much thicker than the
+    others, where the thickness estimate is dominated by that layer anyway)
+    can be missed if it doesn't change the probes. The saving is
+    largest for thick films measured with many points per fringe, e.g. time
+    of flight data.
+    """
+    qvals = np.asfarray(q)
+    # the interpolation works on sorted, distinct, Q values
+    x, inverse = np.unique(qvals.ravel(), return_inverse=True)
+    npnts = x.size
+    if not npnts:
+        # nothing to calculate, or to apply scale and bkg to, as for abeles
+        return np.empty_like(qvals)
+
+    def calc(idx):
+        r = abeles(x[idx], layers, threads=threads, repeats=repeats)
+        return np.log(np.maximum(r, TINY))
+
+    thickness = _total_thickness(np.asfarray(layers), repeats)
+
+    # the coarse grid, always including both ends
+    idx = [0, npnts - 1]
+    if thickness > 0 and npnts > 2:
+        spacing = 2 * np.pi / thickness / points_per_fringe
+        grid = np.arange(x[0], x[-1], spacing)
+        idx = np.concatenate((np.searchsorted(x, grid), idx))
+    idx = np.unique(idx)
+
+    logr = np.empty(npnts)
+    known = np.zeros(npnts, bool)
+    logr[idx] = calc(idx)
+    known[idx] = True
+
+    # intervals that still have to be checked
+    lo = idx[:-1]
+    hi = idx[1:]
+    # (lo, third, two_thirds, hi) of the intervals that passed
+    accepted = []
+    while True:
+        wide = hi - lo > 1
+        lo = lo[wide]
+        hi = hi[wide]
+        if not lo.size:
+            break
+
+        # the interpolant the probes are checked against, from the points
+        # calculated so far
+        nodes = np.flatnonzero(known)
+        slopes = np.empty(npnts)
+        slopes[nodes] = _hermite_slopes(x[nodes], logr[nodes])
+        dlo = slopes[lo]
+        dhi = slopes[hi]
+
+        # Two probes per interval, so that an interval doesn't pass because
+        # the interpolation error happens to change sign at a probe. They are
+        # the points nearest to a third and two thirds of the way along the
+        # interval in Q, in case the Q points are unevenly spaced.
+        width = x[hi] - x[lo]
+        third = _nearest(x, x[lo] + width / 3)
+        two_thirds = _nearest(x, x[lo] + 2 * width / 3)
+        # the probes are distinct unless the interval only has one point
+        # inside, so every point inside an interval that passes is either
+        # calculated or between four calculated points.
+        third = np.clip(third, lo + 1, np.maximum(hi - 2, lo + 1))
+        two_thirds = np.clip(two_thirds, third + 1, hi - 1)
+
+        probes = np.unique(np.concatenate((third, two_thirds)))
+        logr[probes] = calc(probes)
+        known[probes] = True
+
+        failed = np.zeros(lo.size, bool)
+        for probe in (third, two_thirds):
+            estimate = _hermite(x, logr, lo, hi, dlo, dhi, x[probe])
+            failed |= np.abs(np.expm1(estimate - logr[probe])) > rtol
+
+        passed = ~failed
+        accepted.append(tuple(v[passed] for v in (lo, third, two_thirds, hi)))
+        lo, third, two_thirds, hi = (
+            v[failed] for v in (lo, third, two_thirds, hi)
+        )
+        lo, hi = (
+            np.concatenate((lo, third, two_thirds)),
+            np.concatenate((third, two_thirds, hi)),
+        )
+
+    unknown = np.flatnonzero(~known)
+    if unknown.size:
+        # every point that hasn't been calculated is inside exactly one of
+        # the intervals that passed.
+        lo, third, two_thirds, hi = (np.concatenate(v) for v in zip(*accepted))
+        order = np.argsort(lo)
+        j = order[np.searchsorted(lo, unknown, sorter=order) - 1]
+        lo, third, two_thirds, hi = (v[j] for v in (lo, third, two_thirds, hi))
+
+        # the cubic through the ends and the probes of the interval
+        nodes = np.stack((lo, third, two_thirds, hi))
+        logr[unknown] = _lagrange(x[nodes], logr[nodes], x[unknown])
+
+    reflectivity = np.exp(logr)[inverse]
+    reflectivity *= scale
+    reflectivity += bkg
+    return np.reshape(reflectivity, qvals.shape)
+
+
+def abeles_smeared(
+    q,
+    layers,
+    dq,
+    scale=1.0,
+    bkg=0,
+    threads=0,
+    rtol=1e-4,
+    max_depth=10,
+    repeats=None,
+    method="auto",
+):
+    """
+    `abeles` smeared by a Gaussian resolution kernel, integrated by adaptive
+    Gauss-Kronrod quadrature, or by FFT convolution if the resolution is a
+    constant fraction of Q.
+
+    Instead of a fixed number of quadrature points per datapoint, each
+    datapoint starts with a single 5 point Kronrod rule over ``Q +/- 3.5
+    sigma`` (split at any critical edges inside it, where R has a kink, and
+    into one interval per Kiessig fringe if the window covers several, with
+    the fringe spacing estimated from the total film thickness). The
+    difference from the embedded 2 point Gauss rule estimates the error of
+    each interval. While the errors of a datapoint's intervals add up to
+    more than ``rtol * R``, the intervals with more than their share of the
+    error are halved and integrated again. Where the reflectivity barely
+    changes within the resolution only 5 points are calculated, and only
+    datapoints near sharp features (critical edge, narrow fringes) pay for
+    more. The kernel points of all the datapoints are calculated together,
+    one `abeles` call per level of refinement.
+
+    If dQ/Q is the same for every point (as for most reflectometers), the
+    smearing is a convolution with a fixed kernel in log(Q). `abeles` is then
+    calculated once, on a log spaced grid covering the whole Q range, which
+    is convolved with the exact log(Q) form of the Gaussian by FFT and
+    interpolated back onto `q`. Only the datapoints within the resolution of
+    a critical edge, where R has a kink that an even grid doesn't resolve,
+    are integrated adaptively.
+
+    Parameters
+    ----------
+    q: array_like
+        the q values required for the calculation.
+        Q = 4 * Pi / lambda * sin(omega).
+        Units = Angstrom**-1
+    layers: np.ndarray
+        coefficients required for the calculation, has shape (2 + N, 4),
+        where N is the number of layers. The layout is the same as for
+        `abeles`.
+    dq: array_like
+        Full width at half maximum of the Gaussian resolution kernel of each
+        q value (as for refnx's `ReflectModel`), must be broadcastable to the
+        shape of `q`. Points with ``dq == 0`` aren't smeared.
+    scale: float
+        Multiply all reflectivities by this value.
+    bkg: float
+        Linear background to be added to all reflectivities
+    threads: int, optional
+        How many threads you would like to use in the reflectivity calculation.
+        If `threads == -1` then the calculation is automatically spread over
+        `os.cpu_count()` threads.
+    rtol: float, optional
+        Requested relative accuracy of each smeared reflectivity.
+    max_depth: int, optional
+        Maximum number of times an interval is halved. Intervals that reach
+        it are accepted whatever their error estimate.
+    repeats: sequence of (int, int, int), optional
+        Repeated blocks of layers, see `abeles`.
+    method: {'auto', 'adaptive', 'fft'}, optional
+        'adaptive' always uses adaptive quadrature, 'fft' always uses FFT
+        convolution (and raises ValueError if dQ/Q isn't constant), and
+        'auto' uses FFT convolution if dQ/Q is constant to within 0.1%.
+
+    Returns
+    -------
+    Reflectivity: np.ndarray
+        Smeared reflectivity values for each q value.
+
+    Notes
+    -----
+    FFT convolution samples each Kiessig fringe and each resolution width
+    with at least ``8 * sqrt(2e-4 / rtol)`` (and at least 8) points, which
+    keeps its error below `rtol`, e.g. 12 points for the default `rtol`.
+    The grid grows as ``1 / sqrt(rtol)``, so for very small `rtol` and
+    fine resolution 'adaptive' may be quicker. `max_depth` only applies to
+    adaptive quadrature.
+
+    The integral is normalised by the area of the Gaussian inside the +/-
+    3.5 sigma window, integrated with the same rules, so that a constant
+    reflectivity is unchanged by the smearing. As with any adaptive
+    quadrature, a feature that is much narrower than a Kiessig fringe of the
+    whole film (e.g. a narrow Bragg peak) can be missed if it falls between
+    the points of a rule that otherwise agrees with its Gauss rule.
+    """
+    qvals = np.asfarray(q)
+    flatq = qvals.ravel()
+    dq = np.broadcast_to(np.asfarray(dq), qvals.shape).ravel()
+    sigma = dq / (2 * np.sqrt(2 * np.log(2)))
+
+    prof = _profiler
+    if prof is not None:
+        prof.add_call("abeles_smeared", flatq.size, len(layers) - 2)
+
+    if method not in ("auto", "adaptive", "fft"):
+        raise ValueError("method must be 'auto', 'adaptive' or 'fft'")
+    resolution = None
+    if method != "adaptive":
+        resolution = _constant_resolution(flatq, sigma)
+        if resolution is None and method == "fft":
+            raise ValueError(
+                "FFT smearing needs a constant dq / q, smaller than"
+                f" {1 / _GK_WINDOW:.3f} sigma"
+            )
+    if resolution is not None:
+        # The error of the FFT convolution falls with the square of the grid
+        # spacing, ~1e-4 with 8 points per sigma and per fringe.
+        density = max(8, int(np.ceil(8 * np.sqrt(2e-4 / rtol))))
+        smeared = _smear_fft(
+            flatq,
+            layers,
+            resolution,
+            threads,
+            repeats,
+            points_per_sigma=density,
+            points_per_fringe=density,
+        )
+
+        # R has a kink at each critical edge, which the evenly spaced grid
+        # doesn't resolve well. The few datapoints whose window contains one
+        # are integrated adaptively.
+        qc = _critical_edges(layers)
+        near = np.any(
+            np.abs(flatq[:, np.newaxis] - qc)
+            < _GK_WINDOW * sigma[:, np.newaxis],
+            axis=1,
+        )
+        if np.any(near):
+            smeared[near] = abeles_smeared(
+                flatq[near],
+                layers,
+                dq[near],
+                threads=threads,
+                rtol=rtol,
+                max_depth=max_depth,
+                repeats=repeats,
+                method="adaptive",
+            )
+        smeared *= scale
+        smeared += bkg
+        return np.reshape(smeared, qvals.shape)
+
+    smeared = np.zeros_like(flatq)
+    pointwise = sigma <= 0
+    if np.any(pointwise):
+        smeared[pointwise] = abeles(
+            flatq[pointwise], layers, threads=threads, repeats=repeats
+        )
+
+    # The first intervals of each datapoint are no wider than a Kiessig
+    # fringe, otherwise the rules can't resolve the fringes, and their
+    # errors can't be estimated. R also has a kink at each critical edge,
+    # which the rules would only converge to slowly, so critical edges inside
+    # a datapoint's window also start a new interval. The intervals are in
+    # standard deviations from the datapoint.
+    layers = np.asfarray(layers)
+    thickness = _total_thickness(layers, repeats)
+    qc = _critical_edges(layers)
+
+    point = np.flatnonzero(~pointwise)
+    width = 2 * _GK_WINDOW * sigma[point]
+    nfringes = np.ceil(width * thickness / (2 * np.pi)).astype(int)
+    nfringes = np.maximum(nfringes, 1)
+    fringes = np.arange(np.max(nfringes, initial=1) + 1)
+    fringes = np.minimum(fringes / nfringes[:, np.newaxis], 1)
+    edges = (qc - flatq[point, np.newaxis]) / sigma[point, np.newaxis]
+    edges = np.concatenate(
+        (
+            (2 * fringes - 1) * _GK_WINDOW,
+            np.clip(edges, -_GK_WINDOW, _GK_WINDOW),
+        ),
+        axis=1,
+    )
+    edges.sort(axis=1)
+    start = edges[:, :-1]
+    end = edges[:, 1:]
+    nonempty = end > start
+    point = np.broadcast_to(point[:, np.newaxis], start.shape)[nonempty]
+    start = start[nonempty]
+    end = end[nonempty]
+
+    # intervals of the datapoints that haven't converged
+    depth = np.zeros(point.size, int)
+    integral = np.zeros(point.size)
+    area = np.zeros(point.size)
+    error = np.zeros(point.size)
+    area_error = np.zeros(point.size)
+    new = np.ones(point.size, bool)
+
+    # integrals of R * Gaussian and of the Gaussian over the intervals that
+    # have finished
+    done = np.zeros_like(flatq)
+    done_area = np.zeros_like(flatq)
+    while point.size:
+        # integrate the new intervals, all datapoints in one kernel call
+        centre = 0.5 * (start[new] + end[new])
+        half = 0.5 * (end[new] - start[new])
+        z = centre[:, np.newaxis] + half[:, np.newaxis] * _GK_NODES
+        x = flatq[point[new], np.newaxis] + sigma[point[new], np.newaxis] * z
+        if prof is not None:
+            start_level = time.perf_counter()
+        r = abeles(x, layers, threads=threads, repeats=repeats)
+        if prof is not None:
+            reflectance = time.perf_counter()
+            prof.add_stage(
+                "abeles_smeared.reflectance", reflectance - start_level
+            )
+        g = np.exp(-0.5 * z * z)
+        kronrod = np.sum(r * g * _GK_KRONROD, axis=-1)
+        gauss = np.sum(r * g * _GK_GAUSS, axis=-1)
+        area[new] = half * np.sum(g * _GK_KRONROD, axis=-1)
+        area_gauss = half * np.sum(g * _GK_GAUSS, axis=-1)
+        integral[new] = half * kronrod
+        # The 2 point rule is poor at integrating the Gaussian itself, so it
+        # is rescaled to agree with the Kronrod rule for a constant R, and
+        # the error of the Gaussian's integral is accounted for separately.
+        gauss *= area[new] / area_gauss
+        error[new] = np.abs(integral[new] - gauss * half)
+        area_error[new] = np.abs(area[new] - area_gauss)
+
+        # The error of the Gaussian's integral over an interval only matters
+        # in as much as R in the interval differs from the smeared R.
+        total = np.bincount(point, integral, minlength=flatq.size)
+        total_area = np.bincount(point, area, minlength=flatq.size)
+        smeared_r = total[point] / total_area[point]
+        estimate = error + area_error * np.abs(integral / area - smeared_r)
+
+        # A datapoint has converged when the errors of its intervals add up
+        # to less than rtol * R. Otherwise the intervals with more than
+        # their share of the allowed error are halved.
+        allowed = rtol * np.abs(total)
+        total_error = np.bincount(point, estimate, minlength=flatq.size)
+        nintervals = np.bincount(point, minlength=flatq.size)
+        split = (total_error[point] > allowed[point]) & (
+            estimate > allowed[point] / nintervals[point]
+        )
+        split &= depth < max_depth
+
+        # datapoints with nothing left to split are finished
+        active = np.bincount(point, split, minlength=flatq.size) > 0
+        finished = ~active[point]
+        done += np.bincount(
+            point[finished], integral[finished], minlength=flatq.size
+        )
+        done_area += np.bincount(
+            point[finished], area[finished], minlength=flatq.size
+        )
+
+        keep = ~finished & ~split
+        centre = 0.5 * (start[split] + end[split])
+        point, start, end, depth, integral, area, error, area_error = (
+            np.concatenate((v[keep], v[split], v[split]))
+            for v in (
+                point,
+                start,
+                end,
+                depth,
+                integral,
+                area,
+                error,
+                area_error,
+            )
+        )
+        nkeep = np.count_nonzero(keep)
+        nsplit = centre.size
+        start[nkeep + nsplit :] = centre
+        end[nkeep : nkeep + nsplit] = centre
+        depth[nkeep:] += 1
+        new = np.arange(point.size) >= nkeep
+        if prof is not None:
+            prof.add_stage(
+                "abeles_smeared.quadrature", time.perf_counter() - reflectance
+            )
+
+    smeared[~pointwise] = done[~pointwise] / done_area[~pointwise]
+    smeared *= scale
+    smeared += bkg
+    return np.reshape(smeared, qvals.shape)
+
+
+def _total_thickness(layers, repeats=None):
+    # thickness of the film, with repeated blocks expanded. The spacing of
+    # its Kiessig fringes is 2 * pi / thickness.
+    thickness = np.sum(layers[1:-1, 0])
+    for start, stop, n in repeats or []:
+        thickness += (n - 1) * np.sum(layers[start:stop, 0])
+    return thickness
+
+
+def _critical_edges(layers):
+    # the Q at which each layer (and the backing medium) is totally
+    # reflecting, for those with a higher SLD than the fronting medium
+    layers = np.asfarray(layers)
+    contrast = layers[1:, 1] - layers[0, 1]
+    return np.unique(np.sqrt(16 * np.pi * contrast[contrast > 0] * 1e-6))
+
+
+def _constant_resolution(q, sigma, rtol=1e-3):
+    """
+    sigma / q if it's the same (within `rtol`) for all the points, all of
+    which have Q > 0, and small enough that the resolution window doesn't
+    reach Q = 0. Otherwise None.
+    """
+    if not q.size or np.any(q <= 0) or np.any(sigma <= 0):
+        return None
+    ratio = sigma / q
+    resolution = np.mean(ratio)
+    if np.ptp(ratio) > rtol * resolution or _GK_WINDOW * resolution >= 1:
+        return None
+    return resolution
+
+
+def _smear_fft(
+    flatq,
+    layers,
+    resolution,
+    threads=0,
+    repeats=None,
+    points_per_sigma=8,
+    points_per_fringe=8,
+):
+    """
+    Reflectivity smeared by a Gaussian resolution kernel with a constant
+    ``sigma / Q == resolution``, by FFT convolution on a log(Q) grid.
+
+    With ``Q' = Q * exp(t)`` the smeared reflectivity is
+
+        R_s(Q) = int R(Q * exp(t)) k(t) dt,
+        k(t) = exp(t) * exp(-(exp(t) - 1)**2 / (2 * resolution**2)),
+
+    and the kernel doesn't depend on Q, so on a grid evenly spaced in log(Q)
+    the smearing is a discrete convolution. The kernel is truncated at +/-
+    3.5 sigma and normalised to sum to 1.
+    """
+    prof = _profiler
+    if prof is not None:
+        start = time.perf_counter()
+
+    layers = np.asfarray(layers)
+    logq = np.log(flatq)
+    lo, hi = np.min(logq), np.max(logq)
+
+    # the kernel is ~resolution wide in log(Q), and the Kiessig fringes are
+    # 2 * pi / (thickness * Q) apart, closest at the largest Q.
+    step = resolution / points_per_sigma
+    thickness = _total_thickness(layers, repeats)
+    if thickness > 0:
+        qmax = np.exp(hi) * (1 + _GK_WINDOW * resolution)
+        step = min(step, 2 * np.pi / (thickness * qmax) / points_per_fringe)
+
+    # Each grid point stands for the cell of width `step` around it. The
+    # cells at the ends of the kernel only count for the fraction that's
+    # inside the window, so the kernel is truncated at exactly 3.5 sigma
+    # whatever the step.
+    tlo = np.log1p(-_GK_WINDOW * resolution)
+    thi = np.log1p(_GK_WINDOW * resolution)
+    kmin = int(np.round(tlo / step))
+    kmax = int(np.round(thi / step))
+    t = np.arange(kmin, kmax + 1) * step
+    kernel = np.exp(t - 0.5 * np.expm1(t) ** 2 / resolution**2)
+    kernel[0] *= np.clip((t[0] + 0.5 * step - tlo) / step, 0, 1)
+    kernel[-1] *= np.clip((thi - t[-1] + 0.5 * step) / step, 0, 1)
+    kernel /= np.sum(kernel)
+
+    # the grid, with the kernel's reach (and a point for interpolation)
+    # beyond each end of the Q range
+    first = -kmin + 1
+    npnts = first + int(np.ceil((hi - lo) / step)) + kmax + 2
+    u = lo + (np.arange(npnts) - first) * step
+    if prof is not None:
+        grid = time.perf_counter()
+    r = abeles(np.exp(u), layers, threads=threads, repeats=repeats)
+    if prof is not None:
+        reflectance = time.perf_counter()
+        prof.add_stage("abeles_smeared.reflectance", reflectance - grid)
+
+    # smeared[i] = sum_k r[i + k] * kernel[k - kmin], a correlation, done as
+    # a convolution with the reversed kernel
+    size = npnts + kernel.size - 1
+    full = np.fft.irfft(
+        np.fft.rfft(r, size) * np.fft.rfft(kernel[::-1], size), size
+    )
+    valid = np.arange(-kmin, npnts - kmax)
+    smeared = full[valid + kernel.size - 1 + kmin]
+
+    # back onto the requested points, interpolating log(R) as for
+    # abeles_adaptive
+    xn = u[valid]
+    yn = np.log(np.maximum(smeared, TINY))
+    slopes = _hermite_slopes(xn, yn)
+    i = np.clip(np.searchsorted(xn, logq, side="right") - 1, 0, xn.size - 2)
+    smeared = np.exp(
+        _hermite(xn, yn, i, i + 1, slopes[i], slopes[i + 1], logq)
+    )
+
+    if prof is not None:
+        # setting up the grid and kernel, convolution and interpolation
+        prof.add_stage(
+            "abeles_smeared.fft",
+            grid - start + time.perf_counter() - reflectance,
+        )
+    return smeared
+
+
+def _hermite_slopes(xn, yn):
+    """
+    Slopes for a cubic Hermite interpolant of (xn, yn).
+
+    The slope at each node is that of the parabola through it and its
+    neighbours, so the interpolant is exact for quadratics and has a
+    continuous first derivative. `xn` must be sorted and distinct.
+    """
+    if xn.size < 2:
+        return np.zeros_like(yn)
+
+    h = np.diff(xn)
+    s = np.diff(yn) / h
+    if xn.size == 2:
+        return np.full_like(yn, s[0])
+
+    d = np.empty_like(yn)
+    d[1:-1] = (h[:-1] * s[1:] + h[1:] * s[:-1]) / (h[:-1] + h[1:])
+    d[0] = ((2 * h[0] + h[1]) * s[0] - h[0] * s[1]) / (h[0] + h[1])
+    d[-1] = ((2 * h[-1] + h[-2]) * s[-1] - h[-1] * s[-2]) / (h[-1] + h[-2])
+    return d
+
+
+def _nearest(x, values):
+    # indices of the points of the sorted array x nearest to values
+    i = np.clip(np.searchsorted(x, values), 1, x.size - 1)
+    return i - (values - x[i - 1] < x[i] - values)
+
+
+def _lagrange(xn, yn, x):
+    """
+    Interpolation at `x` with the polynomial through the nodes ``xn[:, i]``
+    and values ``yn[:, i]``, for each column i.
+    """
+    y = np.zeros_like(x)
+    for k in range(xn.shape[0]):
+        basis = yn[k].copy()
+        for m in range(xn.shape[0]):
+            if m != k:
+                basis *= (x - xn[m]) / (xn[k] - xn[m])
+        y += basis
+    return y
+
+
+def _hermite(xn, yn, lo, hi, dlo, dhi, x):
+    """
+    Cubic Hermite interpolation at `x`, between the nodes ``xn[lo]`` and
+    ``xn[hi]``, with values `yn` and slopes `dlo` and `dhi` at those nodes.
+    """
+    h = xn[hi] - xn[lo]
+    t = (x - xn[lo]) / h
+    t2 = t * t
+    t3 = t2 * t
+    return (
+        (2 * t3 - 3 * t2 + 1) * yn[lo]
+        + (t3 - 2 * t2 + t) * h * dlo
+        + (-2 * t3 + 3 * t2) * yn[hi]
+        + (t3 - t2) * h * dhi
+    )
+
+
+def _chunks(npnts, chunk_size=None):
+    """
+    Slices that split ``range(npnts)`` into pieces no longer than
+    `chunk_size`. If `chunk_size` is None a single slice is produced.
+    """
+    if chunk_size is None or chunk_size >= npnts:
+        return [slice(0, npnts)]
+
+    chunk_size = int(chunk_size)
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be a positive integer")
+    return [
+        slice(i, min(i + chunk_size, npnts))
+        for i in range(0, npnts, chunk_size)
+    ]
+
+
+def _map_chunks(func, npnts, chunk_size=None, threads=0):
+    """
+    Calls ``func(chunk)`` for slices that cover ``range(npnts)``, spreading
+    the calls over a thread pool if more than one thread is requested.
+
+    Parameters
+    ----------
+    func: callable
+        Called with a slice of the Q points. It should store its own
+        results.
+    npnts: int
+        Total number of Q points.
+    chunk_size: int, optional
+        Maximum number of Q points given to each call of `func`.
+    threads: int, optional
+        Number of threads. If `threads == -1` then `os.cpu_count()` threads
+        are used. 0 or 1 means the calculation is done serially.
+    """
+    if threads == -1:
+        threads = os.cpu_count() or 1
+
+    if threads > 1:
+        per_thread = max(-(-npnts // threads), _MIN_POINTS_PER_THREAD)
+        if chunk_size is None or chunk_size > per_thread:
+            chunk_size = per_thread
+
+    chunks = _chunks(npnts, chunk_size)
+    if threads > 1 and len(chunks) > 1:
+        # consume the iterator so that exceptions are raised here
+        list(_get_thread_pool().map(func, chunks))
+    else:
+        for chunk in chunks:
+            func(chunk)
+
+
+# number, and total memory (bytes), of the wavevectors and interface terms
+# remembered by _interface_terms
+_INTERFACE_CACHE_SIZE = 64
+_INTERFACE_CACHE_BYTES = 64 * 2**20
+# calculations with fewer wavevectors (Q points * layers) than this aren't
+# cached. For them hashing the key costs as much as a cache hit saves.
+_INTERFACE_CACHE_MIN_SIZE = 2**14
+_interface_cache = OrderedDict()
+_interface_cache_nbytes = 0
+_interface_cache_lock = threading.Lock()
+
+
+def _interface_terms(flatq, layers):
+    """
+    Wavevector in each layer, and the reflectance of each interface
+    (including the Nevot-Croce roughness factor), for each Q point.
+
+    Only the thicknesses of the layers change in thickness scans, and in
+    many fit proposals, but they don't enter these terms. The most recently
+    calculated terms are kept in a least recently used cache, keyed on the
+    Q values and on the SLD, iSLD and roughness columns of `layers`, so that
+    the complex square roots and exponentials aren't recalculated. The
+    cached arrays are read-only. Small calculations, with fewer than
+    `_INTERFACE_CACHE_MIN_SIZE` wavevectors, bypass the cache.
+
+    Parameters
+    ----------
+    flatq: np.ndarray
+        1D array of Q values (Angstrom**-1).
+    layers: np.ndarray
+        Has shape (..., 2 + N, 4), laid out as for `abeles`.
+
+    Returns
+    -------
+    kn, rj: np.ndarray
+        Have shapes (..., npnts, N + 2) and (..., npnts, N + 1).
+    """
+    layers = np.asarray(layers, dtype=np.float64)
+    flatq = np.ascontiguousarray(flatq, dtype=np.float64)
+    if flatq.size * layers[..., 0].size < _INTERFACE_CACHE_MIN_SIZE:
+        return _calc_interface_terms(flatq, layers)
+
+    key = (
+        flatq.size,
+        hashlib.blake2b(flatq.tobytes(), digest_size=16).digest(),
+        layers.shape,
+        hashlib.blake2b(
+            np.ascontiguousarray(layers[..., 1:]).tobytes(), digest_size=16
+        ).digest(),
+    )
+
+    with _interface_cache_lock:
+        terms = _interface_cache.get(key)
+        if terms is not None:
+            _interface_cache.move_to_end(key)
+            return terms
+
+    kn, rj = _calc_interface_terms(flatq, layers)
+    kn.flags.writeable = False
+    rj.flags.writeable = False
+    terms = kn, rj
+    nbytes = kn.nbytes + rj.nbytes
+    if nbytes > _INTERFACE_CACHE_BYTES:
+        return terms
+
+    global _interface_cache_nbytes
+    with _interface_cache_lock:
+        if key not in _interface_cache:
+            _interface_cache[key] = terms
+            _interface_cache_nbytes += nbytes
+        while (
+            len(_interface_cache) > _INTERFACE_CACHE_SIZE
+            or _interface_cache_nbytes > _INTERFACE_CACHE_BYTES
+        ):
+            old_kn, old_rj = _interface_cache.popitem(last=False)[1]
+            _interface_cache_nbytes -= old_kn.nbytes + old_rj.nbytes
+
+    return terms
+
+
+def _clear_interface_cache():
+    """
+    Forget all the terms cached by `_interface_terms`, e.g. so that
+    benchmarks time the calculation rather than the cache.
+    """
+    global _interface_cache_nbytes
+    with _interface_cache_lock:
+        _interface_cache.clear()
+        _interface_cache_nbytes = 0
+
+
+def _calc_interface_terms(flatq, layers):
+    """
+    Uncached calculation of the wavevectors and interface reflectances, see
+    `_interface_terms`.
+    """
+    sld = np.zeros(layers.shape[:-1], np.complex128)
+
+    # addition of TINY is to ensure the correct branch cut
+    # in the complex sqrt calculation of kn.
+    sld[..., 1:] += (
+        (layers[..., 1:, 1] - layers[..., 0:1, 1])
+        + 1j * (np.abs(layers[..., 1:, 2]) + TINY)
+    ) * 1.0e-6
+
+    # kn has shape (..., npnts, nlayers + 2). Rows are Q points, columns are
+    # kn in a layer.
+    # calculate wavevector in each layer, for each Q point.
+    kn = np.sqrt(
+        flatq[:, np.newaxis] ** 2.0 / 4.0
+        - 4.0 * np.pi * sld[..., np.newaxis, :]
+    )
+
+    # reflectances for each layer
+    # rj.shape = (..., npnts, nlayers + 1)
+    rj = kn[..., :-1] - kn[..., 1:]
+    rj /= kn[..., :-1] + kn[..., 1:]
+    rj *= np.exp(
+        -2.0 * kn[..., :-1] * kn[..., 1:] * layers[..., np.newaxis, 1:, 3] ** 2
+    )
+    return kn, rj
+
+
+def _abeles_reflectance(flatq, layers):
+    """
+    Complex reflectance calculated with the Abeles matrix formalism.
+
+    Parameters
+    ----------
+    flatq: np.ndarray
+        1D array of Q values (Angstrom**-1).
+    layers: np.ndarray
+        Has shape (..., 2 + N, 4). Any leading dimensions are treated as a
+        batch of structures, each of which is laid out as for `abeles`.
+
+    Returns
+    -------
+    r: np.ndarray
+        Complex reflectance, has shape ``layers.shape[:-2] + flatq.shape``.
+    """
+    prof = _profiler
+    if prof is not None:
+        start = time.perf_counter()
+
+    nlayers = layers.shape[-2] - 2
+
+    # kn.shape = (..., npnts, nlayers + 2), rj.shape = (..., npnts,
+    # nlayers + 1). Neither depends on the layer thicknesses.
+    kn, rj = _interface_terms(flatq, layers)
+
+    if prof is not None:
+        wavevectors = time.perf_counter()
+        prof.add_stage("abeles.wavevectors", wavevectors - start)
+
+    # characteristic matrices for each layer
+    # miNN.shape = (..., npnts, nlayers + 1)
+    mi00 = np.ones(rj.shape, np.complex128)
+    if nlayers:
+        mi00[..., 1:] = np.exp(
+            kn[..., 1:-1] * 1j * np.fabs(layers[..., np.newaxis, 1:-1, 0])
+        )
+    mi11 = 1.0 / mi00
+    mi10 = rj * mi00
+    mi01 = rj * mi11
+
+    # initialise matrix total
+    mrtot00 = mi00[..., 0]
+    mrtot01 = mi01[..., 0]
+    mrtot10 = mi10[..., 0]
+    mrtot11 = mi11[..., 0]
+
+    # propagate characteristic matrices
+    for idx in range(1, nlayers + 1):
+        # matrix multiply mrtot by characteristic matrix
+        p0 = mrtot00 * mi00[..., idx] + mrtot10 * mi01[..., idx]
+        p1 = mrtot00 * mi10[..., idx] + mrtot10 * mi11[..., idx]
+        mrtot00 = p0
+        mrtot10 = p1
+
+        p0 = mrtot01 * mi00[..., idx] + mrtot11 * mi01[..., idx]
+        p1 = mrtot01 * mi10[..., idx] + mrtot11 * mi11[..., idx]
+
+        mrtot01 = p0
+        mrtot11 = p1
+
+    r = mrtot01 / mrtot00
+    if prof is not None:
+        prof.add_stage("abeles.propagation", time.perf_counter() - wavevectors)
+    return r
+
+
+def _abeles_jacobian(flatq, layers):
+    """
+    Complex reflectance, and its derivatives with respect to the layer
+    parameters.
+
+    Parameters
+    ----------
+    flatq: np.ndarray
+        1D array of Q values (Angstrom**-1).
+    layers: np.ndarray
+        Has shape (2 + N, 4), laid out as for `abeles`.
+
+    Returns
+    -------
+    r, jacobian: np.ndarray
+        `r` is the complex reflectance, shape ``flatq.shape``.
+        ``jacobian[i, j]`` is the (complex) derivative of `r` with respect to
+        ``layers[i, j]``, it has shape ``layers.shape + flatq.shape``.
+
+    Notes
+    -----
+    The total matrix is ``T = M_0 M_1 ... M_N`` and ``r = T_10 / T_00``. The
+    derivative of ``r`` with respect to a parameter of ``M_j`` is
+    ``u_j (dM_j) s_j``, where the row vector ``u_j = w M_0 ... M_j-1``,
+    with ``w = (-T_10, T_00) / T_00**2``, and the column vector
+    ``s_j = M_j+1 ... M_N (1, 0)``. The ``s_j`` are accumulated in a
+    backward sweep and the ``u_j`` in a forward sweep.
+    """
+    prof = _profiler
+    if prof is not None:
+        start = time.perf_counter()
+
+    nrows = layers.shape[0]
+    nlayers = nrows - 2
+    npnts = flatq.size
+    thick = layers[1:-1, 0]
+    sigma = layers[1:, 3]
+
+    sld = np.zeros(nrows, np.complex128)
+    # addition of TINY is to ensure the correct branch cut
+    # in the complex sqrt calculation of kn.
+    sld[1:] += (
+        (layers[1:, 1] - layers[0, 1]) + 1j * (np.abs(layers[1:, 2]) + TINY)
+    ) * 1.0e-6
+
+    # kn.shape = (nrows, npnts)
+    kn = np.sqrt(flatq**2 / 4.0 - 4.0 * np.pi * sld[:, np.newaxis])
+    ka = kn[:-1]
+    kb = kn[1:]
+
+    # reflectances of each interface, rj.shape = (nlayers + 1, npnts)
+    ksum = ka + kb
+    rough = np.exp(-2.0 * ka * kb * sigma[:, np.newaxis] ** 2)
+    rj = (ka - kb) / ksum * rough
+
+    # beta[j] = exp(i k_j d_j), with beta[0] = 1
+    beta = np.ones_like(rj)
+    beta[1:] = np.exp(1j * kn[1:-1] * np.fabs(thick)[:, np.newaxis])
+
+    if prof is not None:
+        wavevectors = time.perf_counter()
+        prof.add_stage("abeles_jacobian.wavevectors", wavevectors - start)
+
+    # backward sweep, s[j] = M_j+1 ... M_N (1, 0)
+    s = np.empty((nlayers + 1, 2, npnts), np.complex128)
+    s[-1, 0] = 1.0
+    s[-1, 1] = 0.0
+    for j in range(nlayers, 0, -1):
+        s[j - 1, 0] = beta[j] * (s[j, 0] + rj[j] * s[j, 1])
+        s[j - 1, 1] = (rj[j] * s[j, 0] + s[j, 1]) / beta[j]
+
+    # first column of the total matrix
+    t00 = s[0, 0] + rj[0] * s[0, 1]
+    t10 = rj[0] * s[0, 0] + s[0, 1]
+    r = t10 / t00
+
+    # forward sweep, u[j] = w M_0 ... M_j-1
+    u = np.empty_like(s)
+    u[0, 0] = -r / t00
+    u[0, 1] = 1.0 / t00
+    for j in range(nlayers):
+        u[j + 1, 0] = beta[j] * u[j, 0] + rj[j] / beta[j] * u[j, 1]
+        u[j + 1, 1] = rj[j] * beta[j] * u[j, 0] + u[j, 1] / beta[j]
+
+    # derivative of r with respect to each rj and beta
+    dr_rj = u[:, 0] * beta * s[:, 1] + u[:, 1] * s[:, 0] / beta
+    dr_beta = (
+        u[1:, 0] * (s[1:, 0] + rj[1:] * s[1:, 1])
+        - u[1:, 1] * (rj[1:] * s[1:, 0] + s[1:, 1]) / beta[1:] ** 2
+    )
+
+    # rj depends on the wavevectors either side of an interface, ka and kb.
+    drj_dka = 2.0 * kb / ksum**2 * rough
+    drj_dka -= 2.0 * kb * sigma[:, np.newaxis] ** 2 * rj
+    drj_dkb = -2.0 * ka / ksum**2 * rough
+    drj_dkb -= 2.0 * ka * sigma[:, np.newaxis] ** 2 * rj
+
+    # derivative of r with respect to the wavevector in each layer
+    dr_dk = np.zeros_like(kn)
+    dr_dk[:-1] += dr_rj * drj_dka
+    dr_dk[1:] += dr_rj * drj_dkb
+    dr_dk[1:-1] += dr_beta * 1j * np.fabs(thick)[:, np.newaxis] * beta[1:]
+
+    jacobian = np.zeros(layers.shape + (npnts,), np.complex128)
+
+    # thickness
+    jacobian[1:-1, 0] = dr_beta * 1j * kn[1:-1] * beta[1:]
+    jacobian[1:-1, 0] *= np.where(thick < 0, -1.0, 1.0)[:, np.newaxis]
+
+    # SLD, dk/dSLD = -2 pi 1e-6 / k. The fronting SLD is subtracted from all
+    # the others.
+    dk_dsld = -2.0e-6 * np.pi / kn[1:]
+    jacobian[1:, 1] = dr_dk[1:] * dk_dsld
+    jacobian[0, 1] = -np.sum(jacobian[1:, 1], axis=0)
+
+    # iSLD, the absolute value of iSLD is used
+    jacobian[1:, 2] = dr_dk[1:] * 1j * dk_dsld
+    jacobian[1:, 2] *= np.where(layers[1:, 2] < 0, -1.0, 1.0)[:, np.newaxis]
+
+    # roughness
+    jacobian[1:, 3] = dr_rj * -4.0 * ka * kb * sigma[:, np.newaxis] * rj
+
+    if prof is not None:
+        prof.add_stage(
+            "abeles_jacobian.propagation", time.perf_counter() - wavevectors
+        )
+    return r, jacobian
+
+
+def _abeles_reflectance_fast(flatq, layers):
+    """
+    Complex reflectance calculated in single precision with the Abeles matrix
+    formalism, along with an estimate of the error in the reflectivity.
+
+    Parameters
+    ----------
+    flatq: np.ndarray
+        1D array of Q values (Angstrom**-1).
+    layers: np.ndarray
+        Has shape (2 + N, 4), laid out as for `abeles`.
+
+    Returns
+    -------
+    r, error: np.ndarray
+        `r` is the complex64 reflectance, `error` is the estimated relative
+        error of ``|r|**2``.
+
+    Notes
+    -----
+    The error is a running (first order) error analysis. Alongside the
+    product of the characteristic matrices, ``T``, the product of their
+    absolute values, ``A``, and the squared relative error of each element of
+    ``A``, ``v``, are accumulated. The errors come from the error in the
+    wavevectors, which is large when ``Q**2 / 4`` nearly cancels
+    ``4 pi SLD``, and from the rounding error of each element. The errors
+    that each layer contributes to an element are independent, so they're
+    added in quadrature rather than linearly. That makes ``error`` an
+    estimate, not a bound, but a linear sum overestimates the error of a
+    many layered system by orders of magnitude.
+
+    The Fresnel coefficients are calculated as
+    ``(kb**2 - ka**2) / (ka + kb)**2``, where the numerator is the difference
+    of the SLDs. The equivalent ``(ka - kb) / (ka + kb)`` loses most of its
+    precision to cancellation when the contrast of an interface is low.
+    """
+    prof = _profiler
+    if prof is not None:
+        start = time.perf_counter()
+
+    eps = np.finfo(np.float32).eps
+    nlayers = layers.shape[0] - 2
+    thick = np.fabs(layers[1:-1, 0]).astype(np.float32)
+    sigma2 = (layers[1:, 3] ** 2).astype(np.float32)
+
+    # addition of TINY32 is to ensure the correct branch cut
+    # in the complex sqrt calculation of kn.
+    sld = np.zeros(layers.shape[0], np.complex128)
+    sld[1:] = (
+        (layers[1:, 1] - layers[0, 1]) + 1j * (np.abs(layers[1:, 2]) + TINY32)
+    ) * (4e-6 * np.pi)
+    # SLD contrast of each interface, taken before rounding to single
+    dsld = (sld[1:] - sld[:-1]).astype(np.complex64)
+    sld = sld.astype(np.complex64)
+
+    # kn.shape = (nlayers + 2, npnts)
+    qq = (flatq.astype(np.float32) / np.float32(2)) ** 2
+    kn = np.sqrt(qq - sld[:, np.newaxis])
+
+    # absolute error in kn, from the rounding error of the argument to sqrt
+    # and of the sqrt itself
+    dkn = np.abs(sld)[:, np.newaxis] + qq
+    dkn *= 0.5 * eps
+    dkn /= np.abs(kn)
+    dkn += eps * np.abs(kn)
+
+    ka = kn[:-1]
+    kb = kn[1:]
+    ksum = ka + kb
+    rough = np.exp(-2 * ka * kb * sigma2[:, np.newaxis])
+    rj = dsld[:, np.newaxis] / ksum**2 * rough
+
+    # relative error in rj
+    drj = dkn[:-1] + dkn[1:]
+    drj *= 2 / np.abs(ksum)
+    drj += (dkn[:-1] * np.abs(kb) + dkn[1:] * np.abs(ka)) * (
+        2 * sigma2[:, np.newaxis]
+    )
+    drj += 6 * eps
+
+    # |beta|, |rj| and the relative error of beta for each layer
+    babs = np.exp(-kn[1:-1].imag * thick[:, np.newaxis])
+    rabs = np.abs(rj)
+    dphase = dkn[1:-1] * thick[:, np.newaxis]
+    dphase += 2 * eps
+
+    if prof is not None:
+        wavevectors = time.perf_counter()
+        prof.add_stage("abeles_fast.wavevectors", wavevectors - start)
+
+    # initialise matrix total, absolute product and squared relative error
+    t00 = np.ones_like(rj[0])
+    t11 = np.ones_like(rj[0])
+    t01 = rj[0]
+    t10 = rj[0]
+    a00 = np.ones(flatq.size, np.float32)
+    a11 = np.ones(flatq.size, np.float32)
+    a01 = rabs[0]
+    a10 = rabs[0]
+    v00 = np.zeros(flatq.size, np.float32)
+    v11 = np.zeros(flatq.size, np.float32)
+    v01 = drj[0] ** 2
+    v10 = drj[0] ** 2
+
+    for idx in range(1, nlayers + 1):
+        beta = np.exp(1j * kn[idx] * thick[idx - 1])
+        mi00 = beta
+        mi11 = 1 / beta
+        mi10 = rj[idx] * mi00
+        mi01 = rj[idx] * mi11
+
+        p0 = t00 * mi00 + t10 * mi01
+        p1 = t00 * mi10 + t10 * mi11
+        t00, t10 = p0, p1
+        p0 = t01 * mi00 + t11 * mi01
+        p1 = t01 * mi10 + t11 * mi11
+        t01, t11 = p0, p1
+
+        # absolute values, and squared relative errors, of the layer matrix
+        b00 = babs[idx - 1]
+        b11 = 1 / b00
+        b10 = rabs[idx] * b00
+        b01 = rabs[idx] * b11
+        d2beta = dphase[idx - 1] ** 2
+        d2rj = (drj[idx] + dphase[idx - 1]) ** 2
+
+        # A' = A |M|
+        v00, v10, a00, a10 = _rss_row(
+            v00, v10, a00, a10, b00, b01, b10, b11, d2beta, d2rj
+        )
+        v01, v11, a01, a11 = _rss_row(
+            v01, v11, a01, a11, b00, b01, b10, b11, d2beta, d2rj
+        )
+
+    r = t01 / t00
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # relative error of r, doubled for |r|**2
+        error = (np.sqrt(v01) * a01).astype(np.float64) / np.abs(t01)
+        error += np.sqrt(v00) * a00 / np.abs(t00)
+        error += eps
+        error *= 2
+    error[~np.isfinite(r)] = np.inf
+
+    if prof is not None:
+        prof.add_stage(
+            "abeles_fast.propagation", time.perf_counter() - wavevectors
+        )
+    return r, error
+
+
+def _rss_row(v0, v1, a0, a1, b00, b01, b10, b11, d2beta, d2rj):
+    # One row of the product of the absolute values of the characteristic
+    # matrices, A' = A |M|, and the squared relative errors of its elements
+    # (see _abeles_reflectance_fast). Each term of a sum contributes its share
+    # of the sum to the relative error, the last term is the rounding error.
+    eps2 = 4 * np.finfo(np.float32).eps ** 2
+    tiny = np.finfo(np.float32).tiny
+
+    p0 = a0 * b00
+    p1 = a1 * b01
+    n0 = p0 + p1
+    inv = 1 / (n0 + tiny)
+    w0 = p0 * inv
+    w1 = p1 * inv
+    f0 = w0**2 * (v0 + d2beta) + w1**2 * (v1 + d2rj) + eps2
+
+    p0 = a0 * b10
+    p1 = a1 * b11
+    n1 = p0 + p1
+    inv = 1 / (n1 + tiny)
+    w0 = p0 * inv
+    w1 = p1 * inv
+    f1 = w0**2 * (v0 + d2rj) + w1**2 * (v1 + d2beta) + eps2
+    return f0, f1, n0, n1
+
+
+class AbelesEvaluator:
+    """
+    Abeles matrix formalism reflectivity calculation, bound to a fixed set of
+    Q points.
+
+    During a fit the Q points don't change between iterations. This object
+    does the Q dependent setup once and owns the scratch arrays used by the
+    calculation, so repeated calls with new `layers` (with the same number
+    of layers) don't allocate any Q sized arrays.
+
+    Parameters
+    ----------
+    q: array_like
+        the q values required for the calculation.
+        Q = 4 * Pi / lambda * sin(omega).
+        Units = Angstrom**-1
+    weights: array_like, optional
+        Resolution weights, must be broadcastable to the shape of `q`. If
+        provided the reflectivity is the weighted sum over the last axis of
+        `q`, i.e. ``np.sum(weights * R(q), axis=-1)``. For example, a fixed
+        order gaussian quadrature resolution kernel has `q` of shape (M, K),
+        containing the K quadrature points of each of the M datapoints.
+
+    Notes
+    -----
+    The scratch arrays are shared between calls, so an instance should not
+    be called from several threads at once.
+
+    Examples
+    --------
+    >>> evaluator = AbelesEvaluator(q)
+    >>> out = np.empty_like(q)
+    >>> for layers in proposals:
+    ...     evaluator(layers, out=out)
+    """
+
+    def __init__(self, q, weights=None):
+        self.q = np.array(q, dtype=np.float64)
+        self._flatq = self.q.ravel()
+        self._qq4 = (self._flatq**2 / 4.0).astype(np.complex128)
+
+        self.weights = None
+        self.shape = self.q.shape
+        if weights is not None:
+            self.weights = np.array(
+                np.broadcast_to(weights, self.q.shape), dtype=np.float64
+            )
+            self.shape = self.q.shape[:-1]
+
+        self._nlayers = None
+
+    def _allocate(self, nlayers):
+        npnts = self._flatq.size
+
+        # per layer values
+        self._sld = np.zeros(nlayers + 2, np.complex128)
+        self._thickness = np.zeros(nlayers, np.complex128)
+        self._rough = np.zeros(nlayers + 1, np.float64)
+
+        # the work arrays are laid out as (layer, Q point) so that each row
+        # used in the propagation loop is contiguous.
+        self._kn = np.empty((nlayers + 2, npnts), np.complex128)
+        self._rj = np.empty((nlayers + 1, npnts), np.complex128)
+        self._mi00 = np.empty((nlayers + 1, npnts), np.complex128)
+        self._mi11 = np.empty_like(self._mi00)
+        self._mi10 = np.empty_like(self._mi00)
+        self._mi01 = np.empty_like(self._mi00)
+        self._tmp = np.empty_like(self._mi00)
+
+        # matrix total, and products for the propagation
+        self._mrtot = np.empty((4, npnts), np.complex128)
+        self._p = np.empty((3, npnts), np.complex128)
+
+        self._reflectivity = np.empty(npnts, np.float64)
+        if self.weights is not None:
+            self._smeared = np.empty(self.q.shape, np.float64)
+        self._nlayers = nlayers
+
+    def __call__(self, layers, scale=1.0, bkg=0.0, out=None):
+        """
+        Calculate reflectivity.
+
+        Parameters
+        ----------
+        layers: np.ndarray
+            coefficients required for the calculation, has shape (2 + N, 4),
+            where N is the number of layers. Same layout as for `abeles`.
+        scale: float
+            Multiply all reflectivities by this value.
+        bkg: float
+            Linear background to be added to all reflectivities
+        out: np.ndarray, optional
+            Array in which to place the result. Must have shape
+            `self.shape`.
+
+        Returns
+        -------
+        Reflectivity: np.ndarray
+            Calculated reflectivity values, has shape `self.shape`.
+        """
+        layers = np.asarray(layers, dtype=np.float64)
+        nlayers = layers.shape[0] - 2
+        if nlayers != self._nlayers:
+            self._allocate(nlayers)
+
+        if out is None:
+            out = np.empty(self.shape, np.float64)
+
+        prof = _profiler
+        if prof is not None:
+            prof.add_call(type(self).__name__, self._flatq.size, nlayers)
+            start = time.perf_counter()
+
+        self._reflectance(layers)
+
+        if prof is not None:
+            reflectance = time.perf_counter()
+            prof.add_stage("evaluator.reflectance", reflectance - start)
+
+        if self.weights is None:
+            np.multiply(self._reflectivity.reshape(self.shape), scale, out=out)
+        else:
+            np.multiply(
+                self._reflectivity.reshape(self.q.shape),
+                self.weights,
+                out=self._smeared,
+            )
+            np.sum(self._smeared, axis=-1, out=out)
+            out *= scale
+            if prof is not None:
+                smearing = time.perf_counter() - reflectance
+                prof.add_stage("evaluator.smearing", smearing)
+        out += bkg
+        return out
+
+    def _reflectance(self, layers):
+        # calculates unscaled reflectivity into self._reflectivity
+        nlayers = self._nlayers
+        sld = self._sld
+        kn = self._kn
+        rj = self._rj
+        tmp = self._tmp
+        mi00, mi11, mi10, mi01 = self._mi00, self._mi11, self._mi10, self._mi01
+
+        # addition of TINY is to ensure the correct branch cut
+        # in the complex sqrt calculation of kn.
+        np.subtract(layers[1:, 1], layers[0, 1], out=sld.real[1:])
+        np.abs(layers[1:, 2], out=sld.imag[1:])
+        sld.imag[1:] += TINY
+        sld *= -4.0e-6 * np.pi
+
+        # wavevector in each layer, for each Q point.
+        np.add(self._qq4, sld[:, np.newaxis], out=kn)
+        np.sqrt(kn, out=kn)
+
+        # reflectances for each layer
+        np.subtract(kn[:-1], kn[1:], out=rj)
+        np.add(kn[:-1], kn[1:], out=tmp)
+        rj /= tmp
+        np.square(layers[1:, 3], out=self._rough)
+        self._rough *= -2.0
+        np.multiply(kn[:-1], kn[1:], out=tmp)
+        tmp *= self._rough[:, np.newaxis]
+        np.exp(tmp, out=tmp)
+        rj *= tmp
+
+        # characteristic matrices for each layer
+        mi00[0] = 1.0
+        if nlayers:
+            np.abs(layers[1:-1, 0], out=self._thickness.imag)
+            np.multiply(kn[1:-1], self._thickness[:, np.newaxis], out=mi00[1:])
+            np.exp(mi00[1:], out=mi00[1:])
+        np.reciprocal(mi00, out=mi11)
+        np.multiply(rj, mi00, out=mi10)
+        np.multiply(rj, mi11, out=mi01)
+
+        # initialise matrix total
+        mrtot00, mrtot01, mrtot10, mrtot11 = self._mrtot
+        mrtot00[:] = mi00[0]
+        mrtot01[:] = mi01[0]
+        mrtot10[:] = mi10[0]
+        mrtot11[:] = mi11[0]
+        p0, p1, t = self._p
+
+        # propagate characteristic matrices
+        for idx in range(1, nlayers + 1):
+            # matrix multiply mrtot by characteristic matrix
+            np.multiply(mrtot00, mi00[idx], out=p0)
+            np.multiply(mrtot10, mi01[idx], out=t)
+            p0 += t
+            np.multiply(mrtot00, mi10[idx], out=p1)
+            np.multiply(mrtot10, mi11[idx], out=t)
+            p1 += t
+            mrtot00, p0 = p0, mrtot00
+            mrtot10, p1 = p1, mrtot10
+
+            np.multiply(mrtot01, mi00[idx], out=p0)
+            np.multiply(mrtot11, mi01[idx], out=t)
+            p0 += t
+            np.multiply(mrtot01, mi10[idx], out=p1)
+            np.multiply(mrtot11, mi11[idx], out=t)
+            p1 += t
+            mrtot01, p0 = p0, mrtot01
+            mrtot11, p1 = p1, mrtot11
+
+        np.divide(mrtot01, mrtot00, out=t)
+        np.abs(t, out=self._reflectivity)
+        np.square(self._reflectivity, out=self._reflectivity)
+
+
+class IncrementalAbelesEvaluator(AbelesEvaluator):
+    """
+    An `AbelesEvaluator` that only recalculates the parts of the calculation
+    affected by the layers that changed since the previous call.
+
+    The characteristic matrix of each layer is a leaf of a balanced binary
+    tree, with each node holding the product of its two children and the
+    root holding the total matrix. When k of the N layers change only the
+    affected leaves and their ancestors are recalculated, costing
+    O(k log N) matrix multiplications instead of O(N). The result is
+    identical to recalculating the whole tree.
+
+    Parameters
+    ----------
+    q: array_like
+        the q values required for the calculation.
+        Q = 4 * Pi / lambda * sin(omega).
+        Units = Angstrom**-1
+    weights: array_like, optional
+        Resolution weights, see `AbelesEvaluator`.
+
+    Notes
+    -----
+    The tree holds ``2 * 4 * M`` complex values per layer, where M is the
+    number of Q points.
+    """
+
+    def _allocate(self, nlayers):
+        npnts = self._flatq.size
+
+        nleaves = 1
+        while nleaves < nlayers + 1:
+            nleaves *= 2
+        self._nleaves = nleaves
+
+        # tree[1] is the root, tree[nleaves + i] holds the characteristic
+        # matrix of layer i. Each matrix is stored as its (00, 01, 10, 11)
+        # elements. Unused leaves are identity matrices.
+        self._tree = np.zeros((2 * nleaves, 4, npnts), np.complex128)
+        self._tree[:, 0] = 1.0
+        self._tree[:, 3] = 1.0
+
+        self._kn = np.empty((nlayers + 2, npnts), np.complex128)
+        self._previous = None
+
+        self._reflectivity = np.empty(npnts, np.float64)
+        if self.weights is not None:
+            self._smeared = np.empty(self.q.shape, np.float64)
+        self._nlayers = nlayers
+
+    def _reflectance(self, layers):
+        nlayers = self._nlayers
+        previous = self._previous
+
+        if previous is None or layers[0, 1] != previous[0, 1]:
+            # the fronting SLD enters the wavevector of every layer
+            changed = np.arange(nlayers + 2)
+        else:
+            changed = np.flatnonzero(np.any(layers != previous, axis=1))
+        self._previous = np.copy(layers)
+
+        if changed.size:
+            self._update_wavevectors(layers, changed)
+
+            # layer j enters the characteristic matrices j - 1 and j
+            leaves = np.union1d(changed - 1, changed)
+            leaves = leaves[(leaves >= 0) & (leaves <= nlayers)]
+            self._update_tree(layers, leaves)
+
+        root = self._tree[1]
+        r = root[2] / root[0]
+        np.abs(r, out=self._reflectivity)
+        np.square(self._reflectivity, out=self._reflectivity)
+
+    def _update_wavevectors(self, layers, rows):
+        # addition of TINY is to ensure the correct branch cut
+        # in the complex sqrt calculation of kn.
+        sld = (layers[rows, 1] - layers[0, 1]) + 1j * (
+            np.abs(layers[rows, 2]) + TINY
+        )
+        sld[rows == 0] = 0.0
+        sld *= 4.0e-6 * np.pi
+
+        # Each layer is calculated on its own. NumPy's SIMD loops can round
+        # the tail of an array differently, so working on a batch of layers
+        # would make the result depend on which other layers changed.
+        for row, sld_row in zip(rows, sld):
+            kn = self._kn[row]
+            np.subtract(self._qq4, sld_row, out=kn)
+            np.sqrt(kn, out=kn)
+
+    def _update_tree(self, layers, leaves):
+        tree = self._tree
+        kn = self._kn
+        nodes = leaves + self._nleaves
+
+        for leaf, node in zip(leaves, nodes):
+            # reflectance of the interface below the layer
+            rj = (kn[leaf] - kn[leaf + 1]) / (kn[leaf] + kn[leaf + 1])
+            rj *= np.exp(
+                -2.0 * kn[leaf] * kn[leaf + 1] * layers[leaf + 1, 3] ** 2
+            )
+
+            m = tree[node]
+            if leaf:
+                m[0] = np.exp(kn[leaf] * 1j * np.fabs(layers[leaf, 0]))
+            else:
+                # the fronting medium has no thickness
+                m[0] = 1.0
+            m[3] = 1.0 / m[0]
+            m[1] = rj * m[0]
+            m[2] = rj * m[3]
+
+        # all leaves are at the same depth, so walk up level by level
+        while nodes[0] > 1:
+            nodes = np.unique(nodes // 2)
+            tree[nodes] = _matmul2(tree[2 * nodes], tree[2 * nodes + 1])
+
+
+class ResolutionMatrix:
+    """
+    Sparse matrix smearing reflectivity calculated on an oversampled Q grid
+    onto the measured points, for arbitrary (per point) Gaussian resolution.
+
+    Time of flight data has a different resolution for every point, from the
+    wavelength and angular spread of each bin. The matrix is built once per
+    dataset. Every calculation is then a single `AbelesEvaluator` call on the
+    shared grid, followed by a sparse matrix-vector product.
+
+    Parameters
+    ----------
+    q: array_like
+        the measured q values.
+        Q = 4 * Pi / lambda * sin(omega).
+        Units = Angstrom**-1
+    dq: array_like
+        Full width at half maximum of the Gaussian resolution kernel of each
+        q value, must be broadcastable to the shape of `q`. For time of
+        flight data ``dq / q = sqrt((dL / L)**2 + (dT / T)**2)``. Points with
+        ``dq == 0`` aren't smeared.
+    points_per_sigma: float, optional
+        Grid spacing, the grid has at least this many points per standard
+        deviation of the narrowest kernel covering it.
+    thickness: float, optional
+        Largest total film thickness the matrix will be used for. Kiessig
+        fringes narrower than the kernel point spacing alias in the sum, so
+        if the resolution is coarse compared to the fringes of thick films
+        the grid must also be limited by the fringe spacing, ``2 * Pi /
+        thickness``.
+    points_per_fringe: float, optional
+        Grid points per Kiessig fringe of a `thickness` thick film.
+
+    Attributes
+    ----------
+    grid: np.ndarray
+        The oversampled Q grid, sorted.
+    data, indices, indptr: np.ndarray
+        The matrix in compressed sparse row format (as used by
+        `scipy.sparse.csr_matrix`), with one row per measured point and one
+        column per grid point.
+
+    Notes
+    -----
+    The grid is warped, its spacing follows the narrowest kernel covering
+    each part of the Q range, so the densely sampled (finely resolved) low Q
+    end of a dataset doesn't set the spacing of the high Q end. Each row
+    holds the Gaussian weights of the grid points within +/- 3.5 sigma of
+    the measured point, integrated with the trapezoidal rule and normalised
+    to sum to one. With the default spacing the smeared reflectivity is
+    typically within 5e-4 of the exact integral. The grid is fixed before
+    the model is known, so it can't follow the critical edges, where R has a
+    kink. Within the resolution of a critical edge the error can reach
+    ~1e-3.
+
+    The size of the grid depends on the resolution, not on the number of
+    measured points. It is the length of Q covered by the windows divided
+    by the local spacing. For constant dQ/Q that is about ``2.35 *
+    points_per_sigma * ln(q_max / q_min) / (dQ / Q)`` points, e.g. ~4000
+    for 0.005 - 0.3 Angstrom**-1 at 2% dQ/Q, whether there are 300 or 3000
+    measured points. Data sampled more coarsely than its resolution (points
+    more than ~7 sigma apart) doesn't share grid points between windows, and
+    needs up to ``7 * points_per_sigma`` (56 by default) grid points per
+    measured point. 120 points over the same range at 1% dQ/Q give a grid of
+    6841 points. `abeles_smeared` is usually cheaper for such data.
+
+    Examples
+    --------
+    >>> matrix = ResolutionMatrix(q, dq)
+    >>> matrix.save("dataset_resolution.npz")
+    >>> matrix = ResolutionMatrix.load("dataset_resolution.npz")
+    >>> for layers in proposals:
+    ...     matrix(layers)
+    """
+
+    def __init__(
+        self, q, dq, points_per_sigma=8, thickness=None, points_per_fringe=4
+    ):
+        q = np.array(q, dtype=np.float64)
+        dq = np.broadcast_to(np.asfarray(dq), q.shape)
+        self.q = q
+        self.dq = np.array(dq)
+
+        flatq = q.ravel()
+        sigma = self.dq.ravel() / (2 * np.sqrt(2 * np.log(2)))
+        smeared = sigma > 0
+
+        max_spacing = np.inf
+        if thickness:
+            max_spacing = 2 * np.pi / thickness / points_per_fringe
+
+        lo = flatq - _GK_WINDOW * sigma
+        hi = flatq + _GK_WINDOW * sigma
+        grid = _warped_grid(
+            lo[smeared],
+            hi[smeared],
+            sigma[smeared] / points_per_sigma,
+            max_spacing,
+        )
+        # unsmeared points are calculated exactly
+        grid = np.union1d(grid, flatq[~smeared])
+        self.grid = grid
+
+        # each grid point stands for the cell between the midpoints to its
+        # neighbours. A row holds the grid points whose cells overlap the
+        # window, weighted by the overlap (the trapezoidal rule, with the end
+        # cells cut at the window edges). R can be much larger at the edges
+        # than in the middle of the window (next to a Bragg peak), so they
+        # must not move with the grid.
+        midpoints = 0.5 * (grid[1:] + grid[:-1])
+        cell_lo = np.concatenate((grid[:1], midpoints))
+        cell_hi = np.concatenate((midpoints, grid[-1:]))
+
+        left = np.searchsorted(cell_hi, lo, side="right")
+        right = np.searchsorted(cell_lo, hi, side="left")
+        left[~smeared] = np.searchsorted(grid, flatq[~smeared])
+        right[~smeared] = left[~smeared] + 1
+        counts = right - left
+
+        self.indptr = np.zeros(flatq.size + 1, np.intp)
+        np.cumsum(counts, out=self.indptr[1:])
+        indices = (
+            np.arange(self.indptr[-1])
+            - np.repeat(self.indptr[:-1], counts)
+            + np.repeat(left, counts)
+        )
+        self.indices = indices
+
+        width = np.minimum(cell_hi[indices], np.repeat(hi, counts))
+        width -= np.maximum(cell_lo[indices], np.repeat(lo, counts))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            z = (grid[indices] - np.repeat(flatq, counts)) / np.repeat(
+                sigma, counts
+            )
+        data = np.exp(-0.5 * z**2) * width
+        data[np.repeat(~smeared, counts)] = 1.0
+        data /= np.repeat(np.add.reduceat(data, self.indptr[:-1]), counts)
+        self.data = data
+
+        self._evaluator = None
+
+    @property
+    def shape(self):
+        """(number of measured points, number of grid points)"""
+        return self.indptr.size - 1, self.grid.size
+
+    def dot(self, r):
+        """
+        Smear reflectivity calculated on `grid` onto the measured points.
+
+        Parameters
+        ----------
+        r: array_like
+            Reflectivity on `grid`, has shape (..., grid.size). For example,
+            shape (P, grid.size) for a population of structures.
+
+        Returns
+        -------
+        smeared: np.ndarray
+            Smeared reflectivity, has shape (..., ) + `q.shape`.
+        """
+        r = np.asarray(r, dtype=np.float64)
+        smeared = np.add.reduceat(
+            r[..., self.indices] * self.data, self.indptr[:-1], axis=-1
+        )
+        return smeared.reshape(r.shape[:-1] + self.q.shape)
+
+    def __call__(self, layers, scale=1.0, bkg=0.0):
+        """
+        Calculate smeared reflectivity.
+
+        Parameters
+        ----------
+        layers: np.ndarray
+            coefficients required for the calculation, has shape (2 + N, 4),
+            where N is the number of layers. Same layout as for `abeles`.
+        scale: float
+            Multiply all reflectivities by this value.
+        bkg: float
+            Linear background to be added to all reflectivities
+
+        Returns
+        -------
+        Reflectivity: np.ndarray
+            Smeared reflectivity values, has the shape of `q`.
+        """
+        if self._evaluator is None:
+            self._evaluator = AbelesEvaluator(self.grid)
+        r = self._evaluator(layers)
+
+        prof = _profiler
+        if prof is not None:
+            start = time.perf_counter()
+
+        smeared = self.dot(r)
+
+        if prof is not None:
+            prof.add_stage("resolution.smearing", time.perf_counter() - start)
+
+        smeared *= scale
+        smeared += bkg
+        return smeared
+
+    def save(self, file):
+        """
+        Save the matrix (e.g. alongside the dataset) in ``.npz`` format.
+
+        Parameters
+        ----------
+        file: str, os.PathLike or file-like
+            Where to save the matrix. As for `np.savez`, ``.npz`` is appended
+            to a file name that doesn't end with it.
+        """
+        np.savez(
+            file,
+            q=self.q,
+            dq=self.dq,
+            grid=self.grid,
+            data=self.data,
+            indices=self.indices,
+            indptr=self.indptr,
+        )
+
+    @classmethod
+    def load(cls, file):
+        """
+        Load a matrix written by `save`.
+
+        Parameters
+        ----------
+        file: str, os.PathLike or file-like
+            File to load the matrix from.
 
-If TINY is made too small, then the C implementations start too suffer because
-the sqrt calculation takes too long. The C implementation is only just ahead of
-the python implementation!
-"""
+        Returns
+        -------
+        matrix: ResolutionMatrix
+        """
+        matrix = cls.__new__(cls)
+        with np.load(file) as f:
+            for key in ("q", "dq", "grid", "data", "indices", "indptr"):
+                setattr(matrix, key, f[key])
+        matrix._evaluator = None
+        return matrix
 
 
-class _Abeles_pyopencl:
-    def __init__(self):
-        self.ctx = None
-        self.prg = None
+def _warped_grid(lo, hi, spacing, max_spacing=np.inf):
+    """
+    Sorted grid covering the windows ``[lo, hi]``, whose local spacing is no
+    more than the smallest `spacing` (or `max_spacing`) of the windows
+    covering each point. Gaps between the windows are crossed in one step.
+    """
+    if not lo.size:
+        return np.empty(0)
+
+    edges = np.unique(np.concatenate((lo, hi)))
+
+    # smallest spacing of the windows covering each interval between edges,
+    # found by sweeping over the edges with a heap of the open windows.
+    order = np.argsort(lo, kind="stable")
+    step = np.full(edges.size - 1, np.inf)
+    heap = []
+    i = 0
+    for k in range(edges.size - 1):
+        while i < order.size and lo[order[i]] <= edges[k]:
+            heapq.heappush(heap, (spacing[order[i]], hi[order[i]]))
+            i += 1
+        while heap and heap[0][1] <= edges[k]:
+            heapq.heappop(heap)
+        if heap:
+            step[k] = heap[0][0]
+    step = np.minimum(step, max_spacing)
+
+    # number of grid intervals needed between the edges, with the gaps
+    # crossed in one step. The grid is spread evenly over the cumulative
+    # count.
+    count = np.diff(edges) / step
+    count[~np.isfinite(step)] = 1.0
+    cumulative = np.concatenate(([0.0], np.cumsum(count)))
+    total = cumulative[-1]
+    targets = np.linspace(0, total, int(np.ceil(total)) + 1)
+    return np.interp(targets, cumulative, edges)
+
+
+def _shared_array(shape, dtype=np.float64):
+    """
+    An array in a new `multiprocessing.shared_memory` block, together with
+    the ``(name, shape, dtype)`` spec that other processes use to attach
+    to it.
+    """
+    from multiprocessing import shared_memory
+
+    nbytes = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+    shm = shared_memory.SharedMemory(create=True, size=nbytes)
+    arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    return shm, arr, (shm.name, tuple(shape), np.dtype(dtype).str)
+
+
+# shared memory blocks attached by a pool worker, role -> (spec, shm, array)
+_worker_arrays = {}
+
+
+def _worker_attach(role, spec):
+    # Blocks are only attached once by each worker. When the parent replaces
+    # a block (e.g. for a larger population) the old one is released.
+    from multiprocessing import shared_memory
+
+    attached = _worker_arrays.get(role)
+    if attached is not None:
+        if attached[0] == spec:
+            return attached[2]
+        del _worker_arrays[role]
+        attached[1].close()
+
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    _worker_arrays[role] = (spec, shm, arr)
+    return arr
+
+
+def _worker_calc(kernel, specs, structures, points):
+    # Calculates the structures in slice `structures` at the Q points in
+    # slice `points`, writing into the shared output array. Only the specs
+    # (a few short strings) and the slices are sent to the worker.
+    q, layers, params, out = (
+        _worker_attach(role, spec)
+        for role, spec in zip(("q", "layers", "params", "out"), specs)
+    )
+
+    if kernel == "abeles":
+        r = _abeles_reflectance(q[points], layers[structures])
+        reflectivity = out[structures, points]
+        np.square(np.abs(r), out=reflectivity)
+        reflectivity *= params[structures, 0:1]
+        reflectivity += params[structures, 1:2]
+    else:
+        xx = q[points].astype(np.complex128)
+        for i in range(*structures.indices(len(layers))):
+            out[i, :, points] = _pnr_reflectivity(xx, layers[i])
+
+
+class ProcessPoolEvaluator:
+    """
+    Calculates the reflectivity of a population of structures (e.g. all the
+    members of a differential evolution generation) with a pool of worker
+    processes.
 
-    def __getstate__(self):
-        # pyopencl Contexts and Programs can't be pickled.
-        d = self.__dict__
-        d["ctx"] = None
-        d["prg"] = None
-        return d
+    The Q points, layers and results are held in
+    `multiprocessing.shared_memory` blocks. The workers attach to each block
+    once, after which only the block names and the index ranges of each
+    task are sent between processes, instead of pickling the arrays for
+    every task.
 
-    def __setstate__(self, state):
-        self.__dict__.update(state)
+    Parameters
+    ----------
+    q: array_like
+        the q values required for the calculation.
+        Q = 4 * Pi / lambda * sin(omega).
+        Units = Angstrom**-1
+    kernel: {'abeles', 'pnr'}, optional
+        The calculation to do. 'abeles' gives unpolarised reflectivity, see
+        `abeles`, 'pnr' gives the four spin channels of `pnr`.
+    workers: int, optional
+        Number of worker processes, `os.cpu_count()` by default.
+    mp_context: multiprocessing context, optional
+        Context used to start the workers, e.g.
+        ``multiprocessing.get_context('forkserver')``. By default the
+        platform default is used.
 
-    def __call__(self, q, w, scale=1.0, bkg=0.0, threads=0):
+    Notes
+    -----
+    Each structure is calculated serially in a worker. If there are fewer
+    structures than workers the Q points are split up as well. The shared
+    blocks are released by `close` (or on leaving a ``with`` block).
+
+    Examples
+    --------
+    >>> with ProcessPoolEvaluator(q) as evaluator:
+    ...     for population in generations:
+    ...         R = evaluator(population)
+    """
+
+    def __init__(self, q, kernel="abeles", workers=None, mp_context=None):
+        from concurrent.futures import ProcessPoolExecutor
+
+        if kernel not in ("abeles", "pnr"):
+            raise ValueError("kernel must be one of 'abeles', 'pnr'")
+        self.kernel = kernel
+
+        self.q = np.array(q, dtype=np.float64)
+        self.workers = workers or os.cpu_count() or 1
+
+        self._blocks = {}
+        self._specs = {}
+        shm, arr, spec = _shared_array((self.q.size,))
+        arr[:] = self.q.ravel()
+        self._blocks["q"] = (shm, arr)
+        self._specs["q"] = spec
+
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=mp_context
+        )
+        self._finalizer = weakref.finalize(
+            self, ProcessPoolEvaluator._release, self._pool, self._blocks
+        )
+
+    @staticmethod
+    def _release(pool, blocks):
+        pool.shutdown(wait=True)
+        for shm, _ in blocks.values():
+            shm.close()
+            shm.unlink()
+        blocks.clear()
+
+    def close(self):
         """
-        Abeles matrix formalism for calculating reflectivity from a
-        stratified
-        medium.
-        Uses pyopencl on a GPU to calculate reflectivity. The accuracy of
-        this function may not as good as the C and Python based versions.
-        Furthermore, it can be tricky to use when using multiprocessing
-        based parallelism.
+        Shut down the worker processes and release the shared memory.
+        """
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _array(self, role, shape):
+        # a shared array of `shape`, replacing the block if the shape changed
+        block = self._blocks.get(role)
+        if block is not None and block[1].shape == shape:
+            return block[1]
+        if block is not None:
+            del self._blocks[role]
+            block[0].close()
+            block[0].unlink()
+
+        shm, arr, spec = _shared_array(shape)
+        self._blocks[role] = (shm, arr)
+        self._specs[role] = spec
+        return arr
+
+    def _tasks(self, npop):
+        # split the population into about two tasks per worker, so that the
+        # workers stay busy if structures take different times. Small
+        # populations are split over the Q points instead.
+        npnts = self.q.size
+        if npop >= self.workers:
+            ntasks = min(npop, 2 * self.workers)
+            edges = np.linspace(0, npop, ntasks + 1).astype(int)
+            return [
+                (slice(a, b), slice(0, npnts))
+                for a, b in zip(edges[:-1], edges[1:])
+            ]
+
+        per_structure = max(self.workers // npop, 1)
+        per_structure = min(
+            per_structure, max(npnts // _MIN_POINTS_PER_THREAD, 1)
+        )
+        edges = np.linspace(0, npnts, per_structure + 1).astype(int)
+        return [
+            (slice(i, i + 1), slice(a, b))
+            for i in range(npop)
+            for a, b in zip(edges[:-1], edges[1:])
+        ]
+
+    def __call__(self, layers, scale=1.0, bkg=0.0, out=None):
+        """
+        Calculate reflectivity.
 
         Parameters
         ----------
-        q: array_like
-            the q values required for the calculation.
-            Q = 4 * Pi / lambda * sin(omega).
-            Units = Angstrom**-1
         layers: np.ndarray
             coefficients required for the calculation, has shape
-            (2 + N, 4), where N is the number of layers
-            layers[0, 1] - SLD of fronting (/1e-6 Angstrom**-2)
-            layers[0, 2] - iSLD of fronting (/1e-6 Angstrom**-2)
-            layers[N, 0] - thickness of layer N
-            layers[N, 1] - SLD of layer N (/1e-6 Angstrom**-2)
-            layers[N, 2] - iSLD of layer N (/1e-6 Angstrom**-2)
-            layers[N, 3] - roughness between layer N-1/N
-            layers[-1, 1] - SLD of backing (/1e-6 Angstrom**-2)
-            layers[-1, 2] - iSLD of backing (/1e-6 Angstrom**-2)
-            layers[-1, 3] - roughness between backing and last layer
-        scale: float
-            Multiply all reflectivities by this value.
-        bkg: float
-            Linear background to be added to all reflectivities
-        threads: int, optional
-            <THIS OPTION IS CURRENTLY IGNORED>
+            (P, 2 + N, C), where P is the number of structures. Each
+            ``layers[i]`` has the same layout as the `layers` argument of
+            `abeles` (C == 4) or `pnr` (C == 5 or 6).
+        scale: float or array_like
+            Multiply all reflectivities by this value, can be an array of
+            shape (P,). Only used by the 'abeles' kernel.
+        bkg: float or array_like
+            Linear background to be added to all reflectivities, can be an
+            array of shape (P,). Only used by the 'abeles' kernel.
+        out: np.ndarray, optional
+            Array in which to place the result.
 
         Returns
         -------
         Reflectivity: np.ndarray
-            Calculated reflectivity values for each q value.
+            Calculated reflectivity values. Has shape ``(P,) + q.shape``
+            for 'abeles', and ``(P, 4) + q.shape`` for 'pnr', with the spin
+            channels in the order (PP, MM, PM, MP).
         """
-        import pyopencl as cl
+        if not self._finalizer.alive:
+            raise RuntimeError("ProcessPoolEvaluator has been closed")
 
-        if self.ctx is None or self.prg is None:
-            self.ctx = cl.create_some_context(interactive=False)
-            pth = os.path.dirname(os.path.abspath(__file__))
-            with open(os.path.join(pth, "abeles_pyopencl.cl"), "r") as f:
-                src = f.read()
-            self.prg = cl.Program(self.ctx, src).build()
-
-        qvals = np.asfarray(q)
-        flatq = qvals.ravel()
+        layers = np.asarray(layers, dtype=np.float64)
+        if layers.ndim != 3 or layers.shape[1] < 2:
+            raise ValueError("layers must be an array of shape (P, >2, C)")
+        npop = layers.shape[0]
 
-        nlayers = len(w) - 2
-        coefs = np.empty((nlayers * 4 + 8))
-        coefs[0] = nlayers
-        coefs[1] = scale
-        coefs[2:4] = w[0, 1:3]
-        coefs[4:6] = w[-1, 1:3]
-        coefs[6] = bkg
-        coefs[7] = w[-1, 3]
-        if nlayers:
-            coefs[8::4] = w[1:-1, 0]
-            coefs[9::4] = w[1:-1, 1]
-            coefs[10::4] = w[1:-1, 2]
-            coefs[11::4] = w[1:-1, 3]
+        self._array("layers", layers.shape)[:] = layers
+        params = self._array("params", (npop, 2))
+        params[:, 0] = scale
+        params[:, 1] = bkg
 
-        mf = cl.mem_flags
-        with cl.CommandQueue(self.ctx) as queue:
-            q_g = cl.Buffer(
-                self.ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=flatq
-            )
-            coefs_g = cl.Buffer(
-                self.ctx, mf.READ_ONLY | mf.COPY_HOST_PTR, hostbuf=coefs
+        if self.kernel == "abeles":
+            shape = (npop, self.q.size)
+        else:
+            shape = (npop, 4, self.q.size)
+        result = self._array("out", shape)
+
+        specs = tuple(
+            self._specs[role] for role in ("q", "layers", "params", "out")
+        )
+        futures = [
+            self._pool.submit(
+                _worker_calc, self.kernel, specs, structures, points
             )
-            ref_g = cl.Buffer(self.ctx, mf.WRITE_ONLY, flatq.nbytes)
+            for structures, points in self._tasks(npop)
+        ]
+        for future in futures:
+            future.result()
 
-            self.prg.abeles(queue, flatq.shape, None, q_g, coefs_g, ref_g)
+        if out is None:
+            out = np.empty(shape[:-1] + self.q.shape)
+        out[...] = result.reshape(out.shape)
+        return out
 
-            reflectivity = np.empty_like(flatq)
-            cl.enqueue_copy(queue, reflectivity, ref_g)
-        return np.reshape(reflectivity, qvals.shape)
 
+def _matmul2(a, b):
+    """
+    Matrix products of (stacks of) 2x2 matrices.
+
+    Parameters
+    ----------
+    a, b: np.ndarray
+        Matrices held as their (00, 01, 10, 11) elements along the second
+        last axis, i.e. ``a.shape == (..., 4, M)``.
 
-abeles_pyopencl = _Abeles_pyopencl()
+    Returns
+    -------
+    c: np.ndarray
+        ``a @ b``, laid out in the same way.
+    """
+    a00, a01, a10, a11 = a[..., 0, :], a[..., 1, :], a[..., 2, :], a[..., 3, :]
+    b00, b01, b10, b11 = b[..., 0, :], b[..., 1, :], b[..., 2, :], b[..., 3, :]
+    return np.stack(
+        [
+            a00 * b00 + a01 * b10,
+            a00 * b01 + a01 * b11,
+            a10 * b00 + a11 * b10,
+            a10 * b01 + a11 * b11,
+        ],
+        axis=-2,
+    )
+
+
+def _matpow2(a, n):
+    """
+    Integer power of 2x2 matrices, by repeated squaring.
+
+    Parameters
+    ----------
+    a: np.ndarray
+        Matrices held as their (00, 01, 10, 11) elements along the second
+        last axis, see `_matmul2`.
+    n: int
+        Non-negative power.
+
+    Returns
+    -------
+    c: np.ndarray
+        ``a ** n``, laid out in the same way as `a`.
+    """
+    result = None
+    while n:
+        if n & 1:
+            result = a if result is None else _matmul2(result, a)
+        n >>= 1
+        if n:
+            a = _matmul2(a, a)
+
+    if result is None:
+        result = np.zeros_like(a)
+        result[..., 0, :] = 1.0
+        result[..., 3, :] = 1.0
+    return result
+
+
+def _identity2(npnts):
+    """
+    2x2 identity matrices for each spin state and each of `npnts` points,
+    laid out as for `_matmul2`, with shape (2, 4, npnts).
+    """
+    m = np.zeros((2, 4, npnts), np.complex128)
+    m[:, 0] = 1.0
+    m[:, 3] = 1.0
+    return m
 
 
-def abeles(q, layers, scale=1.0, bkg=0, threads=0):
+def _identity4(npnts):
     """
-    Abeles matrix formalism for calculating reflectivity from a stratified
-    medium.
+    4x4 identity matrix for each of `npnts` points, with shape (4, 4, npnts).
+    """
+    m = np.zeros((4, 4, npnts), np.complex128)
+    for i in range(4):
+        m[i, i] = 1.0
+    return m
+
+
+def _matmul4(a, b):
+    """
+    Matrix products of 4x4 matrices with shape (4, 4, M), see `_identity4`.
+    """
+    c = np.moveaxis(a, -1, 0) @ np.moveaxis(b, -1, 0)
+    return np.ascontiguousarray(np.moveaxis(c, 0, -1))
+
+
+def _matpow4(a, n):
+    """
+    Integer power of 4x4 matrices with shape (4, 4, M), see `_identity4`.
+    """
+    c = np.linalg.matrix_power(np.moveaxis(a, -1, 0), n)
+    return np.ascontiguousarray(np.moveaxis(c, 0, -1))
+
+
+def _check_repeats(repeats, nrows):
+    """
+    Validates a repeat specification.
 
     Parameters
     ----------
-    q: array_like
-        the q values required for the calculation.
-        Q = 4 * Pi / lambda * sin(omega).
-        Units = Angstrom**-1
-    layers: np.ndarray
-        coefficients required for the calculation, has shape (2 + N, 4),
-        where N is the number of layers
-        layers[0, 1] - SLD of fronting (/1e-6 Angstrom**-2)
-        layers[0, 2] - iSLD of fronting (/1e-6 Angstrom**-2)
-        layers[N, 0] - thickness of layer N
-        layers[N, 1] - SLD of layer N (/1e-6 Angstrom**-2)
-        layers[N, 2] - iSLD of layer N (/1e-6 Angstrom**-2)
-        layers[N, 3] - roughness between layer N-1/N
-        layers[-1, 1] - SLD of backing (/1e-6 Angstrom**-2)
-        layers[-1, 2] - iSLD of backing (/1e-6 Angstrom**-2)
-        layers[-1, 3] - roughness between backing and last layer
-    scale: float
-        Multiply all reflectivities by this value.
-    bkg: float
-        Linear background to be added to all reflectivities
-    threads: int, optional
-        <THIS OPTION IS CURRENTLY IGNORED>
+    repeats: sequence of (int, int, int)
+        Each entry is ``(start, stop, n)``: the block of rows
+        ``layers[start:stop]`` is repeated `n` times.
+    nrows: int
+        Number of rows in the layers array (including fronting and backing).
 
     Returns
     -------
-    Reflectivity: np.ndarray
-        Calculated reflectivity values for each q value.
+    blocks: dict
+        Maps the start row of each repeated block to ``(stop, n)``.
     """
-    qvals = np.asfarray(q)
-    flatq = qvals.ravel()
+    blocks = {}
+    previous_stop = 1
+    for start, stop, n in sorted(repeats):
+        start, stop, n = int(start), int(stop), int(n)
+        if not (previous_stop <= start < stop <= nrows - 1):
+            raise ValueError(
+                "Repeated blocks must not overlap, and can't include the"
+                " fronting or backing media."
+            )
+        if n < 1:
+            raise ValueError("A block must be repeated at least once.")
+        blocks[start] = (stop, n)
+        previous_stop = stop
+    return blocks
 
-    nlayers = layers.shape[0] - 2
-    npnts = flatq.size
 
-    kn = np.zeros((npnts, nlayers + 2), np.complex128)
-    mi00 = np.ones((npnts, nlayers + 1), np.complex128)
+def _abeles_reflectance_repeats(flatq, layers, repeats):
+    """
+    Complex reflectance calculated with the Abeles matrix formalism, for a
+    structure containing repeated blocks of layers.
+
+    Parameters
+    ----------
+    flatq: np.ndarray
+        1D array of Q values (Angstrom**-1).
+    layers: np.ndarray
+        Has shape (2 + N, 4), laid out as for `abeles`.
+    repeats: sequence of (int, int, int)
+        Each entry is ``(start, stop, n)``: the block of rows
+        ``layers[start:stop]`` is repeated `n` times.
+
+    Returns
+    -------
+    r: np.ndarray
+        Complex reflectance, same shape as `flatq`.
+
+    Notes
+    -----
+    The result is the same as for the expanded structure, where each block
+    is replaced by `n` copies of itself. The characteristic matrix of the
+    repeat unit (including the interface from its last layer back to its
+    first) is raised to the power ``n - 1`` by repeated squaring, so the
+    cost grows with ``log(n)``.
+    """
+    prof = _profiler
+    if prof is not None:
+        start = time.perf_counter()
+
+    nrows = layers.shape[0]
+    blocks = _check_repeats(repeats, nrows)
 
-    sld = np.zeros(nlayers + 2, np.complex128)
+    sld = np.zeros(nrows, np.complex128)
 
     # addition of TINY is to ensure the correct branch cut
     # in the complex sqrt calculation of kn.
@@ -204,49 +2994,59 @@ def abeles(q, layers, scale=1.0, bkg=0, threads=0):
         (layers[1:, 1] - layers[0, 1]) + 1j * (np.abs(layers[1:, 2]) + TINY)
     ) * 1.0e-6
 
-    # kn is a 2D array. Rows are Q points, columns are kn in a layer.
-    # calculate wavevector in each layer, for each Q point.
-    kn[:] = np.sqrt(flatq[:, np.newaxis] ** 2.0 / 4.0 - 4.0 * np.pi * sld)
-
-    # reflectances for each layer
-    # rj.shape = (npnts, nlayers + 1)
-    rj = kn[:, :-1] - kn[:, 1:]
-    rj /= kn[:, :-1] + kn[:, 1:]
-    rj *= np.exp(-2.0 * kn[:, :-1] * kn[:, 1:] * layers[1:, 3] ** 2)
-
-    # characteristic matrices for each layer
-    # miNN.shape = (npnts, nlayers + 1)
-    if nlayers:
-        mi00[:, 1:] = np.exp(kn[:, 1:-1] * 1j * np.fabs(layers[1:-1, 0]))
-    mi11 = 1.0 / mi00
-    mi10 = rj * mi00
-    mi01 = rj * mi11
+    # kn.shape = (nrows, npnts)
+    kn = np.sqrt(flatq**2.0 / 4.0 - 4.0 * np.pi * sld[:, np.newaxis])
 
-    # initialise matrix total
-    mrtot00 = mi00[:, 0]
-    mrtot01 = mi01[:, 0]
-    mrtot10 = mi10[:, 0]
-    mrtot11 = mi11[:, 0]
+    if prof is not None:
+        wavevectors = time.perf_counter()
+        prof.add_stage("abeles.wavevectors", wavevectors - start)
 
-    # propagate characteristic matrices
-    for idx in range(1, nlayers + 1):
-        # matrix multiply mrtot by characteristic matrix
-        p0 = mrtot00 * mi00[:, idx] + mrtot10 * mi01[:, idx]
-        p1 = mrtot00 * mi10[:, idx] + mrtot10 * mi11[:, idx]
-        mrtot00 = p0
-        mrtot10 = p1
+    def matrix(j, j_next):
+        # characteristic matrix of layer j, followed by layer j_next
+        rj = (kn[j] - kn[j_next]) / (kn[j] + kn[j_next])
+        rj *= np.exp(-2.0 * kn[j] * kn[j_next] * layers[j_next, 3] ** 2)
+        if j:
+            mi00 = np.exp(kn[j] * 1j * np.fabs(layers[j, 0]))
+        else:
+            mi00 = np.ones_like(rj)
+        mi11 = 1.0 / mi00
+        return np.stack([mi00, rj * mi00, rj * mi11, mi11])
+
+    mrtot = matrix(0, 1)
+    j = 1
+    while j < nrows - 1:
+        if j in blocks:
+            stop, n = blocks[j]
+            inner = None
+            for k in range(j, stop - 1):
+                m = matrix(k, k + 1)
+                inner = m if inner is None else _matmul2(inner, m)
+
+            # every repeat apart from the last returns to the first layer of
+            # the block, the last one continues on to the following layer.
+            wrap = matrix(stop - 1, j)
+            last = matrix(stop - 1, stop)
+            if inner is not None:
+                wrap = _matmul2(inner, wrap)
+                last = _matmul2(inner, last)
+
+            mrtot = _matmul2(mrtot, _matpow2(wrap, n - 1))
+            mrtot = _matmul2(mrtot, last)
+            j = stop
+        else:
+            mrtot = _matmul2(mrtot, matrix(j, j + 1))
+            j += 1
 
-        p0 = mrtot01 * mi00[:, idx] + mrtot11 * mi01[:, idx]
-        p1 = mrtot01 * mi10[:, idx] + mrtot11 * mi11[:, idx]
+    r = mrtot[2] / mrtot[0]
+    if prof is not None:
+        prof.add_stage("abeles.propagation", time.perf_counter() - wavevectors)
+    return r
 
-        mrtot01 = p0
-        mrtot11 = p1
 
-    r = mrtot01 / mrtot00
-    reflectivity = r * np.conj(r)
-    reflectivity *= scale
-    reflectivity += bkg
-    return np.real(np.reshape(reflectivity, qvals.shape))
+# number of contracted slab representations remembered by _contract_by_area
+_CONTRACT_CACHE_SIZE = 32
+_contract_cache = OrderedDict()
+_contract_cache_lock = threading.Lock()
 
 
 # The following slab contraction code was translated from C code in
@@ -280,8 +3080,53 @@ def _contract_by_area(slabs, dA=0.5):
     -----
     The reflectivity profiles from both contracted and un-contracted profiles
     should be compared to check for accuracy.
+
+    The most recently contracted profiles are cached, keyed on the contents
+    of `slabs` and on `dA`, so an unchanged profile isn't contracted again.
     """
+    slabs = np.ascontiguousarray(slabs, dtype=np.float64)
+
+    prof = _profiler
+    if prof is not None:
+        prof.add_call("contract_by_area", 0, len(slabs) - 2)
+
+    key = (
+        slabs.shape,
+        hashlib.blake2b(slabs.tobytes(), digest_size=16).digest(),
+        float(dA),
+    )
+
+    with _contract_cache_lock:
+        contracted = _contract_cache.get(key)
+        if contracted is not None:
+            _contract_cache.move_to_end(key)
+            return np.copy(contracted)
+
+    if prof is not None:
+        start = time.perf_counter()
+    contracted = _contract(slabs, dA)
+    if prof is not None:
+        prof.add_stage("contraction", time.perf_counter() - start)
 
+    with _contract_cache_lock:
+        _contract_cache[key] = contracted
+        if len(_contract_cache) > _CONTRACT_CACHE_SIZE:
+            _contract_cache.popitem(last=False)
+
+    return np.copy(contracted)
+
+
+def _contract(slabs, dA):
+    """
+    Slab contraction for `_contract_by_area`, vectorised with NumPy.
+
+    Starting from the backing medium, slabs are accumulated into a layer
+    for as long as the interfaces between them have no roughness and the
+    SLD range of the layer multiplied by its thickness stays below `dA`.
+    Rather than visiting each slab in turn the end of each layer is found
+    from cumulative sums/extrema over a window of slabs, the window growing
+    until the end is found.
+    """
     # In refl1d the first slab is the substrate, the order is reversed here.
     # In the following code the slabs are traversed from the backing towards
     # the fronting.
@@ -293,97 +3138,172 @@ def _contract_by_area(slabs, dA=0.5):
     vfsolv = newslabs[:, 4]
 
     n = np.size(d, 0)
-    i = newi = 1  # Skip the substrate
+    if n < 2:
+        return newslabs[::-1]
 
+    starts = []
+    i = 1  # Skip the substrate
+    width = 16
     while i < n:
-        # Get ready for the next layer
-        # Accumulation of the first row happens in the inner loop
-        dz = rhoarea = irhoarea = vfsolvarea = 0.0
-        rholo = rhohi = rho[i]
-        irholo = irhohi = irho[i]
-
-        # Accumulate slices into layer
-        while True:
-            # Accumulate next slice
-            dz += d[i]
-            rhoarea += d[i] * rho[i]
-            irhoarea += d[i] * irho[i]
-            vfsolvarea += d[i] * vfsolv[i]
-
-            i += 1
-            # If no more slices or sigma != 0, break immediately
-            if i == n or sigma[i - 1] != 0.0:
-                break
-
-            # If next slice won't fit, break
-            if rho[i] < rholo:
-                rholo = rho[i]
-            if rho[i] > rhohi:
-                rhohi = rho[i]
-            if (rhohi - rholo) * (dz + d[i]) > dA:
-                break
-
-            if irho[i] < irholo:
-                irholo = irho[i]
-            if irho[i] > irhohi:
-                irhohi = irho[i]
-            if (irhohi - irholo) * (dz + d[i]) > dA:
-                break
-
-        # Save the layer
-        d[newi] = dz
-        if i == n:
-            # printf("contract: adding final sld at %d\n",newi)
-            # Last layer uses surface values
-            rho[newi] = rho[n - 1]
-            irho[newi] = irho[n - 1]
-            vfsolv[newi] = vfsolv[n - 1]
-        else:
-            # Middle layers uses average values
-            rho[newi] = rhoarea / dz
-            irho[newi] = irhoarea / dz
-            sigma[newi] = sigma[i - 1]
-            vfsolv[newi] = vfsolvarea / dz
-        # First layer uses substrate values
-        newi += 1
-
-    return newslabs[:newi][::-1]
-
-
-"""
-Polarised Neutron Reflectometry calculation
-"""
-
-
-def _pmatrix(kn_u, kn_d, thickness):
+        starts.append(i)
+        i = _contract_layer_end(d, rho, irho, sigma, i, dA, width)
+        # neighbouring layers tend to contain a similar number of slabs
+        width = max(16, 2 * (i - starts[-1]))
+    starts = np.array(starts)
+    ends = np.append(starts[1:], n)
+
+    dz = np.add.reduceat(d, starts)
+    rhoarea = np.add.reduceat(d * rho, starts)
+    irhoarea = np.add.reduceat(d * irho, starts)
+    vfsolvarea = np.add.reduceat(d * vfsolv, starts)
+
+    newi = len(starts) + 1
+    contracted = np.copy(newslabs[:newi])
+
+    # Middle layers uses average values
+    contracted[1:, 0] = dz
+    contracted[1:-1, 1] = rhoarea[:-1] / dz[:-1]
+    contracted[1:-1, 2] = irhoarea[:-1] / dz[:-1]
+    contracted[1:-1, 3] = sigma[ends[:-1] - 1]
+    contracted[1:-1, 4] = vfsolvarea[:-1] / dz[:-1]
+
+    # Last layer uses surface values
+    contracted[-1, 1] = rho[n - 1]
+    contracted[-1, 2] = irho[n - 1]
+    contracted[-1, 4] = vfsolv[n - 1]
+
+    # First layer uses substrate values
+    return contracted[::-1]
+
+
+def _contract_layer_end(d, rho, irho, sigma, i, dA, width=16):
+    """
+    Index of the first slab that can't be added to the layer starting at
+    slab `i`, see `_contract`. `width` is the number of slabs examined
+    first, it's doubled until the end of the layer is found.
+    """
+    n = np.size(d, 0)
+    while True:
+        stop = min(i + width, n)
+
+        # thickness, and SLD extrema of the layer if it extends to each slab
+        dz = np.cumsum(d[i:stop])[1:]
+        rho_range = np.maximum.accumulate(rho[i:stop])
+        rho_range -= np.minimum.accumulate(rho[i:stop])
+        irho_range = np.maximum.accumulate(irho[i:stop])
+        irho_range -= np.minimum.accumulate(irho[i:stop])
+
+        # If sigma != 0, or the next slice won't fit, break
+        full = sigma[i : stop - 1] != 0.0
+        full |= rho_range[1:] * dz > dA
+        full |= irho_range[1:] * dz > dA
+
+        idx = np.flatnonzero(full)
+        if idx.size:
+            return i + 1 + idx[0]
+        if stop == n:
+            return n
+        width *= 2
+
+
+def _contract_by_tolerance(
+    slabs, q, rtol=1e-3, points_per_fringe=16, maxiter=8
+):
     """
-    # equation 7 + 14 in Blundell and Bland
+    Shrinks a slab representation to the smallest number of layers whose
+    reflectivity stays within a relative tolerance of the un-contracted
+    reflectivity.
 
     Parameters
     ----------
-    kn_u, kn_d: np.ndarray
-        wavevector for up and down within a given layer. Has shape (N,),
-        where N is the number of Q points.
-
-    thickness: float
-        Thickness of layer (Angstrom)
+    slabs : array
+        Has shape (N, 5), see `_contract_by_area`.
+    q : array_like
+        Q values (Angstrom**-1) of the data the contracted slabs will be
+        used for. The error is assessed over the range spanned by these
+        values.
+    rtol : float
+        Target maximum relative error in reflectivity.
+    points_per_fringe : int
+        The error is assessed at evenly spaced Q points, this many per
+        Kiessig fringe of the whole film (whose period is ``2 * pi / D``,
+        with D the total thickness).
+    maxiter : int
+        Number of bisections used to refine `dA`, once the largest
+        acceptable `dA` has been bracketed.
 
     Returns
     -------
-    p : np.ndarray
-        P matrix
+    contract_slab, dA, error : array, float, float
+        Contracted slab representation, the `dA` used for the contraction,
+        and the maximum relative error in reflectivity at the probe points.
+
+    Notes
+    -----
+    `dA` is increased geometrically until the error exceeds `rtol`, or no
+    further contraction is possible, and then refined by bisection. The
+    error is only assessed at the probe points. The largest errors are at
+    the minima of the Kiessig fringes, which are sampled closely enough
+    that the error in between the probes is at most a few percent larger.
     """
-    p = np.zeros((kn_u.size, 4, 4), np.complex128)
+    slabs = np.asarray(slabs, dtype=np.float64)
+    q = np.asfarray(q)
+    qmin, qmax = np.min(q), np.max(q)
+    thickness = _total_thickness(slabs)
+    nprobe = 2
+    if thickness > 0:
+        period = 2 * np.pi / thickness
+        nprobe += int(np.ceil((qmax - qmin) / period * points_per_fringe))
+    probe = np.linspace(qmin, qmax, nprobe)
+    reference = abeles(probe, slabs[:, :4])
+
+    def trial(dA):
+        contracted = _contract_by_area(slabs, dA)
+        R = abeles(probe, contracted[:, :4])
+        return contracted, np.max(np.abs(R - reference) / reference)
+
+    # the most that the profile can be contracted
+    min_layers = len(_contract_by_area(slabs, np.inf))
+
+    # bracket the largest acceptable dA
+    good = (slabs, 0.0, 0.0)
+    bad = None
+    dA = 0.01
+    while dA > 1e-8:
+        contracted, error = trial(dA)
+        if error <= rtol:
+            good = (contracted, dA, error)
+            if len(contracted) <= min_layers:
+                return good
+            dA *= 4.0
+        else:
+            bad = dA
+            if good[1]:
+                break
+            dA /= 4.0
+
+    if bad is None or not good[1]:
+        # either contraction is never acceptable, or always is
+        return good
+
+    # refine by geometric bisection
+    lo, hi = good[1], bad
+    for i in range(maxiter):
+        dA = np.sqrt(lo * hi)
+        contracted, error = trial(dA)
+        if error <= rtol:
+            if len(contracted) < len(good[0]):
+                good = (contracted, dA, error)
+            lo = dA
+        else:
+            hi = dA
 
-    p0 = np.exp(complex(0, 1) * kn_u * thickness)
-    p1 = np.exp(complex(0, 1) * kn_d * thickness)
+    return good
 
-    p[:, 0, 0] = 1 / p0
-    p[:, 1, 1] = p0
-    p[:, 2, 2] = 1 / p1
-    p[:, 3, 3] = p1
 
-    return p
+"""
+Polarised Neutron Reflectometry calculation
+"""
 
 
 def _dmatrix(kn_u, kn_d):
@@ -482,12 +3402,10 @@ def _magsqr(z):
     return np.abs(z) ** 2
 
 
-def pnr(q, layers):
+def pnr(q, layers, threads=0, chunk_size=None, repeats=None):
     """
     Calculates Polarised Neutron Reflectivity of a series of slabs.
 
-    No interlayer roughness is taken into account.
-
     Parameters
     ----------
     q: array_like
@@ -495,23 +3413,45 @@ def pnr(q, layers):
         Q = 4 * Pi / lambda * sin(omega).
         Units = Angstrom**-1
     layers: np.ndarray
-        coefficients required for the calculation, has shape (2 + N, 4),
-        where N is the number of layers
+        coefficients required for the calculation, has shape (2 + N, 5) or
+        (2 + N, 6), where N is the number of layers
         layers[0, 1] - SLD of fronting (/1e-6 Angstrom**-2)
         layers[0, 2] - iSLD of fronting (/1e-6 Angstrom**-2)
         layers[0, 3] - magSLD of fronting (/1e-6 Angstrom**-2)
-        layers[0, 3] - angle of magnetic moment w.r.t applied field (degrees)
+        layers[0, 4] - angle of magnetic moment w.r.t applied field (degrees)
 
         layers[N, 0] - thickness of layer N
         layers[N, 1] - SLD of layer N (/1e-6 Angstrom**-2)
         layers[N, 2] - iSLD of layer N (/1e-6 Angstrom**-2)
         layers[N, 3] - magSLD of layer N (/1e-6 Angstrom**-2)
         layers[N, 4] - angle of magnetic moment w.r.t applied field (degrees)
+        layers[N, 5] - roughness between layer N and N-1 (optional)
 
         layers[-1, 1] - SLD of backing (/1e-6 Angstrom**-2)
         layers[-1, 2] - iSLD of backing (/1e-6 Angstrom**-2)
         layers[-1, 3] - magSLD of backing (/1e-6 Angstrom**-2)
         layers[-1, 4] - angle of magnetic moment w.r.t applied field (degrees)
+        layers[-1, 5] - roughness between backing and last layer (optional)
+
+        If the roughness column is present the interfaces are smeared with
+        a Nevot-Croce factor, as in refl1d's `magnetic_amplitude`. Each
+        element of an interface matrix that couples incident and reflected
+        waves is damped by ``exp(-2 k_a k_b sigma**2)``, where ``k_a``,
+        ``k_b`` are the wavevectors of the spin states on either side.
+    threads: int, optional
+        How many threads you would like to use in the reflectivity calculation.
+        If `threads == -1` then the calculation is automatically spread over
+        `os.cpu_count()` threads. Q points are split between the threads.
+    chunk_size: int, optional
+        Maximum number of Q points that are calculated at once. The
+        temporary (chunk_size, 4, 4) matrices are reused for each chunk,
+        rather than scaling with the total number of Q points, which bounds
+        memory use for large datasets. By default all Q points are
+        calculated at once.
+    repeats: sequence of (int, int, int), optional
+        Compact description of repeated blocks of layers. Each entry is
+        ``(start, stop, n)``, meaning that the rows ``layers[start:stop]``
+        are repeated `n` times, see `abeles`.
 
     Returns
     -------
@@ -524,59 +3464,308 @@ def pnr(q, layers):
     ..[1] S. J. Blundell, J. A. C. Bland, 'Polarized neutron reflection as a
          probe of magnetic films and multilayers', Phys. Rev. B, (1992), 46,
          3391.
+    ..[2] L. Nevot, P. Croce, 'Caracterisation des surfaces par reflexion
+         rasante de rayons X. Application a l'etude du polissage de quelques
+         verres silicates', Revue de Physique Appliquee, (1980), 15, 761-779.
     """
     xx = np.asfarray(q).astype(np.complex128).ravel()
 
+    prof = _profiler
+    if prof is not None:
+        prof.add_call("pnr", xx.size, len(layers) - 2)
+
+    reflectivity = np.empty((4, xx.size))
+
+    def calc(chunk):
+        reflectivity[:, chunk] = _pnr_reflectivity(xx[chunk], layers, repeats)
+
+    _map_chunks(calc, xx.size, chunk_size=chunk_size, threads=threads)
+
+    return tuple(reflectivity)
+
+
+def _pnr_reflectivity(xx, layers, repeats=None):
+    """
+    Polarised Neutron Reflectivity of a series of slabs, see `pnr`.
+
+    Parameters
+    ----------
+    xx: np.ndarray
+        1D complex array of Q values.
+    layers: np.ndarray
+        Layer specification, as for `pnr`.
+    repeats: sequence of (int, int, int), optional
+        Repeated blocks of layers, as for `pnr`.
+
+    Returns
+    -------
+    reflectivity: tuple of np.ndarray
+        (PP, MM, PM, MP)
+
+    Notes
+    -----
+    The transfer matrix of each layer, ``D P D^-1 R`` in Blundell and
+    Bland, is never formed as a dense 4x4 matrix. ``D P D^-1`` is block
+    diagonal, with 2x2 blocks ``A = [[cos(kd), -i sin(kd) / k],
+    [-i k sin(kd), cos(kd)]]`` for each spin state, and ``R`` mixes the
+    blocks by ``cos(theta / 2)`` and ``sin(theta / 2)``. The running total
+    is multiplied by those factors in place, so nothing is allocated per
+    layer. If all the magnetic moments are collinear the spin states
+    decouple, and two independent 2x2 calculations are done instead. If
+    there is roughness as well (and no iSLD > 0), each spin state is
+    calculated with `_abeles_reflectance`.
+
+    Rough interfaces can't be written in that form. If any roughness is
+    specified for non-collinear moments the product is instead accumulated
+    as ``I_01 P_1 I_12 P_2 ...``, where ``I_jk = D_j^-1 R D_k`` is the matrix
+    of the interface between layers j and k, and ``P_j`` is the diagonal
+    propagation matrix of layer j. The Nevot-Croce factor is applied to the
+    off-diagonal elements of each 2x2 block of ``I_jk``.
+    """
+    prof = _profiler
+    if prof is not None:
+        start = time.perf_counter()
+
+    nrows = len(layers)
+    blocks = _check_repeats(repeats or [], nrows)
+
     thetas = np.radians(layers[:, 4])
-    thetas = np.diff(thetas)
 
     # nuclear SLD minus that of the superphase
     sld = layers[:, 1] + 1j * layers[:, 2] - layers[0, 1] - 1j * layers[0, 2]
 
-    # nuclear and magnetic
+    # nuclear and magnetic, spin_sld.shape = (2, nrows). The first axis is
+    # the spin state (up, down).
     sldu = sld + layers[:, 3] - layers[0, 3]
     sldd = sld - layers[:, 3] + layers[0, 3]
-    sldu *= 1e-6
-    sldd *= 1e-6
-
-    # wavevector in each layer
-    kn_u = np.sqrt(0.25 * xx[:, np.newaxis] ** 2 - 4 * np.pi * sldu)
-    kn_d = np.sqrt(0.25 * xx[:, np.newaxis] ** 2 - 4 * np.pi * sldd)
-
-    mm = np.zeros((xx.size, 4, 4), np.complex128)
-    mm[:] = np.identity(4, np.complex128)
+    spin_sld = np.stack([sldu, sldd])
+
+    if layers.shape[1] > 5:
+        sigma = layers[:, 5]
+    else:
+        sigma = np.zeros(nrows)
+    rough = np.any(sigma[1:] != 0)
+
+    # The moments are collinear if every one is parallel or antiparallel to
+    # that of the fronting medium, i.e. R is (+/-) the identity or swaps
+    # the spin states. In the frame of the fronting medium the spin states
+    # then decouple; in layers whose moment is antiparallel the up state is
+    # the local down state. The overall signs in R don't affect the
+    # reflectivity.
+    collinear = np.allclose(np.sin(thetas - thetas[0]), 0, rtol=0, atol=1e-12)
+    flipped = np.cos(thetas - thetas[0]) < 0
+
+    if collinear and rough:
+        # Each spin state is an ordinary slab model, with Nevot-Croce
+        # roughness. The imaginary part of the wavevectors has the opposite
+        # sign to that in abeles, an iSLD of -x here is an iSLD of x there.
+        # abeles takes the absolute value of iSLD, so only iSLD <= 0 carries
+        # over, otherwise the 4x4 calculation below is used.
+        local = np.copy(spin_sld)
+        local[:, flipped] = local[::-1, flipped]
+        if np.all(local.imag <= 0):
+            slabs = np.empty((2, nrows, 4))
+            slabs[..., 0] = layers[:, 0]
+            slabs[..., 1] = local.real
+            slabs[..., 2] = -local.imag
+            slabs[..., 3] = sigma
+            flatq = xx.real
+            if blocks:
+                r = [
+                    _abeles_reflectance_repeats(flatq, s, repeats)
+                    for s in slabs
+                ]
+            else:
+                r = [_abeles_reflectance(flatq, s) for s in slabs]
+            pp = _magsqr(r[0])
+            mm = _magsqr(r[1])
+            return (pp, mm, np.zeros_like(pp), np.zeros_like(pp))
+        collinear = False
+
+    # wavevector in each layer, kn.shape = (2, nrows, npnts)
+    kn = np.sqrt(0.25 * xx**2 - 4e-6 * np.pi * spin_sld[..., np.newaxis])
+    if collinear:
+        kn[:, flipped] = kn[::-1, flipped]
+
+    # elements of the 2x2 blocks, A, for each layer.
+    kd = kn[:, 1:-1] * layers[1:-1, 0][:, np.newaxis]
+    a00 = np.cos(kd)
+    a01 = np.sin(kd)
+    a10 = a01 * kn[:, 1:-1]
+    a10 *= -1j
+    a01 /= kn[:, 1:-1]
+    a01 *= -1j
+    # A[1, 1] == A[0, 0]
+
+    if prof is not None:
+        wavevectors = time.perf_counter()
+        prof.add_stage("pnr.wavevectors", wavevectors - start)
+
+    def rotation(j, j_next):
+        # R, rotating from the frame of layer j into that of layer j_next
+        half = 0.5 * (thetas[j_next] - thetas[j])
+        return np.cos(half), np.sin(half)
+
+    if rough:
+        # m.shape = (4, 4, npnts)
+        identity, matmul, matpow = _identity4, _matmul4, _matpow4
+
+        # propagation through a layer scales the columns of m @ P by
+        # exp(-ikd), exp(ikd)
+        phase = np.exp(1j * kd)
+        z = np.empty((4, 4, xx.size), np.complex128)
+        w = np.empty((4, xx.size), np.complex128)
+        t = np.empty((3, xx.size), np.complex128)
+
+        def interface(m, j, j_next):
+            # m @ D_j^-1 R D_j_next. Block (a, b) of the interface matrix is
+            # 0.5 * R_ab * [[1 + f, (1 - f) * e], [(1 - f) * e, 1 + f]], where
+            # f = k_b / k_a and e is the Nevot-Croce factor.
+            c, s = rotation(j, j_next)
+            z[:] = m
+            m[:] = 0
+            for a, b, r_ab in ((0, 0, c), (1, 0, -s), (0, 1, s), (1, 1, c)):
+                if r_ab == 0:
+                    continue
+                ka = kn[a, j]
+                kb = kn[b, j_next]
+                # t[0] = 1 + f, t[1] = (1 - f) * e
+                np.divide(kb, ka, out=t[0])
+                np.multiply(ka, kb, out=t[2])
+                t[2] *= -2 * sigma[j_next] ** 2
+                np.exp(t[2], out=t[2])
+                np.subtract(1, t[0], out=t[1])
+                t[1] *= t[2]
+                t[0] += 1
+                t[:2] *= 0.5 * r_ab
+
+                za0, za1 = z[:, 2 * a], z[:, 2 * a + 1]
+                for col, u, v in (
+                    (2 * b, t[0], t[1]),
+                    (2 * b + 1, t[1], t[0]),
+                ):
+                    np.multiply(za0, u, out=w)
+                    m[:, col] += w
+                    np.multiply(za1, v, out=w)
+                    m[:, col] += w
+            return m
+
+        def layer(m, j, j_next):
+            m[:, 0] /= phase[0, j - 1]
+            m[:, 1] *= phase[0, j - 1]
+            m[:, 2] /= phase[1, j - 1]
+            m[:, 3] *= phase[1, j - 1]
+            return interface(m, j, j_next)
+
+    elif collinear:
+        # Collinear moments, the spin states decouple. Each spin state is a
+        # 2x2 calculation, m.shape = (2, 4, npnts), holding the
+        # (00, 01, 10, 11) elements of the matrix for each spin state.
+        identity, matmul, matpow = _identity2, _matmul2, _matpow2
+        t = np.empty((2, 2, xx.size), np.complex128)
+
+        def layer(m, j, j_next):
+            aa, ab, ba = a00[:, j - 1], a01[:, j - 1], a10[:, j - 1]
+            for row in (0, 2):
+                m0, m1 = m[:, row], m[:, row + 1]
+                np.multiply(m0, aa, out=t[0])
+                np.multiply(m1, ba, out=t[1])
+                t[0] += t[1]
+                np.multiply(m0, ab, out=t[1])
+                m1 *= aa
+                m1 += t[1]
+                m0[:] = t[0]
+            return m
+
+    else:
+        # m.shape = (4, 4, npnts)
+        identity, matmul, matpow = _identity4, _matmul4, _matpow4
+        x = np.empty((4, 2, xx.size), np.complex128)
+        y = np.empty_like(x)
+        w = np.empty_like(x)
+
+        def layer(m, j, j_next):
+            c, s = rotation(j, j_next)
+            for blk, z in ((0, x), (1, y)):
+                aa, ab, ba = a00[blk, j - 1], a01[blk, j - 1], a10[blk, j - 1]
+                m0, m1 = m[:, 2 * blk], m[:, 2 * blk + 1]
+                np.multiply(m0, aa, out=z[:, 0])
+                np.multiply(m1, ba, out=w[:, 0])
+                z[:, 0] += w[:, 0]
+                np.multiply(m0, ab, out=z[:, 1])
+                np.multiply(m1, aa, out=w[:, 1])
+                z[:, 1] += w[:, 1]
+
+            # m @ [[c A_u, s A_u], [-s A_d, c A_d]]
+            np.multiply(x, c, out=m[:, :2])
+            np.multiply(y, s, out=w)
+            m[:, :2] -= w
+            np.multiply(x, s, out=m[:, 2:])
+            np.multiply(y, c, out=w)
+            m[:, 2:] += w
+            return m
 
     # iterate over layers
-    for jj in range(len(layers) - 2):
-        d, d_inv = _dmatrix(kn_u[:, jj + 1], kn_d[:, jj + 1])
-        p = _pmatrix(kn_u[:, jj + 1], kn_d[:, jj + 1], layers[jj + 1, 0])
-        r = _rmatrix(thetas[jj + 1])
-
-        mm = mm @ d @ p @ d_inv @ r
-
-    # d_inv for the first layer
-    _, d_inv = _dmatrix(kn_u[:, 0], kn_d[:, 0])
+    mm = identity(xx.size)
+    if rough:
+        mm = interface(mm, 0, 1)
+    jj = 1
+    while jj < nrows - 1:
+        if jj in blocks:
+            stop, n = blocks[jj]
+            inner = identity(xx.size)
+            for k in range(jj, stop - 1):
+                inner = layer(inner, k, k + 1)
+
+            # every repeat apart from the last returns to the first layer of
+            # the block, the last one continues on to the following layer.
+            unit = layer(np.copy(inner), stop - 1, jj)
+            inner = layer(inner, stop - 1, stop)
+            mm = matmul(matmul(mm, matpow(unit, n - 1)), inner)
+            jj = stop
+        else:
+            mm = layer(mm, jj, jj + 1)
+            jj += 1
+
+    if mm.shape[0] == 2:
+        # collinear, the first column of D_0^-1 mm D_N for each spin state
+        v0 = mm[:, 0] + mm[:, 1] * kn[:, -1]
+        v1 = mm[:, 2] + mm[:, 3] * kn[:, -1]
+        v0 *= kn[:, 0]
+        r = (v0 - v1) / (v0 + v1)
+        pp, mm = _magsqr(r)
+        pm = np.zeros_like(pp)
+        mp = np.zeros_like(pp)
+    else:
+        if rough:
+            # the interface matrices already include D_0^-1 and D_N
+            M = np.moveaxis(mm, -1, 0)
+        else:
+            # d_inv for the first layer
+            _, d_inv = _dmatrix(kn[0, 0], kn[1, 0])
 
-    # d for the last layer
-    d, _ = _dmatrix(kn_u[:, -1], kn_d[:, -1])
-    r = _rmatrix(thetas[0])
+            # d for the last layer
+            d, _ = _dmatrix(kn[0, -1], kn[1, -1])
+            r = _rmatrix(thetas[1] - thetas[0])
 
-    M = d_inv @ r @ mm @ d
+            M = d_inv @ r @ np.moveaxis(mm, -1, 0) @ d
 
-    # equation 16 in Blundell and Bland
-    den = M[:, 0, 0] * M[:, 2, 2] - M[:, 0, 2] * M[:, 2, 0]
-    # uu
-    pp = _magsqr((M[:, 1, 0] * M[:, 2, 2] - M[:, 1, 2] * M[:, 2, 0]) / den)
+        # equation 16 in Blundell and Bland
+        den = M[:, 0, 0] * M[:, 2, 2] - M[:, 0, 2] * M[:, 2, 0]
+        # uu
+        pp = _magsqr((M[:, 1, 0] * M[:, 2, 2] - M[:, 1, 2] * M[:, 2, 0]) / den)
 
-    # dd
-    mm = _magsqr((M[:, 3, 2] * M[:, 0, 0] - M[:, 3, 0] * M[:, 0, 2]) / den)
+        # dd
+        mm = _magsqr((M[:, 3, 2] * M[:, 0, 0] - M[:, 3, 0] * M[:, 0, 2]) / den)
 
-    # ud
-    pm = _magsqr((M[:, 3, 0] * M[:, 2, 2] - M[:, 3, 2] * M[:, 2, 0]) / den)
+        # ud
+        pm = _magsqr((M[:, 3, 0] * M[:, 2, 2] - M[:, 3, 2] * M[:, 2, 0]) / den)
 
-    # du
-    mp = _magsqr((M[:, 1, 2] * M[:, 0, 0] - M[:, 1, 0] * M[:, 0, 2]) / den)
+        # du
+        mp = _magsqr((M[:, 1, 2] * M[:, 0, 0] - M[:, 1, 0] * M[:, 0, 2]) / den)
 
+    if prof is not None:
+        prof.add_stage("pnr.propagation", time.perf_counter() - wavevectors)
     return (pp, mm, pm, mp)
 
 
@@ -43,13 +43,16 @@ However, the following remains the fastest calculation  so far.
 #include "complex.h"
 #include "tgmath.h"
 #include "string.h"
+#include "float.h"
 
-#define NUM_CPUS 4
 #define PI 3.14159265358979323846
 // TINY is required to make sure a complex sqrt takes the correct branch
 // if you choose too small a number for tiny then the complex square root
 // takes a lot longer.
 #define TINY 1e-30
+// TINY is too small for single precision, products of the imaginary parts it
+// creates are subnormal floats, which are very slow.
+#define TINY32 1e-12
 
 #ifdef __cplusplus
 extern "C" {
@@ -205,6 +208,602 @@ void AbelesCalc_ImagAll(int numcoefs,
             free(rough_sqr);
     }
 
+
+/*
+Number of Q points calculated together by AbelesCalc_Blocked. The work arrays
+for a block live on the stack.
+*/
+#define BLOCK_SIZE 64
+
+/*
+AbelesCalc_Blocked calculates the same reflectivity as AbelesCalc_ImagAll, but
+for a block of Q points at a time. The complex numbers are held as separate
+arrays of real and imaginary parts (struct of arrays), so that the loops over
+the Q points in a block are simple enough for the compiler to vectorise, and
+no memory is allocated.
+*/
+void AbelesCalc_Blocked(int numcoefs,
+                        const double* restrict coefP,
+                        int npoints,
+                        double* restrict yP,
+                        const double* restrict xP){
+    int nlayers = (int) coefP[0];
+    double scale = coefP[1];
+    double bkg = coefP[6];
+    double super = coefP[2];
+
+    // wavevector in the current layer
+    double kr[BLOCK_SIZE], ki[BLOCK_SIZE];
+    // wavevector in the next layer
+    double nr[BLOCK_SIZE], ni[BLOCK_SIZE];
+    // reflectance of the interface, and phase factor of the layer
+    double rr[BLOCK_SIZE], ri[BLOCK_SIZE];
+    double br[BLOCK_SIZE], bi[BLOCK_SIZE];
+    // the total characteristic matrix
+    double m00r[BLOCK_SIZE], m00i[BLOCK_SIZE], m01r[BLOCK_SIZE];
+    double m01i[BLOCK_SIZE], m10r[BLOCK_SIZE], m10i[BLOCK_SIZE];
+    double m11r[BLOCK_SIZE], m11i[BLOCK_SIZE];
+
+    for(int first = 0; first < npoints; first += BLOCK_SIZE){
+        int nb = npoints - first < BLOCK_SIZE ? npoints - first : BLOCK_SIZE;
+        const double *x = xP + first;
+
+        for(int j = 0; j < nb; j++){
+            kr[j] = x[j] / 2;
+            ki[j] = 0;
+        }
+
+        for(int ii = 0; ii < nlayers + 1; ii++){
+            double sld_r, sld_i, rough_sqr;
+            if(ii < nlayers){
+                sld_r = 4e-6 * PI * (coefP[4 * ii + 9] - super);
+                sld_i = 4e-6 * PI * (fabs(coefP[4 * ii + 10]) + TINY);
+                rough_sqr = -2 * coefP[4 * ii + 11] * coefP[4 * ii + 11];
+            } else {
+                sld_r = 4e-6 * PI * (coefP[4] - super);
+                sld_i = 4e-6 * PI * (fabs(coefP[5]) + TINY);
+                rough_sqr = -2 * coefP[7] * coefP[7];
+            }
+
+            // wavevector in the next layer, kn_next = sqrt(x**2 / 4 - SLD).
+            // The principal square root is taken, the real part of a + ib
+            // is calculated as |b| / 2t when a < 0 to avoid cancellation.
+            for(int j = 0; j < nb; j++){
+                double a = x[j] * x[j] / 4 - sld_r;
+                double b = -sld_i;
+                double t = sqrt((fabs(a) + sqrt(a * a + b * b)) / 2);
+                nr[j] = a >= 0 ? t : fabs(b) / (2 * t);
+                ni[j] = a >= 0 ? b / (2 * t) : copysign(t, b);
+            }
+
+            // reflectance of the interface, (kn - kn_next) / (kn + kn_next)
+            for(int j = 0; j < nb; j++){
+                double numr = kr[j] - nr[j], numi = ki[j] - ni[j];
+                double denr = kr[j] + nr[j], deni = ki[j] + ni[j];
+                double den = denr * denr + deni * deni;
+                rr[j] = (numr * denr + numi * deni) / den;
+                ri[j] = (numi * denr - numr * deni) / den;
+            }
+
+            // Nevot-Croce roughness, exp(kn * kn_next * rough_sqr)
+            if(rough_sqr != 0){
+                for(int j = 0; j < nb; j++){
+                    double er = (kr[j] * nr[j] - ki[j] * ni[j]) * rough_sqr;
+                    double ei = (kr[j] * ni[j] + ki[j] * nr[j]) * rough_sqr;
+                    double mag = exp(er);
+                    double c = mag * cos(ei), s = mag * sin(ei);
+                    double t = rr[j] * c - ri[j] * s;
+                    ri[j] = rr[j] * s + ri[j] * c;
+                    rr[j] = t;
+                }
+            }
+
+            if(!ii){
+                // characteristic matrix for the first interface
+                for(int j = 0; j < nb; j++){
+                    m00r[j] = 1;
+                    m00i[j] = 0;
+                    m11r[j] = 1;
+                    m11i[j] = 0;
+                    m01r[j] = m10r[j] = rr[j];
+                    m01i[j] = m10i[j] = ri[j];
+                }
+            } else {
+                // phase factor of the layer, beta = exp(i kn d)
+                double thickness = fabs(coefP[4 * ii + 4]);
+                for(int j = 0; j < nb; j++){
+                    double mag = exp(-ki[j] * thickness);
+                    br[j] = mag * cos(kr[j] * thickness);
+                    bi[j] = mag * sin(kr[j] * thickness);
+                }
+
+                /*
+                The characteristic matrix of the layer is
+                MI = [[beta, rj * beta], [rj / beta, 1 / beta]]. The total
+                matrix is multiplied by it, using
+                M[row][0] * beta + M[row][1] * rj / beta and
+                M[row][0] * rj * beta + M[row][1] / beta.
+                */
+                for(int j = 0; j < nb; j++){
+                    double inv = 1 / (br[j] * br[j] + bi[j] * bi[j]);
+                    double ibr = br[j] * inv, ibi = -bi[j] * inv;
+                    // rj * beta and rj / beta
+                    double rbr = rr[j] * br[j] - ri[j] * bi[j];
+                    double rbi = rr[j] * bi[j] + ri[j] * br[j];
+                    double rir = rr[j] * ibr - ri[j] * ibi;
+                    double rii = rr[j] * ibi + ri[j] * ibr;
+                    double ar, ai, cr, ci;
+
+                    ar = m00r[j], ai = m00i[j], cr = m01r[j], ci = m01i[j];
+                    m00r[j] = ar * br[j] - ai * bi[j] + cr * rir - ci * rii;
+                    m00i[j] = ar * bi[j] + ai * br[j] + cr * rii + ci * rir;
+                    m01r[j] = ar * rbr - ai * rbi + cr * ibr - ci * ibi;
+                    m01i[j] = ar * rbi + ai * rbr + cr * ibi + ci * ibr;
+
+                    ar = m10r[j], ai = m10i[j], cr = m11r[j], ci = m11i[j];
+                    m10r[j] = ar * br[j] - ai * bi[j] + cr * rir - ci * rii;
+                    m10i[j] = ar * bi[j] + ai * br[j] + cr * rii + ci * rir;
+                    m11r[j] = ar * rbr - ai * rbi + cr * ibr - ci * ibi;
+                    m11i[j] = ar * rbi + ai * rbr + cr * ibi + ci * ibr;
+                }
+            }
+
+            for(int j = 0; j < nb; j++){
+                kr[j] = nr[j];
+                ki[j] = ni[j];
+            }
+        }
+
+        for(int j = 0; j < nb; j++){
+            double num = m10r[j] * m10r[j] + m10i[j] * m10i[j];
+            double den = m00r[j] * m00r[j] + m00i[j] * m00i[j];
+            yP[first + j] = num / den * scale + bkg;
+        }
+    }
+}
+
+
+void AbelesCalc_Jacobian(int numcoefs,
+                         const double* restrict coefP,
+                         int npoints,
+                         double* restrict yP,
+                         double* restrict jacP,
+                         const double* restrict xP){
+    int j, ii;
+    double scale, bkg;
+    double refl, sign;
+    int nlayers = (int) coefP[0];
+
+    double complex super;
+    double complex _t;
+    double complex oneC = CMPLX(1., 0.);
+    double complex iC = CMPLX(0., 1.);
+    double complex qq2;
+    double complex r, t00, t10, u0, u1, nu0, nu1;
+    double complex ka, kb, ksum, drr, drb, dk_dsld;
+    _Complex double *SLD = NULL;
+    _Complex double *kn = NULL;
+    _Complex double *rj = NULL;
+    _Complex double *rough = NULL;
+    _Complex double *beta = NULL;
+    _Complex double *s0 = NULL;
+    _Complex double *s1 = NULL;
+    _Complex double *dr_dk = NULL;
+    _Complex double *dr_dp = NULL;
+    double *thickness = NULL;
+    double *sigma = NULL;
+    double *isign = NULL;
+
+    SLD = (_Complex double *) malloc ((nlayers + 2) * sizeof(_Complex double));
+    kn = (_Complex double *) malloc ((nlayers + 2) * sizeof(_Complex double));
+    dr_dk = (_Complex double *) malloc ((nlayers + 2) * sizeof(_Complex double));
+    rj = (_Complex double *) malloc ((nlayers + 1) * sizeof(_Complex double));
+    rough = (_Complex double *) malloc ((nlayers + 1) * sizeof(_Complex double));
+    beta = (_Complex double *) malloc ((nlayers + 1) * sizeof(_Complex double));
+    s0 = (_Complex double *) malloc ((nlayers + 1) * sizeof(_Complex double));
+    s1 = (_Complex double *) malloc ((nlayers + 1) * sizeof(_Complex double));
+    dr_dp = (_Complex double *) malloc (numcoefs * sizeof(_Complex double));
+    thickness = (double *) malloc ((nlayers + 1) * sizeof(double));
+    sigma = (double *) malloc ((nlayers + 1) * sizeof(double));
+    isign = (double *) malloc ((nlayers + 2) * sizeof(double));
+    if (!SLD || !kn || !dr_dk || !rj || !rough || !beta || !s0 || !s1
+        || !dr_dp || !thickness || !sigma || !isign)
+        goto done;
+
+    scale = coefP[1];
+    bkg = coefP[6];
+    super = CMPLX(coefP[2], 0);
+
+    // fill out all the SLD's for all the layers. sigma[ii] is the roughness
+    // of the interface between layer ii and ii + 1, where layer 0 is the
+    // fronting medium.
+    for(ii = 1; ii < nlayers + 1; ii += 1){
+        _t = CMPLX(coefP[4 * ii + 5], fabs(coefP[4 * ii + 6]) + TINY);
+        SLD[ii] = 4e-6 * PI * (_t - super);
+        isign[ii] = coefP[4 * ii + 6] < 0 ? -1 : 1;
+
+        thickness[ii] = fabs(coefP[4 * ii + 4]);
+        sigma[ii - 1] = coefP[4 * ii + 7];
+    }
+
+    SLD[0] = CMPLX(0, 0);
+    _t = CMPLX(coefP[4], fabs(coefP[5]) + TINY);
+    SLD[nlayers + 1] = 4e-6 * PI * (_t - super);
+    isign[nlayers + 1] = coefP[5] < 0 ? -1 : 1;
+    sigma[nlayers] = coefP[7];
+
+    for (j = 0; j < npoints; j++) {
+        qq2 = CMPLX(xP[j] * xP[j] / 4, 0);
+
+        // wavevectors, reflectances and phase factors
+        kn[0] = xP[j] / 2.;
+        for(ii = 0; ii < nlayers + 1; ii++){
+            kn[ii + 1] = csqrt(qq2 - SLD[ii + 1]);
+            ka = kn[ii];
+            kb = kn[ii + 1];
+            rough[ii] = cexp(-2 * ka * kb * sigma[ii] * sigma[ii]);
+            rj[ii] = (ka - kb) / (ka + kb) * rough[ii];
+            beta[ii] = ii ? cexp(iC * ka * thickness[ii]) : oneC;
+        }
+
+        // backward sweep, s = M_ii+1 ... M_N (1, 0)
+        s0[nlayers] = oneC;
+        s1[nlayers] = 0;
+        for(ii = nlayers; ii > 0; ii--){
+            s0[ii - 1] = beta[ii] * (s0[ii] + rj[ii] * s1[ii]);
+            s1[ii - 1] = (rj[ii] * s0[ii] + s1[ii]) / beta[ii];
+        }
+
+        t00 = s0[0] + rj[0] * s1[0];
+        t10 = rj[0] * s0[0] + s1[0];
+        r = t10 / t00;
+
+        refl = cabs(r);
+        refl *= refl;
+        yP[j] = refl * scale + bkg;
+
+        // forward sweep, u = w M_0 ... M_ii-1, with w = (-t10, t00) / t00**2
+        u0 = -r / t00;
+        u1 = oneC / t00;
+        memset(dr_dk, 0, (nlayers + 2) * sizeof(_Complex double));
+        memset(dr_dp, 0, numcoefs * sizeof(_Complex double));
+
+        for(ii = 0; ii < nlayers + 1; ii++){
+            ka = kn[ii];
+            kb = kn[ii + 1];
+            ksum = ka + kb;
+
+            // derivative of r with respect to rj
+            drr = u0 * beta[ii] * s1[ii] + u1 * s0[ii] / beta[ii];
+            dr_dk[ii] += drr * (2 * kb / (ksum * ksum) * rough[ii]
+                                - 2 * kb * sigma[ii] * sigma[ii] * rj[ii]);
+            dr_dk[ii + 1] += drr * (-2 * ka / (ksum * ksum) * rough[ii]
+                                    - 2 * ka * sigma[ii] * sigma[ii] * rj[ii]);
+            dr_dp[ii < nlayers ? 4 * ii + 11 : 7] =
+                drr * -4 * ka * kb * sigma[ii] * rj[ii];
+
+            if (ii){
+                // derivative of r with respect to beta
+                drb = u0 * (s0[ii] + rj[ii] * s1[ii])
+                      - u1 * (rj[ii] * s0[ii] + s1[ii]) / (beta[ii] * beta[ii]);
+                dr_dk[ii] += drb * iC * thickness[ii] * beta[ii];
+                sign = coefP[4 * ii + 4] < 0 ? -1 : 1;
+                dr_dp[4 * ii + 4] = drb * iC * ka * beta[ii] * sign;
+            }
+
+            nu0 = u0 * beta[ii] + u1 * rj[ii] / beta[ii];
+            nu1 = u0 * rj[ii] * beta[ii] + u1 / beta[ii];
+            u0 = nu0;
+            u1 = nu1;
+        }
+
+        // SLD and iSLD. The fronting SLD is subtracted from all the others.
+        for(ii = 1; ii < nlayers + 2; ii++){
+            dk_dsld = -2e-6 * PI / kn[ii];
+            _t = dr_dk[ii] * dk_dsld;
+            dr_dp[ii < nlayers + 1 ? 4 * ii + 5 : 4] = _t;
+            dr_dp[2] -= _t;
+            dr_dp[ii < nlayers + 1 ? 4 * ii + 6 : 5] =
+                _t * iC * isign[ii];
+        }
+
+        // dR/dp = 2 Re(conj(r) dr/dp)
+        for(ii = 0; ii < numcoefs; ii++)
+            jacP[ii * npoints + j] = 2 * scale * creal(conj(r) * dr_dp[ii]);
+        jacP[npoints + j] = refl;
+        jacP[6 * npoints + j] = 1;
+    }
+
+    done:
+        if(SLD)
+            free(SLD);
+        if(kn)
+            free(kn);
+        if(dr_dk)
+            free(dr_dk);
+        if(rj)
+            free(rj);
+        if(rough)
+            free(rough);
+        if(beta)
+            free(beta);
+        if(s0)
+            free(s0);
+        if(s1)
+            free(s1);
+        if(dr_dp)
+            free(dr_dp);
+        if(thickness)
+            free(thickness);
+        if(sigma)
+            free(sigma);
+        if(isign)
+            free(isign);
+    }
+
+
+/*
+One row of the product of the absolute values of the characteristic matrices,
+A' = A |M|, and the squared relative errors of its elements, for
+AbelesCalc_Single. Each term of a sum contributes its share of the sum to the
+relative error. The contributions of different layers are independent, so
+they're added in quadrature. The last term is the rounding error.
+*/
+static inline void
+rss_row(float* restrict v0, float* restrict v1,
+        float* restrict a0, float* restrict a1,
+        float b00, float b01, float b10, float b11,
+        float d2beta, float d2rj){
+    const float eps2 = 4 * FLT_EPSILON * FLT_EPSILON;
+    float p0, p1, n0, n1, inv, f0, f1;
+
+    p0 = *a0 * b00;
+    p1 = *a1 * b10;
+    n0 = p0 + p1;
+    inv = 1 / (n0 + FLT_MIN);
+    p0 *= inv;
+    p1 *= inv;
+    f0 = p0 * p0 * (*v0 + d2beta) + p1 * p1 * (*v1 + d2rj) + eps2;
+
+    p0 = *a0 * b01;
+    p1 = *a1 * b11;
+    n1 = p0 + p1;
+    inv = 1 / (n1 + FLT_MIN);
+    p0 *= inv;
+    p1 *= inv;
+    f1 = p0 * p0 * (*v0 + d2rj) + p1 * p1 * (*v1 + d2beta) + eps2;
+
+    *v0 = f0;
+    *v1 = f1;
+    *a0 = n0;
+    *a1 = n1;
+}
+
+
+/*
+AbelesCalc_Single is a float version of AbelesCalc_Blocked. Alongside the
+characteristic matrix it accumulates the product of the absolute values of
+the layer matrices, a00..a11, and the squared relative error of each of its
+elements, v00..v11 (see _abeles_reflectance_fast in _reflect.py).
+*/
+void AbelesCalc_Single(int numcoefs,
+                       const double* restrict coefP,
+                       int npoints,
+                       double* restrict yP,
+                       double* restrict errP,
+                       const double* restrict xP){
+    int nlayers = (int) coefP[0];
+    double scale = coefP[1];
+    double bkg = coefP[6];
+    double super = coefP[2];
+    const float eps = FLT_EPSILON;
+
+    // Q**2 / 4
+    float qq[BLOCK_SIZE];
+    // wavevector in the current layer, its modulus and absolute error
+    float kr[BLOCK_SIZE], ki[BLOCK_SIZE], km[BLOCK_SIZE], dk[BLOCK_SIZE];
+    // wavevector in the next layer, its modulus and absolute error
+    float nr[BLOCK_SIZE], ni[BLOCK_SIZE], nm[BLOCK_SIZE], dn[BLOCK_SIZE];
+    // reflectance of the interface, its modulus and relative error
+    float rr[BLOCK_SIZE], ri[BLOCK_SIZE], rm[BLOCK_SIZE], dr[BLOCK_SIZE];
+    // |beta|, and the cosine and sine of the phase of the layer
+    float bm[BLOCK_SIZE], bc[BLOCK_SIZE], bs[BLOCK_SIZE];
+    // the total characteristic matrix
+    float m00r[BLOCK_SIZE], m00i[BLOCK_SIZE], m01r[BLOCK_SIZE];
+    float m01i[BLOCK_SIZE], m10r[BLOCK_SIZE], m10i[BLOCK_SIZE];
+    float m11r[BLOCK_SIZE], m11i[BLOCK_SIZE];
+    // product of the absolute values, and its squared relative error
+    float a00[BLOCK_SIZE], a01[BLOCK_SIZE], a10[BLOCK_SIZE], a11[BLOCK_SIZE];
+    float v00[BLOCK_SIZE], v01[BLOCK_SIZE], v10[BLOCK_SIZE], v11[BLOCK_SIZE];
+
+    for(int first = 0; first < npoints; first += BLOCK_SIZE){
+        int nb = npoints - first < BLOCK_SIZE ? npoints - first : BLOCK_SIZE;
+        const double *x = xP + first;
+        // SLD of the current layer, in double precision
+        double prev_r = 0, prev_i = 0;
+
+        /*
+        The loops run over whole blocks, a fixed trip count is easier for the
+        compiler to vectorise. The last block is padded with its last point.
+        */
+        for(int j = 0; j < BLOCK_SIZE; j++){
+            double xj = x[j < nb ? j : nb - 1];
+            qq[j] = (float) (xj * xj / 4);
+            kr[j] = (float) (xj / 2);
+            ki[j] = 0;
+            km[j] = fabsf(kr[j]);
+            dk[j] = 1.5f * eps * km[j];
+        }
+
+        for(int ii = 0; ii < nlayers + 1; ii++){
+            double sld_r, sld_i;
+            float rough_sqr, dsld_r, dsld_i, dsld_m, abs_sld;
+            if(ii < nlayers){
+                sld_r = 4e-6 * PI * (coefP[4 * ii + 9] - super);
+                sld_i = 4e-6 * PI * (fabs(coefP[4 * ii + 10]) + TINY32);
+                rough_sqr = (float) (-2 * coefP[4 * ii + 11]
+                                     * coefP[4 * ii + 11]);
+            } else {
+                sld_r = 4e-6 * PI * (coefP[4] - super);
+                sld_i = 4e-6 * PI * (fabs(coefP[5]) + TINY32);
+                rough_sqr = (float) (-2 * coefP[7] * coefP[7]);
+            }
+            // contrast of the interface, taken before rounding to float
+            dsld_r = (float) (sld_r - prev_r);
+            dsld_i = (float) (sld_i - prev_i);
+            dsld_m = sqrtf(dsld_r * dsld_r + dsld_i * dsld_i);
+            abs_sld = (float) sqrt(sld_r * sld_r + sld_i * sld_i);
+            prev_r = sld_r;
+            prev_i = sld_i;
+
+            // wavevector in the next layer, kn_next = sqrt(x**2 / 4 - SLD),
+            // and its absolute error from the rounding of the argument to
+            // sqrt and of the sqrt itself. b is never zero, because of
+            // TINY32, so neither is t.
+            for(int j = 0; j < BLOCK_SIZE; j++){
+                float a = qq[j] - (float) sld_r;
+                float b = -(float) sld_i;
+                float mod = sqrtf(a * a + b * b);
+                float t = sqrtf((fabsf(a) + mod) / 2);
+                float h = b / (2 * t);
+                nr[j] = a >= 0 ? t : fabsf(h);
+                ni[j] = a >= 0 ? h : copysignf(t, b);
+                // |kn_next| = sqrt(|x**2 / 4 - SLD|)
+                nm[j] = sqrtf(mod);
+                dn[j] = 0.5f * eps * (qq[j] + abs_sld) / nm[j] + eps * nm[j];
+            }
+
+            /*
+            reflectance of the interface,
+            (kn - kn_next) / (kn + kn_next) == dsld / (kn + kn_next)**2,
+            which doesn't lose precision to cancellation when the contrast
+            is low. Then its relative error.
+            */
+            for(int j = 0; j < BLOCK_SIZE; j++){
+                float sr = kr[j] + nr[j], si = ki[j] + ni[j];
+                float s2r = sr * sr - si * si, s2i = 2 * sr * si;
+                float den = s2r * s2r + s2i * s2i;
+                float smod = sqrtf(sr * sr + si * si);
+                rr[j] = (dsld_r * s2r + dsld_i * s2i) / den;
+                ri[j] = (dsld_i * s2r - dsld_r * s2i) / den;
+                rm[j] = dsld_m / (sr * sr + si * si);
+                dr[j] = 2 * (dk[j] + dn[j]) / smod
+                        - rough_sqr * (dk[j] * nm[j] + dn[j] * km[j])
+                        + 6 * eps;
+            }
+
+            // Nevot-Croce roughness, exp(kn * kn_next * rough_sqr)
+            if(rough_sqr != 0){
+                for(int j = 0; j < BLOCK_SIZE; j++){
+                    float er = (kr[j] * nr[j] - ki[j] * ni[j]) * rough_sqr;
+                    float ei = (kr[j] * ni[j] + ki[j] * nr[j]) * rough_sqr;
+                    float mag = expf(er);
+                    float c = mag * cosf(ei), s = mag * sinf(ei);
+                    float t = rr[j] * c - ri[j] * s;
+                    ri[j] = rr[j] * s + ri[j] * c;
+                    rr[j] = t;
+                    rm[j] *= mag;
+                }
+            }
+
+            if(!ii){
+                // characteristic matrix for the first interface
+                for(int j = 0; j < BLOCK_SIZE; j++){
+                    m00r[j] = 1;
+                    m00i[j] = 0;
+                    m11r[j] = 1;
+                    m11i[j] = 0;
+                    m01r[j] = m10r[j] = rr[j];
+                    m01i[j] = m10i[j] = ri[j];
+
+                    a00[j] = a11[j] = 1;
+                    a01[j] = a10[j] = rm[j];
+                    v00[j] = v11[j] = 0;
+                    v01[j] = v10[j] = dr[j] * dr[j];
+                }
+            } else {
+                // phase factor of the layer, beta = exp(i kn d)
+                float thickness = (float) fabs(coefP[4 * ii + 4]);
+                for(int j = 0; j < BLOCK_SIZE; j++){
+                    bm[j] = expf(-ki[j] * thickness);
+                    bc[j] = cosf(kr[j] * thickness);
+                    bs[j] = sinf(kr[j] * thickness);
+                }
+
+                /*
+                The characteristic matrix of the layer is
+                MI = [[beta, rj * beta], [rj / beta, 1 / beta]], as in
+                AbelesCalc_Blocked. 1 / beta is calculated from the phase,
+                |beta|**2 can overflow a float.
+                */
+                for(int j = 0; j < BLOCK_SIZE; j++){
+                    float br = bm[j] * bc[j], bi = bm[j] * bs[j];
+                    float binv = 1 / bm[j];
+                    float ibr = binv * bc[j], ibi = -binv * bs[j];
+                    // rj * beta and rj / beta
+                    float rbr = rr[j] * br - ri[j] * bi;
+                    float rbi = rr[j] * bi + ri[j] * br;
+                    float rir = rr[j] * ibr - ri[j] * ibi;
+                    float rii = rr[j] * ibi + ri[j] * ibr;
+                    // squared relative errors of beta and rj * beta
+                    float dphase = dk[j] * thickness + 2 * eps;
+                    float d2beta = dphase * dphase;
+                    float d2rj = (dr[j] + dphase) * (dr[j] + dphase);
+                    float ar, ai, cr, ci;
+
+                    ar = m00r[j], ai = m00i[j], cr = m01r[j], ci = m01i[j];
+                    m00r[j] = ar * br - ai * bi + cr * rir - ci * rii;
+                    m00i[j] = ar * bi + ai * br + cr * rii + ci * rir;
+                    m01r[j] = ar * rbr - ai * rbi + cr * ibr - ci * ibi;
+                    m01i[j] = ar * rbi + ai * rbr + cr * ibi + ci * ibr;
+
+                    ar = m10r[j], ai = m10i[j], cr = m11r[j], ci = m11i[j];
+                    m10r[j] = ar * br - ai * bi + cr * rir - ci * rii;
+                    m10i[j] = ar * bi + ai * br + cr * rii + ci * rir;
+                    m11r[j] = ar * rbr - ai * rbi + cr * ibr - ci * ibi;
+                    m11i[j] = ar * rbi + ai * rbr + cr * ibi + ci * ibr;
+
+                    rss_row(&v00[j], &v01[j], &a00[j], &a01[j],
+                            bm[j], rm[j] * bm[j], rm[j] * binv, binv,
+                            d2beta, d2rj);
+                    rss_row(&v10[j], &v11[j], &a10[j], &a11[j],
+                            bm[j], rm[j] * bm[j], rm[j] * binv, binv,
+                            d2beta, d2rj);
+                }
+            }
+
+            for(int j = 0; j < BLOCK_SIZE; j++){
+                kr[j] = nr[j];
+                ki[j] = ni[j];
+                km[j] = nm[j];
+                dk[j] = dn[j];
+            }
+        }
+
+        for(int j = 0; j < nb; j++){
+            double num = (double) m10r[j] * m10r[j]
+                         + (double) m10i[j] * m10i[j];
+            double den = (double) m00r[j] * m00r[j]
+                         + (double) m00i[j] * m00i[j];
+            double answer = num / den * scale;
+            // relative error of r, doubled for |r|**2
+            double err = 2 * (sqrt(v10[j] * (double) a10[j] * a10[j] / num)
+                              + sqrt(v00[j] * (double) a00[j] * a00[j] / den)
+                              + eps);
+
+            // the background is exact, it dilutes the relative error
+            err *= answer;
+            answer += bkg;
+            err /= fabs(answer);
+            if (!isfinite(answer) || !isfinite(err))
+                err = INFINITY;
+
+            yP[first + j] = answer;
+            errP[first + j] = err;
+        }
+    }
+}
+
 #ifdef __cplusplus
     }
 #endif
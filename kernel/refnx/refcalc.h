@@ -79,6 +79,31 @@ DEALINGS IN THIS SOFTWARE.
     coefP[4 * M + 10] - SLD of layer M, imaginary part (10**-6 Å**-2)
 
     coefP[4 * M + 11] - roughness between layer M - 1 / M (Å)
+
+    AbelesCalc_Jacobian calculates the same reflectivity as AbelesCalc_ImagAll,
+    as well as its derivative with respect to every entry of coefP. The
+    derivatives are analytic, from one backward and one forward sweep over the
+    characteristic matrices of each Q point.
+
+    jacP - this user supplied array is filled with the derivatives. It must be
+    numcoefs * npoints long. jacP[k * npoints + j] is the derivative of yP[j]
+    with respect to coefP[k]. Entries that don't affect the reflectivity
+    (coefP[0] and coefP[3]) are zero.
+
+    AbelesCalc_Single is a single precision version of AbelesCalc_Blocked. The
+    calculation is done with float numbers, and yP is only accurate to single
+    precision.
+
+    errP - this user supplied array is filled with an estimate of the relative
+    error of each value in yP. It is a first order estimate, accumulated
+    alongside the matrix product with the errors of each layer added in
+    quadrature, and is INFINITY if the calculation overflowed. It must be
+    npoints long.
+
+    AbelesCalc_Blocked has the same arguments and result as AbelesCalc_ImagAll.
+    It calculates blocks of Q points together, with the real and imaginary
+    parts in separate arrays, so that the compiler can vectorise the loops.
+    It doesn't allocate any memory.
 */
 
 
@@ -91,4 +116,24 @@ void AbelesCalc_ImagAll(int numcoefs,
                         double *yP,
                         const double *xP);
 
+void AbelesCalc_Blocked(int numcoefs,
+                        const double *coefP,
+                        int npoints,
+                        double *yP,
+                        const double *xP);
+
+void AbelesCalc_Jacobian(int numcoefs,
+                         const double *coefP,
+                         int npoints,
+                         double *yP,
+                         double *jacP,
+                         const double *xP);
+
+void AbelesCalc_Single(int numcoefs,
+                       const double *coefP,
+                       int npoints,
+                       double *yP,
+                       double *errP,
+                       const double *xP);
+
 #endif
@@ -34,59 +34,240 @@ extern "C" {
 #include <math.h>
 #include <cmath>
 #include <stdlib.h>
+#include <algorithm>
+#include <condition_variable>
+#include <functional>
+#include <mutex>
 #include <thread>
 #include <vector>
 
+#ifdef _WIN32
+    #include <process.h>
+    #define getpid _getpid
+#else
+    #include <unistd.h>
+#endif
+
 
-#define NUM_CPUS 4
 using namespace std;
 
 
+/*
+The smallest amount of work, in Q points * interfaces, that's worth handing
+to another thread. Each point/interface takes ~100 ns, so this is a few
+hundred microseconds, much longer than it takes to wake a pooled thread.
+*/
+#define MIN_WORK_PER_TASK 4096
+
+
+/*
+A pool of worker threads that lives for the lifetime of the process, so that
+each calculation doesn't pay for creating and joining threads.
+parallel_for(ntasks, workers, task) calls task(0) ... task(ntasks - 1),
+using at most `workers` threads, one of which is the calling thread.
+*/
+class ThreadPool {
+    public:
+        ThreadPool() : job(NULL), njobs(0), next(0), tickets(0), active(0),
+                       generation(0) {}
+
+        void parallel_for(int ntasks, int workers,
+                          const std::function<void(int)> &task){
+            workers = std::min(workers, ntasks);
+
+            // Only one calculation uses the pool at a time. If it's busy
+            // (calls from several Python threads) then calculate serially
+            // rather than oversubscribing the CPUs.
+            std::unique_lock<std::mutex> call_lock(call_mutex,
+                                                   std::try_to_lock);
+            if(workers < 2 || !call_lock.owns_lock()){
+                for(int ii = 0; ii < ntasks; ii++){
+                    task(ii);
+                }
+                return;
+            }
+
+            std::unique_lock<std::mutex> lock(mutex);
+            while((int) threads.size() < workers - 1){
+                threads.emplace_back(&ThreadPool::worker_loop, this);
+            }
+            job = &task;
+            njobs = ntasks;
+            next = 0;
+            tickets = workers - 1;
+            generation++;
+            lock.unlock();
+            start_cv.notify_all();
+
+            run_tasks(task);
+
+            // stop threads that haven't woken up yet from joining in, then
+            // wait for the ones that did.
+            lock.lock();
+            tickets = 0;
+            done_cv.wait(lock, [this]{return active == 0;});
+            job = NULL;
+        }
+
+    private:
+        // claims tasks until they've all been taken
+        void run_tasks(const std::function<void(int)> &task){
+            for(;;){
+                int ii;
+                {
+                    std::lock_guard<std::mutex> lock(mutex);
+                    ii = next++;
+                }
+                if(ii >= njobs){
+                    return;
+                }
+                task(ii);
+            }
+        }
+
+        void worker_loop(){
+            unsigned long seen = 0;
+            std::unique_lock<std::mutex> lock(mutex);
+            for(;;){
+                start_cv.wait(lock, [&]{
+                    return tickets > 0 && generation != seen;
+                });
+                seen = generation;
+                tickets--;
+                active++;
+                const std::function<void(int)> *task = job;
+
+                lock.unlock();
+                run_tasks(*task);
+                lock.lock();
+
+                if(--active == 0){
+                    done_cv.notify_one();
+                }
+            }
+        }
+
+        std::vector<std::thread> threads;
+        std::mutex call_mutex;
+        std::mutex mutex;
+        std::condition_variable start_cv;
+        std::condition_variable done_cv;
+
+        const std::function<void(int)> *job;
+        int njobs;
+        int next;
+        int tickets;
+        int active;
+        unsigned long generation;
+};
+
+
+/*
+The process wide pool, created on first use. The threads of a pool don't
+survive a fork, so a forked child creates its own. The parent's pool is
+abandoned (never destroyed) because its threads can't be joined.
+*/
+static ThreadPool *thread_pool = NULL;
+static long thread_pool_pid = 0;
+static std::mutex thread_pool_mutex;
+
+static ThreadPool &get_thread_pool(){
+    std::lock_guard<std::mutex> lock(thread_pool_mutex);
+    long pid = (long) getpid();
+    if(thread_pool == NULL || thread_pool_pid != pid){
+        thread_pool = new ThreadPool();
+        thread_pool_pid = pid;
+    }
+    return *thread_pool;
+}
+
+
+/*
+The number of tasks that `work` (Q points * interfaces) should be split into,
+with no more than maxtasks tasks and no more than `workers` threads. If
+workers < 1 the number of CPUs is used.
+*/
+static int number_of_tasks(double work, int maxtasks, int workers){
+    if(workers < 1){
+        workers = (int) std::thread::hardware_concurrency();
+    }
+    double ntasks = std::min(work / MIN_WORK_PER_TASK, (double) maxtasks);
+    ntasks = std::min(ntasks, (double) workers);
+    return std::max((int) ntasks, 1);
+}
+
+
 void AbelesCalc_Imag(int numcoefs,
-                  const double *coefP,
-                   int npoints,
-                    double *yP,
+                     const double *coefP,
+                     int npoints,
+                     double *yP,
                      const double *xP,
-                      int workers){
+                     int workers){
 
-    std::vector<std::thread> threads;
+    int nlayers = (int) coefP[0];
+    int ntasks = number_of_tasks((double) npoints * (nlayers + 1),
+                                 npoints,
+                                 workers);
+
+    if(ntasks == 1){
+        AbelesCalc_Blocked(numcoefs, coefP, npoints, yP, xP);
+        return;
+    }
+
+    // the Q points are split into ntasks contiguous pieces
+    auto task = [&](int ii){
+        int first = (int) ((long) npoints * ii / ntasks);
+        int last = (int) ((long) npoints * (ii + 1) / ntasks);
+        AbelesCalc_Blocked(numcoefs,
+                           coefP,
+                           last - first,
+                           yP + first,
+                           xP + first);
+    };
+    get_thread_pool().parallel_for(ntasks, ntasks, task);
+}
 
-    int pointsEachThread, pointsRemaining, pointsConsumed;
 
-    // need to calculated how many points are given to each thread.
-    if(workers > 0){
-        pointsEachThread = floorl(npoints / workers);
-    } else {
-        pointsEachThread = npoints;
+void AbelesCalc_Batch(int nstructures,
+                      int numcoefs,
+                      const double *coefP,
+                      int npoints,
+                      double *yP,
+                      const double *xP,
+                      int workers){
+
+    if(workers < 1){
+        workers = (int) std::thread::hardware_concurrency();
     }
 
-    pointsRemaining = npoints;
-    pointsConsumed = 0;
-
-    for (int ii = 0; ii < workers; ii++){
-        if(ii < workers - 1){
-            threads.emplace_back(std::thread(AbelesCalc_ImagAll,
-                                             numcoefs,
-                                             coefP,
-                                             pointsEachThread,
-                                             yP + pointsConsumed,
-                                             xP + pointsConsumed));
-            pointsRemaining -= pointsEachThread;
-            pointsConsumed += pointsEachThread;
-        } else {
-            threads.emplace_back(std::thread(AbelesCalc_ImagAll,
-                                             numcoefs,
-                                             coefP,
-                                             pointsRemaining,
-                                             yP + pointsConsumed,
-                                             xP + pointsConsumed));
-            pointsRemaining -= pointsRemaining;
-            pointsConsumed += pointsRemaining;
+    // if there are fewer structures than workers then parallelise over the
+    // Q points of each structure instead.
+    if(nstructures < workers){
+        for (int ii = 0; ii < nstructures; ii++){
+            AbelesCalc_Imag(numcoefs,
+                            coefP + (size_t) ii * numcoefs,
+                            npoints,
+                            yP + (size_t) ii * npoints,
+                            xP,
+                            workers);
         }
+        return;
     }
 
-    // synchronise threads
-    for (auto& th : threads) th.join();
+    // one structure per task, the pool threads take the next structure when
+    // they've finished, which balances the load.
+    int nlayers = (int) coefP[0];
+    workers = number_of_tasks((double) nstructures * npoints * (nlayers + 1),
+                              nstructures,
+                              workers);
+    auto task = [&](int ii){
+        AbelesCalc_Blocked(numcoefs,
+                           coefP + (size_t) ii * numcoefs,
+                           npoints,
+                           yP + (size_t) ii * npoints,
+                           xP);
+    };
+    get_thread_pool().parallel_for(nstructures, workers, task);
 }
 
 
@@ -114,5 +295,45 @@ void reflect(int numcoefs,
             int npoints,
             double *yP,
             const double *xP){
-    AbelesCalc_ImagAll(numcoefs, coefP, npoints, yP, xP);
+    AbelesCalc_Blocked(numcoefs, coefP, npoints, yP, xP);
+}
+
+
+/*
+Reflectivity and its derivatives with respect to coefP
+*/
+void reflect_jacobian(int numcoefs,
+                      const double *coefP,
+                      int npoints,
+                      double *yP,
+                      double *jacP,
+                      const double *xP){
+    AbelesCalc_Jacobian(numcoefs, coefP, npoints, yP, jacP, xP);
+}
+
+
+/*
+Single precision, with an estimate of the relative error of each point
+*/
+void reflect_single(int numcoefs,
+                    const double *coefP,
+                    int npoints,
+                    double *yP,
+                    double *errP,
+                    const double *xP){
+    AbelesCalc_Single(numcoefs, coefP, npoints, yP, errP, xP);
+}
+
+
+/*
+Batched version, spread over threads
+*/
+void reflect_batch(int nstructures,
+                   int numcoefs,
+                   const double *coefP,
+                   int npoints,
+                   double *yP,
+                   const double *xP,
+                   int threads){
+    AbelesCalc_Batch(nstructures, numcoefs, coefP, npoints, yP, xP, threads);
 }
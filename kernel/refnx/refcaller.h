@@ -95,3 +95,27 @@ Non parallelised
 */
 void reflect(int numcoefs, const double *coefP, int npoints, double *yP,
              const double *xP);
+
+/*
+Non parallelised, also calculates the derivatives of yP with respect to each
+of the coefficients. jacP must be numcoefs * npoints long,
+jacP[k * npoints + j] is the derivative of yP[j] with respect to coefP[k].
+*/
+void reflect_jacobian(int numcoefs, const double *coefP, int npoints,
+                      double *yP, double *jacP, const double *xP);
+
+/*
+Non parallelised, single precision. errP (npoints long) is filled with an
+estimate of the relative error of each value in yP.
+*/
+void reflect_single(int numcoefs, const double *coefP, int npoints,
+                    double *yP, double *errP, const double *xP);
+
+/*
+Batched, parallelised over structures.
+coefP holds nstructures consecutive coefficient arrays, each numcoefs long,
+all with the same number of layers. yP is filled with nstructures
+consecutive reflectivity curves, each npoints long.
+*/
+void reflect_batch(int nstructures, int numcoefs, const double *coefP,
+                   int npoints, double *yP, const double *xP, int threads);
@@ -0,0 +1,168 @@
+import numpy as np
+from numpy.testing import assert_allclose
+import pytest
+
+import _reflect
+
+
+def _film():
+    # two layer film on silicon, with a critical edge in the Q range
+    return np.array(
+        [
+            [0, 0, 0, 0],
+            [250, 3.47, 0, 4],
+            [40, -0.5, 0, 3],
+            [0, 2.07, 0, 3],
+        ],
+        float,
+    )
+
+
+@pytest.mark.parametrize("rtol", [1e-4, 1e-7])
+@pytest.mark.parametrize("resolution", [0.01, 0.05])
+def test_abeles_smeared_auto_rtol(rtol, resolution):
+    # constant dQ/Q, so 'auto' uses FFT convolution, which must still meet
+    # the requested rtol
+    w = _film()
+    q = np.geomspace(0.008, 0.3, 200)
+    dq = resolution * q
+    reference = _reflect.abeles_smeared(
+        q, w, dq, rtol=1e-12, max_depth=40, method="adaptive"
+    )
+    smeared = _reflect.abeles_smeared(q, w, dq, rtol=rtol, method="auto")
+    assert_allclose(smeared, reference, rtol=rtol, atol=0)
+
+
+def _microsliced():
+    # a 300 Angstrom film and a 200 Angstrom layer on silicon, with diffuse
+    # interfaces, in 1 Angstrom slices
+    z = np.arange(-40, 560) + 0.5
+    rho = 4 * (1 + np.tanh(z / 5)) / 2
+    rho += -3 * (1 + np.tanh((z - 300) / 8)) / 2
+    rho += 1.07 * (1 + np.tanh((z - 500) / 4)) / 2
+    slabs = np.zeros((z.size + 2, 5))
+    slabs[1:-1, 0] = 1.0
+    slabs[1:-1, 1] = rho
+    slabs[-1, 1] = 2.07
+    return slabs
+
+
+@pytest.mark.parametrize("rtol", [1e-2, 1e-3, 1e-4])
+def test_contract_by_tolerance_dense(rtol):
+    # the tolerance must hold on a dense grid, not just at the probes
+    slabs = _microsliced()
+    q = np.linspace(0.005, 0.3, 20000)
+    contracted, dA, error = _reflect._contract_by_tolerance(slabs, q, rtol)
+    assert len(contracted) < len(slabs) / 2
+    assert error <= rtol
+
+    reference = _reflect.abeles(q, slabs[:, :4])
+    R = _reflect.abeles(q, contracted[:, :4])
+    assert_allclose(R, reference, rtol=rtol, atol=0)
+
+
+def _multilayer(nlayers):
+    rng = np.random.default_rng(1)
+    w = np.zeros((nlayers + 2, 4))
+    w[1:-1, 0] = rng.uniform(10, 100, nlayers)
+    w[1:-1, 1] = rng.uniform(-1, 7, nlayers)
+    w[1:-1, 2] = rng.uniform(0, 0.1, nlayers)
+    w[1:, 3] = rng.uniform(1, 5, nlayers + 1)
+    w[-1, 1] = 2.07
+    return w
+
+
+@pytest.mark.parametrize("backend", ["python", "c"])
+@pytest.mark.parametrize("nlayers", [2, 20, 50])
+def test_abeles_fast_error(backend, nlayers):
+    # the error estimate covers the actual error, without flagging most of
+    # the points of a multilayer for recalculation
+    if backend == "c":
+        abeles_fast = pytest.importorskip("_creflect").abeles_fast
+    else:
+        abeles_fast = _reflect.abeles_fast
+    w = _multilayer(nlayers)
+    q = np.linspace(0.005, 0.5, 5000)
+    reference = _reflect.abeles(q, w)
+    R, err = abeles_fast(q, w)
+
+    actual = np.abs(R / reference - 1)
+    assert np.all(actual <= err)
+    assert np.mean(err > 1e-3) < 0.1
+    assert_allclose(R, reference, rtol=1e-3)
+
+
+@pytest.mark.parametrize("repeats", [None, [(1, 4, 5)]])
+def test_pnr_rough_collinear(repeats):
+    # rough, collinear moments (one of them antiparallel) are calculated per
+    # spin state with abeles. Tilting every moment by 1e-5 degrees forces
+    # the 4x4 calculation, which must agree.
+    w = np.array(
+        [
+            [0, 0, 0, 0, 0, 0],
+            [100, 4, -0.01, 1.5, 0, 4],
+            [50, 2, 0, 1.0, 180, 3],
+            [80, 3, 0, 0.8, 0, 5],
+            [30, 1, 0, 0, 0, 2],
+            [0, 2.07, 0, 0, 0, 3],
+        ],
+        float,
+    )
+    q = np.linspace(0.005, 0.3, 500)
+    tilted = np.copy(w)
+    tilted[1:, 4] += 1e-5
+
+    pp, mm, pm, mp = _reflect.pnr(q, w, repeats=repeats)
+    reference = _reflect.pnr(q, tilted, repeats=repeats)
+    assert_allclose(pp, reference[0], rtol=1e-9)
+    assert_allclose(mm, reference[1], rtol=1e-9)
+    assert_allclose(pm, 0, atol=1e-12)
+    assert_allclose(mp, 0, atol=1e-12)
+
+    # the up state of a layer whose moment is parallel to the field sees
+    # SLD + magSLD
+    up = w[:, [0, 1, 2, 5]]
+    up[:, 1] += np.cos(np.radians(w[:, 4])) * w[:, 3]
+    up[:, 2] *= -1
+    if repeats is None:
+        assert_allclose(pp, _reflect.abeles(q, up), rtol=1e-12)
+
+
+def test_profile_stages():
+    w = _film()
+    q = np.geomspace(0.008, 0.3, 200)
+    with _reflect.profile() as p:
+        _reflect.abeles_smeared(q, w, 0.05 * q, method="fft")
+        _reflect.abeles_smeared(q, w, 0.05 * q, method="adaptive")
+        _reflect.abeles_fast(q, w)
+        _reflect.abeles_jacobian(q, w)
+        _reflect.abeles(q, w, repeats=[(1, 3, 4)])
+    snapshot = p.snapshot()
+
+    for kernel in ("abeles_smeared", "abeles_fast", "abeles_jacobian"):
+        assert kernel in snapshot["kernels"]
+    for stage in (
+        "abeles_smeared.reflectance",
+        "abeles_smeared.quadrature",
+        "abeles_smeared.fft",
+        "abeles_fast.wavevectors",
+        "abeles_fast.propagation",
+        "abeles_jacobian.wavevectors",
+        "abeles_jacobian.propagation",
+    ):
+        assert snapshot["stages"][stage]["seconds"] > 0
+    # abeles with repeats records the same stages as without
+    calls = snapshot["kernels"]["abeles"]["calls"]
+    assert snapshot["stages"]["abeles.propagation"]["calls"] == calls
+
+
+@pytest.mark.parametrize("chunk_size", [None, 7, 1000])
+def test_abeles_batch_chunk_size(chunk_size):
+    rng = np.random.default_rng(2)
+    population = np.stack([_film() for _ in range(5)])
+    population[:, 1:-1, 0] += rng.uniform(-20, 20, (5, 2))
+    q = np.linspace(0.005, 0.3, 101)
+
+    R = _reflect.abeles_batch(q, population, chunk_size=chunk_size)
+    for i, layers in enumerate(population):
+        assert_allclose(R[i], _reflect.abeles(q, layers), rtol=1e-12)
@@ -0,0 +1,341 @@
+"""
+Throughput comparison of the reflectivity packages on the validation corpus.
+
+Every test case from `test_discovery` is calculated by each available package
+(refnx, refl1d, GenX, BornAgain, anaklasis) with its unsmeared kernel, and
+tests with resolution information also with its resolution smeared path (e.g.
+refnx's ``quad_order=17`` against GenX's ``respoints=10001``), using the same
+set up as the validation tests. The Q range of each test is resampled to more
+points (``--scale``), so that the calculation time isn't dominated by
+overhead. Wall time, throughput and peak
+(Python traced) memory are reported side by side.
+
+Usage::
+
+    python benchmark.py [--scale 10] [--repeat 3] [--engines refnx genx]
+                        [--json results.json]
+
+Packages that aren't installed are skipped.
+"""
+
+import argparse
+import json
+import time
+import tracemalloc
+
+import numpy as np
+from test_discovery import get_test_data
+
+
+def _refnx():
+    from refnx.reflect import (
+        use_reflect_backend,
+        SLD,
+        ReflectModel,
+        Structure,
+    )
+
+    def kernel(q, slabs):
+        with use_reflect_backend("c") as abeles:
+            return abeles(q, slabs)
+
+    def smeared(q, dq, slabs):
+        structure = Structure()
+        for slab in slabs:
+            m = SLD(complex(slab[1], slab[2]))
+            structure |= m(slab[0], slab[-1])
+
+        with use_reflect_backend("c"):
+            model = ReflectModel(structure, bkg=0.0)
+            model.quad_order = 17
+            return model.model(q, x_err=dq * 2 * np.sqrt(2 * np.log(2)))
+
+    return kernel, smeared
+
+
+def _refl1d():
+    from refl1d.sample.reflectivity import reflectivity_amplitude
+    from refl1d.names import Stack, QProbe, Experiment, SLD
+
+    def kernel(q, slabs):
+        r = reflectivity_amplitude(
+            q / 2.0,
+            slabs[:, 0],
+            slabs[:, 1],
+            irho=slabs[:, 2],
+            sigma=slabs[1:, 3],
+        )
+        return (r * np.conj(r)).real
+
+    def smeared(q, dq, slabs):
+        stk = Stack()
+        for i, slab in enumerate(slabs[::-1]):
+            m = SLD(f"layer {i}", rho=slab[1], irho=slab[2])
+            stk |= m(thickness=slab[0], interface=slab[-1])
+
+        probe = QProbe(Q=q, dQ=dq)
+        probe.oversample(21, seed=1)
+        _, R = Experiment(stk, probe).reflectivity()
+        return R
+
+    return kernel, smeared
+
+
+def _genx():
+    import genx.models.spec_nx as model
+
+    def calc(q, dq, slabs):
+        layers = []
+        for thickness, rsld, isld, sigma in slabs:
+            layers.append(
+                model.Layer(
+                    b=(rsld - 1j * isld), dens=0.1, d=thickness, sigma=sigma
+                )
+            )
+        layers.reverse()
+        stack = model.Stack(Layers=list(layers[1:-1]), Repetitions=1)
+        sample = model.Sample(
+            Stacks=[stack], Ambient=layers[-1], Substrate=layers[0]
+        )
+        inst = model.Instrument(
+            probe="neutron pol",
+            wavelength=1.54,
+            coords="q",
+            I0=1,
+            res=0,
+            restype="no conv",
+            respoints=5,
+            resintrange=2,
+            beamw=0.1,
+            footype="no corr",
+            samplelen=10,
+            pol="uu",
+        )
+        if dq is not None:
+            inst.restype = "full conv and varying res."
+            inst.res = dq
+            inst.respoints = 10001
+            inst.resintrange = 3.5
+        return sample.SimSpecular(q, inst)
+
+    def kernel(q, slabs):
+        return calc(q, None, slabs)
+
+    return kernel, calc
+
+
+def _bornagain():
+    from test_bornagain import (
+        get_sample,
+        get_simulation,
+        get_simulation_smeared,
+    )
+
+    def kernel(q, slabs):
+        simulation = get_simulation(q, get_sample(slabs))
+        return simulation.simulate().array()
+
+    def smeared(q, dq, slabs):
+        simulation = get_simulation_smeared(q, dq, get_sample(slabs))
+        return simulation.simulate().array()
+
+    return kernel, smeared
+
+
+def _anaklasis():
+    from anaklasis import ref
+    from test_anaklasis import anaklasis_layer_matrix
+
+    def kernel(q, slabs):
+        layer_matrix = anaklasis_layer_matrix(slabs)
+        dq = np.zeros_like(q)
+        R = ref.Reflectivity(q, dq, [layer_matrix], 0, 0, 1, [1.0], 1)
+        return R[:, 1]
+
+    def smeared(q, dq, slabs):
+        # anaklasis expects the FWHM
+        layer_matrix = anaklasis_layer_matrix(slabs)
+        fwhm = dq * 2 * np.sqrt(2 * np.log(2))
+        R = ref.Reflectivity(q, fwhm, [layer_matrix], -1, 0, 1, [1.0], 1)
+        return R[:, 1]
+
+    return kernel, smeared
+
+
+# engine name -> function returning (kernel, smeared) calculators.
+# kernel(q, slabs) and smeared(q, dq, slabs) return the reflectivity.
+ENGINES = {
+    "refnx": _refnx,
+    "refl1d": _refl1d,
+    "genx": _genx,
+    "bornagain": _bornagain,
+    "anaklasis": _anaklasis,
+}
+
+
+def scaled_q(data, scale):
+    """
+    Resample the Q range of a test to `scale` times as many points.
+
+    Parameters
+    ----------
+    data: np.ndarray
+        Test data, Q in the first column and (if present) dQ in the fourth.
+    scale: float
+        Factor by which the number of points is increased.
+
+    Returns
+    -------
+    q, dq: np.ndarray
+        Resampled Q points, and dQ interpolated onto them (None if the test
+        has no resolution information).
+    """
+    order = np.argsort(data[:, 0])
+    q0 = data[order, 0]
+    q = np.linspace(q0[0], q0[-1], int(round(len(q0) * scale)))
+    dq = None
+    if data.shape[1] == 4:
+        dq = np.interp(q, q0, data[order, 3])
+    return q, dq
+
+
+def measure(func, repeat=3):
+    """
+    Best wall time and peak memory of a calculation.
+
+    Parameters
+    ----------
+    func: callable
+        The calculation.
+    repeat: int
+        Number of times to time the calculation.
+
+    Returns
+    -------
+    seconds, peak: float
+        Best wall time (s) and the peak memory traced by `tracemalloc` during
+        a separate, untimed, call (bytes). Memory allocated outside of
+        Python's allocators (e.g. by C++ libraries) isn't traced.
+    """
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+
+    # tracing slows the calculation down, so it isn't timed.
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def run(engines=None, scale=10, repeat=3):
+    """
+    Benchmark the engines on every test case.
+
+    Parameters
+    ----------
+    engines: sequence of str, optional
+        Engines to benchmark, by default all of `ENGINES`.
+    scale: float
+        Factor by which the number of Q points of each test is increased.
+    repeat: int
+        Number of times each calculation is timed.
+
+    Returns
+    -------
+    results: list of dict
+        One entry per (test, engine, path), with the number of points and
+        layers, the wall time (s), the throughput (points/s and
+        points * layers/s) and the peak traced memory (bytes).
+    """
+    if engines is None:
+        engines = list(ENGINES)
+
+    calculators = {}
+    for engine in engines:
+        try:
+            calculators[engine] = ENGINES[engine]()
+        except ImportError as e:
+            print(f"Skipping {engine}: {e}")
+
+    results = []
+    for test_name, slabs, data in get_test_data():
+        q, dq = scaled_q(data, scale)
+        nlayers = len(slabs) - 2
+        for engine, (kernel, smeared) in calculators.items():
+            paths = [("kernel", lambda: kernel(q, slabs))]
+            if dq is not None:
+                paths.append(("smeared", lambda: smeared(q, dq, slabs)))
+
+            for path, func in paths:
+                seconds, peak = measure(func, repeat=repeat)
+                results.append(
+                    {
+                        "test": test_name,
+                        "engine": engine,
+                        "path": path,
+                        "npoints": len(q),
+                        "nlayers": nlayers,
+                        "seconds": seconds,
+                        "points_per_s": len(q) / seconds,
+                        "points_layers_per_s": len(q) * (nlayers + 1) / seconds,
+                        "peak_bytes": peak,
+                    }
+                )
+    return results
+
+
+def report(results):
+    """
+    Format the results as a table, grouped by test.
+    """
+    lines = [
+        f"{'test':<14}{'path':<9}{'engine':<11}{'points':>8}{'layers':>8}"
+        f"{'time (s)':>11}{'points/s':>11}{'pts*lay/s':>11}{'peak MB':>9}"
+    ]
+    for r in sorted(
+        results, key=lambda r: (r["test"], r["path"], r["seconds"])
+    ):
+        lines.append(
+            f"{r['test']:<14}{r['path']:<9}{r['engine']:<11}"
+            f"{r['npoints']:>8}{r['nlayers']:>8}{r['seconds']:>11.3e}"
+            f"{r['points_per_s']:>11.3e}{r['points_layers_per_s']:>11.3e}"
+            f"{r['peak_bytes'] / 2**20:>9.1f}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compare the throughput of the reflectivity packages."
+    )
+    parser.add_argument(
+        "--engines",
+        nargs="+",
+        choices=list(ENGINES),
+        help="packages to benchmark, by default all of them",
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=10,
+        help="factor by which the number of Q points is increased",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", help="also write the results to a file")
+    args = parser.parse_args(argv)
+
+    results = run(engines=args.engines, scale=args.scale, repeat=args.repeat)
+    print(report(results))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()